@@ -1,10 +1,43 @@
 from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
 from config import Config
 from datetime import datetime
 
 def create_app():
     app = Flask(__name__)
     app.config.from_object(Config)
+    if app.config['TRUSTED_PROXIES']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
+
+    from app.admission import admission
+    admission.init_app(app)
+
+    from app.scheduler import checkpoint_scheduler
+    checkpoint_scheduler.init_app(app)
+
+    from app.jobs import job_manager
+    job_manager.init_app(app)
+
+    from app.workflows import workflow_registry
+    workflow_registry.init_app(app)
+
+    from app.cache import result_cache
+    result_cache.init_app(app)
+
+    from app.storage import output_store
+    output_store.init_app(app)
+
+    from app.models import gallery_index
+    gallery_index.init_app(app)
+
+    from app.thumbnails import thumbnails
+    thumbnails.init_app(app)
+
+    from app.retention import retention
+    retention.init_app(app)
+
+    from app.commands import register_commands
+    register_commands(app)
 
     from app import routes
     app.register_blueprint(routes.main)
@@ -0,0 +1,398 @@
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import closing, contextmanager
+from app import cancellation
+
+logger = logging.getLogger(__name__)
+
+# rank orders the queue (lower runs first), scale multiplies the per-client limits and
+# backlog is the share of ADMISSION_MAX_BACKLOG requests of the class may fill, so
+# low-priority work is turned away first when the server gets busy
+PRIORITY_CLASSES = {
+    'high': {'rank': 0, 'scale': 4, 'backlog': 1.0},
+    'normal': {'rank': 1, 'scale': 1, 'backlog': 0.9},
+    'low': {'rank': 2, 'scale': 1, 'backlog': 0.5},
+}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tickets (
+    id TEXT PRIMARY KEY,
+    client TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    concurrency INTEGER NOT NULL,
+    created REAL NOT NULL,
+    polled REAL NOT NULL,
+    started REAL,
+    pid INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS buckets (
+    client TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+'''
+
+
+class AdmissionRejected(Exception):
+    """The request is over a limit; ``retry_after`` is the suggested wait in whole seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(f"{message}; try again in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Ticket:
+    def __init__(self, client, priority, concurrency):
+        self.id = uuid.uuid4().hex
+        self.client = client
+        self.priority_class = None
+        self.priority = priority
+        self.concurrency = concurrency
+        self.created = time.time()
+
+
+def process_alive(pid):
+    """Return whether process ``pid`` on this host still exists, to free what dead workers held."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class AdmissionController:
+    """Admission control and fair queuing in front of every generation, shared by all workers.
+
+    ``admit`` turns a request away with AdmissionRejected when its client has run out of
+    tokens (``ADMISSION_RATE`` per minute, bursts of ``ADMISSION_BURST``), already has
+    ``ADMISSION_CLIENT_QUEUE`` requests admitted, or when the whole server holds its class's
+    share of ``ADMISSION_MAX_BACKLOG``. Admitted requests then wait for one of
+    ``ADMISSION_MAX_RUNNING`` slots: the next slot goes to the highest priority class,
+    then to the client with the fewest generations running, then to the oldest request,
+    and no client runs more than ``ADMISSION_CLIENT_CONCURRENCY`` at once. Waiting for
+    ``ADMISSION_AGING`` seconds lifts a request by one class, so low priority work is
+    delayed but never starved.
+
+    State lives in a SQLite database (``ADMISSION_DB``) so the limits hold across gunicorn
+    workers; tickets of workers that died are dropped. A waiting request that stops polling
+    is dropped after ``stale_seconds`` unless it is held (see hold()). Waiters poll every
+    ``poll_interval`` seconds, backing off to ``max_poll_interval`` while their place stays
+    the same.
+    """
+
+    # Seconds between checks of a waiting request, and before an unpolled waiting ticket is dropped
+    poll_interval = 0.25
+    # No longer than cancellation.POLL_SECONDS, so a cancelled waiter still leaves within a second
+    max_poll_interval = 1.0
+    stale_seconds = 30
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.db_path = None
+        self.rate = 30
+        self.burst = 10
+        self.client_concurrency = 2
+        self.client_queue = 8
+        self.max_running = 8
+        self.max_backlog = 64
+        self.max_wait = 600
+        self.aging = 60
+        self.api_keys = {}
+        self.default_class = 'normal'
+        # Tickets of this process waiting to start polling, e.g. jobs queued for an executor thread
+        self._held = {}
+        self._heartbeat_pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.enabled = config['ADMISSION_ENABLED']
+        self.db_path = config['ADMISSION_DB']
+        self.rate = config['ADMISSION_RATE']
+        self.burst = config['ADMISSION_BURST']
+        self.client_concurrency = config['ADMISSION_CLIENT_CONCURRENCY']
+        self.client_queue = config['ADMISSION_CLIENT_QUEUE']
+        self.max_running = config['ADMISSION_MAX_RUNNING']
+        self.max_backlog = config['ADMISSION_MAX_BACKLOG']
+        self.max_wait = config['ADMISSION_MAX_WAIT']
+        self.aging = config['ADMISSION_AGING']
+        self.default_class = config['ADMISSION_DEFAULT_CLASS']
+        self.api_keys = {}
+        for entry in filter(None, (part.strip() for part in config['ADMISSION_API_KEYS'].split(','))):
+            key, _, priority_class = entry.partition(':')
+            if priority_class not in PRIORITY_CLASSES:
+                raise ValueError(f"Unknown priority class {priority_class!r} in ADMISSION_API_KEYS")
+            self.api_keys[key] = priority_class
+        if self.enabled:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            with closing(self._connect()) as db:
+                db.execute('PRAGMA journal_mode=WAL')
+                db.executescript(SCHEMA)
+        app.extensions['admission'] = self
+
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        with closing(self._connect()) as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    def identify(self, request):
+        """Return ``(client, priority class)`` for a request: its API key if known, otherwise its address."""
+        key = request.headers.get('X-API-Key')
+        if key and key in self.api_keys:
+            return f"key:{hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]}", self.api_keys[key]
+        return f"ip:{request.remote_addr}", self.default_class
+
+    def _purge(self, db, now):
+        db.execute('DELETE FROM tickets WHERE started IS NULL AND polled < ?', (now - self.stale_seconds,))
+        for (pid,) in db.execute('SELECT DISTINCT pid FROM tickets').fetchall():
+            if not process_alive(pid):
+                logger.warning(f"Dropping admission tickets of exited worker {pid}")
+                db.execute('DELETE FROM tickets WHERE pid = ?', (pid,))
+
+    def _check_limits(self, db, client, priority_class):
+        """Raise AdmissionRejected if ``client`` may not add another request to the queue."""
+        scale = priority_class['scale']
+        total = db.execute('SELECT COUNT(*) FROM tickets').fetchone()[0]
+        if total >= max(1, int(self.max_backlog * priority_class['backlog'])):
+            logger.warning(f"Admission backlog full ({total} requests); rejecting {client}")
+            raise AdmissionRejected('Server is busy', self._retry_after(db, total - self.max_running + 1))
+        mine = db.execute('SELECT COUNT(*) FROM tickets WHERE client = ?', (client,)).fetchone()[0]
+        if mine >= self.client_queue * scale:
+            raise AdmissionRejected('Too many requests in progress for this client', self._retry_after(db, mine))
+
+    def _retry_after(self, db, ahead):
+        """Guess how long until ``ahead`` more generations have finished, from the recent average run time."""
+        row = db.execute("SELECT value FROM meta WHERE key = 'avg_seconds'").fetchone()
+        average = row['value'] if row else 10.0
+        return min(max(1, math.ceil(average * max(ahead, 1) / self.max_running)), 600)
+
+    def hold(self, ticket):
+        """Keep ``ticket`` in the queue until it is released, even while nothing polls it.
+
+        For requests that wait elsewhere before they start polling, such as ``mode=job``
+        generations and batches queued for a JobManager thread; a background thread marks
+        held tickets as polled every ``stale_seconds / 3`` seconds.
+        """
+        if ticket is None:
+            return
+        with self._lock:
+            self._held[ticket.id] = ticket
+            if self._heartbeat_pid == os.getpid():
+                return
+            # Started lazily so each gunicorn worker gets its own thread after the fork
+            self._heartbeat_pid = os.getpid()
+        threading.Thread(target=self._heartbeat_loop, name='admission-heartbeat', daemon=True).start()
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(self.stale_seconds / 3)
+            try:
+                self.heartbeat()
+            except Exception:
+                logger.exception("Admission heartbeat failed")
+
+    def heartbeat(self, now=None):
+        """Mark this process's held tickets as polled so they are not dropped as stale."""
+        with self._lock:
+            held = list(self._held)
+        if not held:
+            return
+        with self._transaction() as db:
+            db.executemany('UPDATE tickets SET polled = ? WHERE id = ?', [(now or time.time(), id) for id in held])
+
+    def admit(self, client, priority_class=None, now=None):
+        """Admit a request from ``client`` and return its Ticket, or None when admission control is off.
+
+        Raises AdmissionRejected if the client or the server is over its limits.
+        """
+        if not self.enabled:
+            return None
+        now = now or time.time()
+        priority_class = PRIORITY_CLASSES[priority_class or self.default_class]
+        scale = priority_class['scale']
+        rate = self.rate * scale / 60
+        burst = self.burst * scale
+
+        with self._transaction() as db:
+            self._purge(db, now)
+            bucket = db.execute('SELECT tokens, updated FROM buckets WHERE client = ?', (client,)).fetchone()
+            tokens = burst if bucket is None else min(burst, bucket['tokens'] + (now - bucket['updated']) * rate)
+            if tokens < 1:
+                raise AdmissionRejected('Rate limit exceeded', math.ceil((1 - tokens) / rate))
+            self._check_limits(db, client, priority_class)
+
+            ticket = Ticket(client, priority_class['rank'], self.client_concurrency * scale)
+            ticket.priority_class = priority_class
+            ticket.created = now
+            db.execute('INSERT OR REPLACE INTO buckets (client, tokens, updated) VALUES (?, ?, ?)',
+                       (client, tokens - 1, now))
+            self._insert(db, ticket, now)
+        return ticket
+
+    @staticmethod
+    def _insert(db, ticket, now):
+        db.execute('INSERT INTO tickets (id, client, priority, concurrency, created, polled, pid) '
+                   'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                   (ticket.id, ticket.client, ticket.priority, ticket.concurrency, ticket.created, now,
+                    os.getpid()))
+
+    def poll(self, ticket, now=None):
+        """Hand out free slots in fair order; return None once ``ticket`` may run, else its queue position."""
+        now = now or time.time()
+        with self._transaction() as db:
+            self._purge(db, now)
+            if not db.execute('UPDATE tickets SET polled = ? WHERE id = ?', (now, ticket.id)).rowcount:
+                # Dropped while nothing polled it; rejoin in its old place, but only within the limits
+                self._check_limits(db, ticket.client, ticket.priority_class or PRIORITY_CLASSES[self.default_class])
+                self._insert(db, ticket, now)
+            rows = db.execute('SELECT id, client, priority, concurrency, created, started FROM tickets').fetchall()
+            running = Counter(row['client'] for row in rows if row['started'] is not None)
+            free = self.max_running - sum(running.values())
+
+            def order(row):
+                priority = row['priority'] - ((now - row['created']) / self.aging if self.aging else 0)
+                return priority, running[row['client']], row['created']
+
+            granted = {row['id'] for row in rows if row['started'] is not None}
+            position = 0
+            for row in sorted((row for row in rows if row['started'] is None), key=order):
+                if free > 0 and running[row['client']] < row['concurrency']:
+                    db.execute('UPDATE tickets SET started = ? WHERE id = ?', (now, row['id']))
+                    running[row['client']] += 1
+                    free -= 1
+                    granted.add(row['id'])
+                else:
+                    position += 1
+                    if row['id'] == ticket.id:
+                        return position
+        return None if ticket.id in granted else position
+
+    def release(self, ticket, now=None):
+        """Give up ``ticket``'s place or slot, recording how long it ran for the Retry-After estimate."""
+        if ticket is None:
+            return
+        now = now or time.time()
+        with self._lock:
+            self._held.pop(ticket.id, None)
+        with self._transaction() as db:
+            row = db.execute('SELECT started FROM tickets WHERE id = ?', (ticket.id,)).fetchone()
+            db.execute('DELETE FROM tickets WHERE id = ?', (ticket.id,))
+            if row is not None and row['started'] is not None:
+                db.execute("INSERT INTO meta (key, value) VALUES ('avg_seconds', ?) "
+                           "ON CONFLICT (key) DO UPDATE SET value = 0.8 * value + 0.2 * excluded.value",
+                           (now - row['started'],))
+
+    def wait(self, ticket):
+        """Block until ``ticket`` may run, yielding a progress string whenever its queue position changes."""
+        if ticket is None:
+            return
+        deadline = time.monotonic() + self.max_wait
+        last = None
+        interval = self.poll_interval
+        while True:
+            cancellation.check()
+            position = self.poll(ticket)
+            if position is None:
+                return
+            if position != last:
+                yield f"Queue position: {position}"
+                last = position
+                interval = self.poll_interval
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Timed out after {self.max_wait:.0f}s in the admission queue")
+            time.sleep(interval)
+            interval = self._back_off(interval)
+
+    def queue(self, ticket, make_generator):
+        """Yield queue positions until ``ticket`` may run, then the items of ``make_generator()``."""
+        try:
+            try:
+                yield from self.wait(ticket)
+            except TimeoutError as e:
+                logger.warning(str(e))
+                yield f"Error: {e}"
+                yield []
+                return
+            yield from make_generator()
+        finally:
+            self.release(ticket)
+
+    async def queue_async(self, ticket, make_generator):
+        """Async queue(): ``make_generator()`` returns an async generator."""
+        try:
+            if ticket is not None:
+                deadline = time.monotonic() + self.max_wait
+                last = None
+                interval = self.poll_interval
+                while True:
+                    cancellation.check()
+                    position = await asyncio.to_thread(self.poll, ticket)
+                    if position is None:
+                        break
+                    if position != last:
+                        yield f"Queue position: {position}"
+                        last = position
+                        interval = self.poll_interval
+                    if time.monotonic() >= deadline:
+                        logger.warning(f"Timed out after {self.max_wait:.0f}s in the admission queue")
+                        yield f"Error: Timed out after {self.max_wait:.0f}s in the admission queue"
+                        yield []
+                        return
+                    await asyncio.sleep(interval)
+                    interval = self._back_off(interval)
+            async for item in make_generator():
+                yield item
+        finally:
+            await asyncio.to_thread(self.release, ticket)
+
+    def _back_off(self, interval):
+        """The next wait between polls while a request's place in the queue has not changed."""
+        return min(interval * 2, self.max_poll_interval)
+
+    def stats(self):
+        if not self.enabled:
+            return {'enabled': False}
+        with closing(self._connect()) as db:
+            rows = db.execute('SELECT priority, started FROM tickets').fetchall()
+            average = db.execute("SELECT value FROM meta WHERE key = 'avg_seconds'").fetchone()
+        names = {spec['rank']: name for name, spec in PRIORITY_CLASSES.items()}
+        waiting = Counter(names[row['priority']] for row in rows if row['started'] is None)
+        return {
+            'enabled': True,
+            'running': sum(1 for row in rows if row['started'] is not None),
+            'waiting': sum(waiting.values()),
+            'waiting_by_class': dict(waiting),
+            'max_running': self.max_running,
+            'max_backlog': self.max_backlog,
+            'avg_run_seconds': round(average['value'], 3) if average else None,
+        }
+
+
+admission = AdmissionController()
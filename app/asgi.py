@@ -0,0 +1,230 @@
+import asyncio
+import functools
+import io
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgiInstance
+from flask import request
+from app import routes
+from app.admission import AdmissionRejected, admission
+from app.cancellation import CancelScope, Cancelled
+from app.async_utils import close_clients, generate_image_async, generate_image_to_image_async
+from app.forms import ImageGenerationForm, ImageToImageForm
+from app.previews import Preview
+
+logger = logging.getLogger(__name__)
+
+# path -> (kind, form class, request binder, async generator, stream)
+ASYNC_ROUTES = {
+    '/generate': ('text_to_image', ImageGenerationForm, routes._text_to_image_request, generate_image_async, False),
+    '/generate/stream': ('text_to_image', ImageGenerationForm, routes._text_to_image_request, generate_image_async,
+                         True),
+    '/generate_image_to_image': ('image_to_image', ImageToImageForm, routes._image_to_image_request,
+                                 generate_image_to_image_async, False),
+    '/generate_image_to_image/stream': ('image_to_image', ImageToImageForm, routes._image_to_image_request,
+                                        generate_image_to_image_async, True),
+}
+
+
+async def _generation_events_async(image_generator, output_meta, trace, scope):
+    """Async counterpart of routes._generation_events."""
+    with trace.activate(), scope.activate():
+        generated_images = None
+        async for item in image_generator:
+            if isinstance(item, str):
+                if item.startswith("Error:"):
+                    logger.error(f"Error during image generation: {item}")
+                    raise routes.GenerationError(item)
+                logger.info(f"Generation progress: {item}")
+                yield 'progress', item
+            elif isinstance(item, Preview):
+                yield 'preview', item
+            elif isinstance(item, list):
+                generated_images = item
+        # Renames, the gallery index and thumbnail hand-off touch the disk; keep them off the loop
+        filenames = await asyncio.to_thread(routes._save_outputs, generated_images, output_meta)
+    yield 'result', filenames
+
+
+class _ThreadedWsgiInstance(WsgiToAsgiInstance):
+    """WsgiToAsgiInstance that runs the WSGI app on ``executor`` rather than asgiref's single sync thread.
+
+    asgiref calls WSGI apps thread-sensitively, so every Flask request in a worker would
+    wait its turn on one thread; the app is thread-safe and needs no such serialisation.
+    """
+
+    def __init__(self, wsgi_application, executor):
+        super().__init__(wsgi_application)
+        self.executor = executor
+
+    async def run_wsgi_app(self, body):
+        # The undecorated method: it sends through AsyncToSync, so any thread will do
+        run = functools.partial(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func, self)
+        await sync_to_async(run, thread_sensitive=False, executor=self.executor)(body)
+
+
+class AsyncGenerationApp:
+    """ASGI entry point that runs generations on the event loop.
+
+    POSTs to the generation routes (other than ``mode=job``) are validated with the usual
+    Flask forms and CSRF checks, then driven through app.async_utils, so one worker process
+    can supervise many in-flight ComfyUI jobs while it waits on I/O. Every other request,
+    and any generation POST that fails validation, is handed to the Flask app unchanged.
+    A client that disconnects mid-generation has its ComfyUI prompt deleted or interrupted.
+    Flask requests run on a pool of ``ASGI_THREADS`` threads, so they do not queue behind
+    each other.
+    """
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(max_workers=flask_app.config['ASGI_THREADS'], thread_name_prefix='wsgi')
+
+    async def wsgi(self, scope, receive, send):
+        await _ThreadedWsgiInstance(self.flask_app, self.executor)(scope, receive, send)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] in ASYNC_ROUTES:
+            return await self._generate(scope, receive, send)
+        return await self.wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await close_clients()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _generate(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        body = bytes(body)
+
+        async def replay():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        kind, form_class, bind, generate, stream = ASYNC_ROUTES[scope['path']]
+        environ = _build_environ(self.flask_app, scope, body)
+        with self.flask_app.request_context(environ):
+            if request.values.get('mode') == 'job':
+                bound = None
+            else:
+                form = form_class()
+                bound = form.validate_on_submit()
+            if bound:
+                try:
+                    # Binding stores an uploaded input image and admission is an SQLite transaction; both
+                    # block, so they run on a thread (which sees this request context) rather than the loop
+                    make_generator, output_meta = await asyncio.to_thread(
+                        bind, form, generate, previews=stream and routes._wants_previews())
+                    ticket = await asyncio.to_thread(routes._admission_ticket)
+                except routes.GenerationError as e:
+                    return await _send_json(send, {'success': False, 'error': str(e)})
+                except AdmissionRejected as e:
+                    return await _send_json(send, {'success': False, 'error': str(e), 'retry_after': e.retry_after},
+                                            status=429, headers=[(b'retry-after', str(e.retry_after).encode('ascii'))])
+                make_generator = functools.partial(admission.queue_async, ticket, make_generator)
+                trace = routes._new_trace(kind)
+                cancel_scope = CancelScope(deadline=routes._deadline())
+        if not bound:
+            # Jobs, invalid forms and anything else keep Flask's own handling
+            return await self.wsgi(scope, replay, send)
+
+        with self.flask_app.app_context():
+            handler = self._stream if stream else self._respond
+            await _cancel_on_disconnect(handler(kind, make_generator, output_meta, trace, cancel_scope, send),
+                                        receive, cancel_scope)
+
+    async def _respond(self, kind, make_generator, output_meta, trace, cancel_scope, send):
+        try:
+            filenames = []
+            async for event, payload in _generation_events_async(make_generator(), output_meta, trace,
+                                                                 cancel_scope):
+                if event == 'result':
+                    filenames = payload
+            data = {'success': True, 'filename': filenames[0], 'filenames': filenames, 'trace': trace.to_dict()}
+        except (routes.GenerationError, Cancelled) as e:
+            data = {'success': False, 'error': str(e), 'trace': trace.to_dict()}
+        except Exception as e:
+            logger.exception(f"Unexpected error during {kind} generation")
+            data = {'success': False, 'error': str(e), 'trace': trace.to_dict()}
+        await _send_json(send, data)
+
+    async def _stream(self, kind, make_generator, output_meta, trace, cancel_scope, send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            # Tell nginx not to buffer the stream so each event reaches the browser immediately
+            (b'x-accel-buffering', b'no'),
+        ]})
+        try:
+            async for event, payload in _generation_events_async(make_generator(), output_meta, trace,
+                                                                 cancel_scope):
+                if event == 'progress':
+                    chunk = routes._sse('progress', {'message': payload})
+                elif event == 'preview':
+                    chunk = routes._sse('preview', payload.to_dict())
+                else:
+                    chunk = routes._sse('result', {'success': True, 'filename': payload[0], 'filenames': payload,
+                                                   'trace': trace.to_dict()})
+                await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+        except (routes.GenerationError, Cancelled) as e:
+            chunk = routes._sse('error', {'success': False, 'error': str(e)})
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+        except Exception as e:
+            logger.exception(f"Unexpected error during {kind} generation")
+            chunk = routes._sse('error', {'success': False, 'error': str(e)})
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+async def _cancel_on_disconnect(handler, receive, cancel_scope):
+    """Run the response coroutine ``handler``, cancelling it if the client disconnects before it finishes."""
+    async def disconnected():
+        # The body has been read, so the next message is http.disconnect
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    task = asyncio.ensure_future(handler)
+    watcher = asyncio.ensure_future(disconnected())
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if task.done():
+        return task.result()
+    logger.info("Client disconnected; cancelling its generation")
+    cancel_scope.cancel('abandoned')
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+def _build_environ(flask_app, scope, body):
+    instance = WsgiToAsgiInstance(flask_app)
+    # build_environ reads the headers from the instance rather than its argument
+    instance.scope = scope
+    return instance.build_environ(scope, io.BytesIO(body))
+
+
+async def _send_json(send, data, status=200, headers=()):
+    body = json.dumps(data).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status, 'headers': [
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(body)).encode('ascii')),
+        *headers,
+    ]})
+    await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,437 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+import weakref
+import aiohttp
+from flask import current_app
+from app.backends import backend_pool
+from app import cancellation
+from app.cache import result_cache
+from app.cancellation import PromptWatch, record_cancellation, record_execution
+from app.coalesce import single_flight
+from app.metrics import Stages, count_bytes
+from app.previews import PreviewThrottle
+from app.scheduler import checkpoint_scheduler, checkpoint_of
+from app.uploads import is_content_addressed
+from app.utils import (PromptFailed, _abandon_reason, _bind_image_to_image, _bind_text_to_image,
+                       _generation_keys, _progress_event, _tag_seed, _uploaded_inputs)
+from app.websocket_manager import (CONNECT_TIMEOUT, RECONNECT_BACKOFF_INITIAL, RECONNECT_BACKOFF_MAX, Subscription,
+                                   WebSocketManager)
+
+logger = logging.getLogger(__name__)
+
+# Per event loop: {server_address: AsyncComfyUIClient}
+_clients = weakref.WeakKeyDictionary()
+
+
+class AsyncSubscription(Subscription):
+    """Subscription whose ``recv()`` is awaited instead of blocking a thread."""
+
+    def __init__(self, manager, prompt_id):
+        self.manager = manager
+        self.prompt_id = prompt_id
+        self.queue = asyncio.Queue()
+
+    async def recv(self, timeout=None):
+        item = await asyncio.wait_for(self.queue.get(), timeout)
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+
+class AsyncWebSocketManager(WebSocketManager):
+    """WebSocketManager whose reader is a task on the event loop rather than a thread."""
+
+    subscription_class = AsyncSubscription
+
+    def __init__(self, server_address, session):
+        super().__init__(server_address)
+        self.session = session
+        self._connected = asyncio.Event()
+        self._stopped = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run(), name='comfyui-ws')
+
+    async def wait_connected(self, timeout=CONNECT_TIMEOUT):
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"Failed to connect to WebSocket {self.ws_url}: {self._last_error}")
+
+    async def close(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        backoff = RECONNECT_BACKOFF_INITIAL
+        while not self._stopped.is_set():
+            try:
+                logger.debug(f"Attempting to connect to WebSocket: {self.ws_url}")
+                async with self.session.ws_connect(self.ws_url, timeout=aiohttp.ClientWSTimeout(ws_close=10),
+                                                   max_msg_size=0) as ws:
+                    self._connected.set()
+                    logger.info(f"WebSocket connection established: {self.ws_url}")
+                    backoff = RECONNECT_BACKOFF_INITIAL
+                    async for message in ws:
+                        if message.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                            self._dispatch(message.data)
+                        elif message.type == aiohttp.WSMsgType.ERROR:
+                            raise ws.exception()
+                raise ConnectionError("WebSocket closed by server")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self._stopped.is_set():
+                    break
+                self._last_error = e
+                self._connected.clear()
+                logger.error(f"WebSocket connection lost: {e}; reconnecting in {backoff}s")
+                self._fail_subscriptions(e)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX)
+
+
+class AsyncComfyUIClient:
+    """aiohttp session and shared WebSocket for one ComfyUI backend, bound to one event loop."""
+
+    def __init__(self, server_address, session):
+        self.server_address = server_address
+        self.session = session
+        self.ws = AsyncWebSocketManager(server_address, session)
+
+    async def queue_prompt(self, prompt):
+        url = f"{self.server_address}/prompt"
+        async with self.session.post(url, json={"prompt": prompt, "client_id": self.ws.client_id}) as response:
+            response.raise_for_status()
+            response_data = await response.json()
+        logger.info(f"Prompt queued successfully: {response_data}")
+        if 'prompt_id' not in response_data:
+            logger.error(f"Unexpected response from ComfyUI: {response_data}")
+            raise ValueError(f"Unexpected response from ComfyUI: {response_data}")
+        return response_data['prompt_id']
+
+    async def cancel_prompt(self, prompt_id, running):
+        """Async counterpart of app.utils.cancel_prompt."""
+        if running:
+            url, payload = f"{self.server_address}/interrupt", {'prompt_id': prompt_id}
+        else:
+            url, payload = f"{self.server_address}/queue", {'delete': [prompt_id]}
+        async with self.session.post(url, json=payload) as response:
+            response.raise_for_status()
+
+    async def get_history(self, prompt_id):
+        async with self.session.get(f"{self.server_address}/history/{prompt_id}") as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def fetch_image(self, image, output_dir=None, chunk_size=64 * 1024):
+        """Download one output image, to a uniquely named file in ``output_dir`` when given."""
+        params = {"filename": image['filename'], "subfolder": image['subfolder'], "type": image['type']}
+        entry = {'image_data': None, 'file_name': image['filename'], 'type': image['type']}
+        try:
+            async with self.session.get(f"{self.server_address}/view", params=params) as response:
+                response.raise_for_status()
+                if output_dir is None:
+                    entry['image_data'] = await response.read()
+                    count_bytes('download', len(entry['image_data']))
+                else:
+                    dest_path = os.path.join(output_dir, f".{uuid.uuid4().hex}_{os.path.basename(image['filename'])}")
+                    size = 0
+                    try:
+                        with open(dest_path, 'wb') as f:
+                            async for chunk in response.content.iter_chunked(chunk_size):
+                                f.write(chunk)
+                                size += len(chunk)
+                    except BaseException:
+                        if os.path.exists(dest_path):
+                            os.remove(dest_path)
+                        raise
+                    entry['path'] = dest_path
+                    count_bytes('download', size)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            entry['error'] = str(e) or type(e).__name__
+        return entry
+
+    async def ensure_uploaded(self, input_path, name):
+        """Async counterpart of app.utils.ensure_uploaded; shares its record of uploaded inputs."""
+        key = (self.server_address, name)
+        if is_content_addressed(name):
+            if key in _uploaded_inputs:
+                return False
+            params = {"filename": name, "subfolder": "", "type": "input"}
+            try:
+                async with self.session.head(f"{self.server_address}/view", params=params) as response:
+                    if response.status == 200:
+                        logger.info(f"Skipping upload, backend already has {name}")
+                        _uploaded_inputs.add(key)
+                        return False
+            except aiohttp.ClientError as e:
+                logger.debug(f"Could not check for input image {name}: {e}")
+
+        with open(input_path, 'rb') as f:
+            form = aiohttp.FormData()
+            form.add_field('image', f, filename=name, content_type='image/png')
+            form.add_field('type', 'input')
+            form.add_field('overwrite', 'false')
+            async with self.session.post(f"{self.server_address}/upload/image", data=form) as response:
+                response.raise_for_status()
+        count_bytes('upload', os.path.getsize(input_path))
+        logger.info(f"Image uploaded successfully: {name}")
+        if is_content_addressed(name):
+            _uploaded_inputs.add(key)
+        return True
+
+
+async def get_client(server_address):
+    """Return this event loop's connected client for ``server_address``, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    clients = _clients.setdefault(loop, {})
+    client = clients.get(server_address)
+    if client is None:
+        config = current_app.config
+        session = clients.get(None)
+        if session is None:
+            connector = aiohttp.TCPConnector(limit_per_host=config['COMFYUI_POOL_SIZE'])
+            timeout = aiohttp.ClientTimeout(sock_connect=config['COMFYUI_CONNECT_TIMEOUT'],
+                                            sock_read=config['COMFYUI_READ_TIMEOUT'])
+            session = clients[None] = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        client = clients[server_address] = AsyncComfyUIClient(server_address, session)
+        client.ws.start()
+    await client.ws.wait_connected()
+    return client
+
+
+async def close_clients():
+    clients = _clients.pop(asyncio.get_running_loop(), {})
+    session = clients.pop(None, None)
+    for client in clients.values():
+        await client.ws.close()
+    if session is not None:
+        await session.close()
+
+
+async def track_progress_async(prompt, subscription, prompt_id, on_start=None, previews=None):
+    node_ids = list(prompt.keys())
+    finished_nodes = []
+    scope = cancellation.current()
+    while True:
+        if scope is not None:
+            scope.check()
+            try:
+                out = await subscription.recv(timeout=scope.poll_timeout())
+            except asyncio.TimeoutError:
+                continue
+        else:
+            out = await subscription.recv()
+        if previews is not None and isinstance(out, bytes):
+            frame = previews.take(out)
+            if frame is not None:
+                # Decoding and re-encoding is CPU work; keep it off the event loop
+                preview = await asyncio.to_thread(previews.render, frame)
+                if preview is not None:
+                    yield preview
+        progress, started, finished = _progress_event(out, node_ids, prompt_id, finished_nodes)
+        if started and on_start is not None:
+            on_start()
+        if progress is not None:
+            yield progress
+        if finished:
+            return
+
+
+async def _request_slot(server_address, ckpt_name):
+    """Take a checkpoint scheduler ticket; returns it with a future the event loop can await for the grant."""
+    loop = asyncio.get_running_loop()
+    granted = loop.create_future()
+
+    def on_grant():
+        loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(True))
+
+    ticket = await asyncio.to_thread(checkpoint_scheduler.request, server_address, ckpt_name, on_grant=on_grant)
+    return ticket, granted
+
+
+async def _run_prompt_async(prompt, server_address, ckpt_name, stages, save_previews, output_dir,
+                            input_path=None, filename=None, live_previews=False):
+    subscription = None
+    ticket = None
+    try:
+        with stages.stage('ws_connect'):
+            client = await get_client(server_address)
+        if input_path is not None:
+            with stages.stage('upload'):
+                await client.ensure_uploaded(input_path, filename)
+
+        ticket, granted = await _request_slot(server_address, ckpt_name)
+        if not ticket.granted:
+            yield "Waiting for a free GPU slot"
+            with stages.stage('slot_wait'):
+                # Grants made by this worker resolve the future; those made by another show up on a poll
+                interval = checkpoint_scheduler.poll_interval
+                while not granted.done():
+                    cancellation.check()
+                    await asyncio.wait({granted}, timeout=interval)
+                    if not granted.done():
+                        await asyncio.to_thread(checkpoint_scheduler.poll, ticket)
+                    interval = checkpoint_scheduler.back_off(interval)
+        with stages.stage('queue_prompt'):
+            prompt_id = await client.queue_prompt(prompt)
+        subscription = client.ws.subscribe(prompt_id)
+        queued_at = time.perf_counter()
+        watch = PromptWatch(prompt_id, ckpt_name)
+        previews = PreviewThrottle.from_config() if live_previews else None
+
+        def on_start():
+            watch.start()
+            stages.observe('comfy_queue_wait', watch.started_at - queued_at)
+
+        try:
+            yield f"Prompt queued with ID: {prompt_id}"
+            async for progress in track_progress_async(prompt, subscription, prompt_id, on_start=on_start,
+                                                       previews=previews):
+                if isinstance(progress, str):
+                    watch.progress(progress)
+                yield progress
+        except PromptFailed:
+            raise
+        except BaseException as e:
+            # A disconnected client surfaces here as the request task being cancelled
+            await _abandon_prompt_async(client, watch, e)
+            raise
+        execution = time.perf_counter() - (watch.started_at or queued_at)
+        stages.observe('execution', execution)
+        record_execution(ckpt_name, execution)
+        await asyncio.to_thread(checkpoint_scheduler.release, ticket)
+        ticket = None
+
+        with stages.stage('history_fetch'):
+            history = await client.get_history(prompt_id)
+        if prompt_id not in history:
+            logger.error(f"No history found for prompt ID: {prompt_id}")
+            yield f"Error: No history found for prompt ID: {prompt_id}"
+            yield []
+            return
+
+        wanted = [image for node_output in history[prompt_id]['outputs'].values()
+                  for image in node_output.get('images', [])
+                  if image['type'] == 'output' or (save_previews and image['type'] == 'temp')]
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+        # Like get_images_from_history, keep at most COMFYUI_FETCH_WORKERS downloads going per prompt
+        fetch_slots = asyncio.Semaphore(current_app.config['COMFYUI_FETCH_WORKERS'])
+
+        async def fetch(image):
+            async with fetch_slots:
+                return await client.fetch_image(image, output_dir)
+
+        with stages.stage('image_download'):
+            images = list(await asyncio.gather(*(fetch(image) for image in wanted)))
+        _tag_seed(images, prompt)
+        if not images:
+            logger.warning(f"No images generated for prompt ID: {prompt_id}")
+            yield "Warning: No images were generated"
+        failed = [image for image in images if 'error' in image]
+        if failed:
+            yield f"Warning: {len(failed)} of {len(images)} images could not be downloaded"
+        yield images
+    finally:
+        if subscription is not None:
+            subscription.close()
+        if ticket is not None:
+            # Shielded so the slot is still freed while the request task is being torn down
+            await asyncio.shield(asyncio.to_thread(checkpoint_scheduler.release, ticket))
+
+
+async def _abandon_prompt_async(client, watch, error):
+    reason = 'abandoned' if isinstance(error, asyncio.CancelledError) else _abandon_reason(error)
+    try:
+        # Shielded so the cancel still reaches ComfyUI while the request task is being torn down
+        await asyncio.shield(client.cancel_prompt(watch.prompt_id, watch.running))
+    except (Exception, asyncio.CancelledError) as e:
+        logger.warning(f"Could not cancel prompt {watch.prompt_id} on {client.server_address}: {e!r}")
+        return
+    record_cancellation(watch, reason, client.server_address)
+
+
+async def generate_by_prompt_async(prompt, save_previews=False, output_dir=None, workflow=None, input_path=None,
+                                   filename=None, live_previews=False):
+    """Async counterpart of generate_image_by_prompt(_and_image); yields the same progress strings and image list."""
+    ckpt_name = checkpoint_of(prompt)
+    stages = Stages(workflow, ckpt_name)
+    # acquire may probe several backends over HTTP, so keep it off the event loop
+    server_address = await asyncio.to_thread(backend_pool.acquire, ckpt_name)
+    try:
+        with stages.in_flight():
+            async for item in _run_prompt_async(prompt, server_address, ckpt_name, stages, save_previews,
+                                                output_dir, input_path, filename, live_previews):
+                yield item
+    except Exception as e:
+        logger.error(f"Error in generate_by_prompt_async: {e}")
+        stages.error(e)
+        if isinstance(e, (ConnectionError, aiohttp.ClientConnectionError, asyncio.TimeoutError)):
+            backend_pool.mark_failed(server_address, e)
+        yield f"Error: {str(e) or type(e).__name__}"
+        yield []
+    finally:
+        backend_pool.release(server_address)
+
+
+async def _coalesced_generation_async(request_key, seed, output_dir, make_generator):
+    """Async _coalesced_generation: coalesces with identical generations from either path and uses the result cache."""
+    coalesce_key, cache_key = _generation_keys(request_key, seed)
+
+    def run():
+        return _cached_generation_async(cache_key, output_dir, make_generator)
+
+    generation = run() if coalesce_key is None else single_flight.run_async(coalesce_key, run)
+    async for item in generation:
+        yield item
+
+
+async def _cached_generation_async(cache_key, output_dir, make_generator):
+    if cache_key is not None:
+        images = await asyncio.to_thread(result_cache.get, cache_key, output_dir)
+        if images is not None:
+            yield f"Cache hit: reusing stored result {cache_key[:12]}"
+            yield images
+            return
+
+    images = []
+    async for item in make_generator():
+        if isinstance(item, list):
+            images = item
+        else:
+            yield item
+
+    if cache_key is not None and images:
+        await asyncio.to_thread(result_cache.put, cache_key, images)
+    logger.info(f"Generated {len(images)} images")
+    yield images
+
+
+async def generate_image_async(workflow, save_previews=False, output_dir=None, live_previews=False, **params):
+    """Async generate_image: takes the same keyword parameters and yields the same items."""
+    template, prompt, request_key = _bind_text_to_image(workflow, **params)
+    async for item in _coalesced_generation_async(
+            request_key, params.get('seed', -1), output_dir,
+            lambda: generate_by_prompt_async(prompt, save_previews, output_dir, workflow=template.name,
+                                             live_previews=live_previews)):
+        yield item
+
+
+async def generate_image_to_image_async(workflow, input_path, save_previews=False, output_dir=None,
+                                        live_previews=False, **params):
+    """Async generate_image_to_image: takes the same keyword parameters and yields the same items."""
+    template, prompt, request_key = _bind_image_to_image(workflow, input_path, **params)
+    filename = os.path.basename(input_path)
+    async for item in _coalesced_generation_async(
+            request_key, params.get('seed', -1), output_dir,
+            lambda: generate_by_prompt_async(prompt, save_previews, output_dir, workflow=template.name,
+                                             input_path=input_path, filename=filename, live_previews=live_previews)):
+        yield item
@@ -0,0 +1,167 @@
+import logging
+import threading
+import time
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+
+def parse_backend_urls(value):
+    """Split a COMFYUI_URL setting into a list of backend base URLs (comma or whitespace separated)."""
+    return [url.strip().rstrip('/') for url in value.replace(',', ' ').split() if url.strip()]
+
+
+class Backend:
+    def __init__(self, url):
+        self.url = url
+        self.healthy = True
+        self.queue_depth = 0
+        self.vram_free = 0
+        self.assigned = 0
+        self.in_flight = 0
+        self.checked_at = 0
+        self.retry_at = 0
+        self.last_error = None
+        self.checkpoint = None
+        self.lock = threading.Lock()
+        self.probe_lock = threading.Lock()
+
+    @property
+    def load(self):
+        # ComfyUI's queue as of the last refresh plus whatever we sent it since
+        return self.queue_depth + self.assigned
+
+    def to_dict(self):
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'queue_depth': self.queue_depth,
+            'vram_free': self.vram_free,
+            'in_flight': self.in_flight,
+            'checkpoint': self.checkpoint,
+            'checked_at': self.checked_at,
+            'last_error': self.last_error,
+        }
+
+
+class BackendPool:
+    """Routes each generation to the least-loaded healthy ComfyUI backend.
+
+    Load comes from ComfyUI's ``/queue`` and ``/system_stats`` endpoints, cached for
+    ``BACKEND_STATS_TTL`` seconds. A backend that fails a probe or a job is skipped for
+    ``BACKEND_RETRY_AFTER`` seconds. Callers hold on to the URL returned by ``acquire``
+    for every leg of one job so upload, queue, progress and fetch hit the same box.
+    """
+
+    def __init__(self):
+        self._backends = {}
+        self._lock = threading.Lock()
+
+    def backends(self):
+        urls = parse_backend_urls(current_app.config['COMFYUI_URL'])
+        with self._lock:
+            for url in urls:
+                if url not in self._backends:
+                    self._backends[url] = Backend(url)
+            return [self._backends[url] for url in urls]
+
+    def acquire(self, ckpt_name=None):
+        """Pick a backend for a new job and count it as in flight; pair with ``release``.
+
+        A backend whose last dispatched job used ``ckpt_name`` is preferred as long as its
+        load is within ``BACKEND_AFFINITY_SLACK`` jobs of the least-loaded backend.
+        """
+        backends = self.backends()
+        if len(backends) == 1:
+            backend = backends[0]
+        else:
+            now = time.time()
+            for candidate in backends:
+                self._refresh(candidate, now)
+            candidates = [b for b in backends if b.healthy] or sorted(backends, key=lambda b: b.retry_at)[:1]
+            backend = min(candidates, key=lambda b: (b.load, -b.vram_free))
+            if ckpt_name is not None and backend.checkpoint != ckpt_name:
+                slack = current_app.config['BACKEND_AFFINITY_SLACK']
+                warm = [b for b in candidates if b.checkpoint == ckpt_name and b.load <= backend.load + slack]
+                if warm:
+                    backend = min(warm, key=lambda b: b.load)
+        with backend.lock:
+            backend.assigned += 1
+            backend.in_flight += 1
+        logger.debug(f"Routing job to backend {backend.url} (load={backend.load})")
+        return backend.url
+
+    def release(self, url):
+        with self._lock:
+            backend = self._backends.get(url)
+        if backend is None:
+            return
+        with backend.lock:
+            backend.in_flight = max(backend.in_flight - 1, 0)
+
+    def checkpoint(self, url):
+        """Return the checkpoint of the last job dispatched to ``url``."""
+        with self._lock:
+            backend = self._backends.get(url)
+        return backend.checkpoint if backend is not None else None
+
+    def note_checkpoint(self, url, ckpt_name):
+        """Record that a job using ``ckpt_name`` was dispatched to ``url``; swaps are counted by the scheduler."""
+        with self._lock:
+            backend = self._backends.get(url)
+        if backend is None or ckpt_name is None:
+            return
+        with backend.lock:
+            backend.checkpoint = ckpt_name
+
+    def mark_failed(self, url, error=None):
+        with self._lock:
+            backend = self._backends.get(url)
+        if backend is None:
+            return
+        retry_after = current_app.config['BACKEND_RETRY_AFTER']
+        with backend.lock:
+            backend.healthy = False
+            backend.last_error = str(error) if error else backend.last_error
+            backend.retry_at = time.time() + retry_after
+        logger.warning(f"Backend {url} marked unhealthy for {retry_after}s: {error}")
+
+    def _refresh(self, backend, now):
+        if not backend.healthy and now < backend.retry_at:
+            return
+        if backend.healthy and now - backend.checked_at < current_app.config['BACKEND_STATS_TTL']:
+            return
+        if not backend.probe_lock.acquire(blocking=False):
+            # Another thread is already probing this backend; use the cached numbers
+            return
+        try:
+            from app.utils import get_probe_session
+            session = get_probe_session()
+            response = session.get(f"{backend.url}/queue")
+            response.raise_for_status()
+            queue_state = response.json()
+            response = session.get(f"{backend.url}/system_stats")
+            response.raise_for_status()
+            devices = response.json().get('devices') or [{}]
+
+            with backend.lock:
+                backend.queue_depth = (len(queue_state.get('queue_running', [])) +
+                                       len(queue_state.get('queue_pending', [])))
+                backend.vram_free = devices[0].get('vram_free', 0)
+                backend.assigned = 0
+                backend.healthy = True
+                backend.last_error = None
+        except Exception as e:
+            backend.healthy = False
+            backend.last_error = str(e)
+            backend.retry_at = now + current_app.config['BACKEND_RETRY_AFTER']
+            logger.warning(f"Backend {backend.url} failed health check: {e}")
+        finally:
+            backend.checked_at = now
+            backend.probe_lock.release()
+
+    def status(self):
+        return [backend.to_dict() for backend in self.backends()]
+
+
+backend_pool = BackendPool()
@@ -0,0 +1,158 @@
+import itertools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import zipfile
+from werkzeug.datastructures import MultiDict
+from wtforms import Form
+from app.forms import ImageGenerationForm
+
+logger = logging.getLogger(__name__)
+
+# generate_image keyword arguments a batch item may set
+PARAMS = ('positive_prompt', 'negative_prompt', 'seed', 'steps', 'cfg', 'sampler_name', 'scheduler', 'denoise',
+          'ckpt_name', 'width', 'height', 'batch_size')
+
+
+# Nodes generate_image binds into; an image-to-image workflow (with a LoadImage node) cannot run as a batch item
+_TEXT_TO_IMAGE_ROLES = ('KSampler', 'CheckpointLoaderSimple', 'EmptyLatentImage')
+
+# The generation page's fields, limits and choices, without its CSRF check
+_ItemForm = type('BatchItemForm', (Form,), {name: getattr(ImageGenerationForm, name) for name in PARAMS})
+
+
+class BatchError(ValueError):
+    pass
+
+
+def _check_item(item, index):
+    if not isinstance(item, dict):
+        raise BatchError(f"Item {index} is not an object")
+    unknown = set(item) - set(PARAMS)
+    if unknown:
+        raise BatchError(f"Item {index} has unknown parameters: {sorted(unknown)}")
+    if not item.get('positive_prompt'):
+        raise BatchError(f"Item {index} has no positive_prompt")
+    if item.get('ckpt_name') == '':
+        raise BatchError(f"Item {index} has no ckpt_name")
+    # Parameters an item leaves out keep generate_image's defaults; the ones it sets get the form's checks
+    form = _ItemForm(formdata=MultiDict({name: '' if value is None else str(value) for name, value in item.items()}))
+    checked = {}
+    for name in item:
+        field = form[name]
+        if not field.validate(form):
+            raise BatchError(f"Item {index} has an invalid {name}: {field.errors[0]}")
+        checked[name] = int(field.data or -1) if name == 'seed' else field.data
+    return checked
+
+
+def expand_sweep(sweep):
+    """Expand ``{"base": {...}, "axes": {"cfg": [5, 7], ...}}`` into the cross product of its axes."""
+    if not isinstance(sweep, dict):
+        raise BatchError("Sweep must be an object")
+    base = sweep.get('base') or {}
+    axes = sweep.get('axes') or {}
+    if not isinstance(base, dict) or not isinstance(axes, dict):
+        raise BatchError("Sweep 'base' and 'axes' must be objects")
+    for name, values in axes.items():
+        if not isinstance(values, list) or not values:
+            raise BatchError(f"Sweep axis {name} must be a non-empty list")
+    names = list(axes)
+    return [dict(base, **dict(zip(names, values))) for values in itertools.product(*(axes[n] for n in names))]
+
+
+def parse_jsonl(stream):
+    items = []
+    for line_number, line in enumerate(stream, 1):
+        line = line.decode('utf-8').strip() if isinstance(line, bytes) else line.strip()
+        if not line:
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError as e:
+            raise BatchError(f"Line {line_number} is not valid JSON: {e}")
+    return items
+
+
+def expand_batch(spec, max_items):
+    """Turn a batch request (``jobs`` list and/or ``sweep`` spec) into a validated list of items."""
+    if not isinstance(spec, dict):
+        raise BatchError("Batch must be a JSON object")
+    if not isinstance(spec.get('workflow') or '', str):
+        raise BatchError("Batch workflow must be a file name")
+    if not isinstance(spec.get('jobs') or [], list):
+        raise BatchError("Batch jobs must be a list")
+    items = list(spec.get('jobs') or [])
+    if spec.get('sweep'):
+        items += expand_sweep(spec['sweep'])
+    if not items:
+        raise BatchError("Batch has no jobs")
+    if len(items) > max_items:
+        raise BatchError(f"Batch has {len(items)} jobs; the limit is {max_items}")
+    return [_check_item(item, index) for index, item in enumerate(items)]
+
+
+def check_workflow(template):
+    """Raise BatchError unless ``template`` is a text-to-image workflow generate_image can bind."""
+    missing = [role for role in _TEXT_TO_IMAGE_ROLES if role not in template.roles]
+    if missing or 'LoadImage' in template.roles:
+        raise BatchError(f"Workflow {template.name} is not a text-to-image workflow")
+
+
+class BatchManifest:
+    """Per-item status of a batch, rewritten to ``path`` as items finish."""
+
+    def __init__(self, path, batch_id, workflow, items):
+        self.path = path
+        self.data = {
+            'batch_id': batch_id,
+            'workflow': workflow,
+            'created_at': time.time(),
+            'finished_at': None,
+            'items': [{'index': index, 'params': params, 'status': 'queued', 'filenames': [], 'error': None}
+                      for index, params in enumerate(items)],
+        }
+        self._lock = threading.Lock()
+        self.save()
+
+    def update(self, index, **fields):
+        with self._lock:
+            self.data['items'][index].update(fields)
+            self.save()
+
+    def finish(self):
+        with self._lock:
+            self.data['finished_at'] = time.time()
+            self.save()
+
+    def save(self):
+        tmp_path = f"{self.path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+
+
+def build_archive(manifest, resolve):
+    """Write a zip of a batch's outputs plus manifest.json to a temporary file and return it, rewound.
+
+    ``resolve`` maps an output filename to its path, or None if it is gone (OutputStore.resolve).
+    """
+    archive = tempfile.TemporaryFile()
+    # PNGs are already compressed; storing them avoids burning CPU for nothing
+    with zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_STORED) as zf:
+        zf.writestr('manifest.json', json.dumps(manifest, indent=2))
+        for item in manifest['items']:
+            for filename in item['filenames']:
+                path = resolve(filename)
+                if path is not None:
+                    zf.write(path, arcname=filename)
+    archive.seek(0)
+    return archive
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+def hash_file(path, chunk_size=64 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Content-addressed store of generated outputs keyed by the fully bound prompt graph.
+
+    Only deterministic generations (an explicit seed) are cached. Each entry is a
+    directory holding the output files and a ``meta.json``; the meta file's mtime is
+    refreshed on every hit and entries are evicted least recently used first once the
+    cache grows past ``RESULT_CACHE_MAX_BYTES``.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.cache_dir = None
+        self.max_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['RESULT_CACHE_ENABLED']
+        self.cache_dir = app.config['RESULT_CACHE_DIR']
+        self.max_bytes = app.config['RESULT_CACHE_MAX_BYTES']
+        if self.enabled:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        app.extensions['result_cache'] = self
+
+    @staticmethod
+    def key(prompt, input_path=None):
+        digest = hashlib.sha256(json.dumps(prompt, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+        if input_path is not None:
+            digest.update(hash_file(input_path).encode('ascii'))
+        return digest.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key, output_dir=None):
+        """Return cached image entries for ``key`` shaped like get_images_from_history, or None.
+
+        With ``output_dir`` set each file is copied there and returned as a ``path``.
+        """
+        if not self.enabled:
+            return None
+        entry_dir = self._entry_dir(key)
+        meta_path = os.path.join(entry_dir, 'meta.json')
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            os.utime(meta_path)
+            images = []
+            for index, image in enumerate(meta['images']):
+                cached_path = os.path.join(entry_dir, f"{index}.png")
+                entry = {'image_data': None, 'file_name': image['file_name'], 'type': image['type'],
+                         'seed': image.get('seed')}
+                if output_dir is not None:
+                    os.makedirs(output_dir, exist_ok=True)
+                    dest_path = os.path.join(output_dir, f".{uuid.uuid4().hex}_{index}.png")
+                    shutil.copyfile(cached_path, dest_path)
+                    entry['path'] = dest_path
+                else:
+                    with open(cached_path, 'rb') as f:
+                        entry['image_data'] = f.read()
+                images.append(entry)
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        logger.info(f"Result cache hit: {key}")
+        return images
+
+    def put(self, key, images):
+        """Store the successfully fetched entries of ``images`` under ``key``."""
+        if not self.enabled:
+            return
+        images = [image for image in images if 'error' not in image]
+        if not images:
+            return
+        entry_dir = self._entry_dir(key)
+        if os.path.exists(entry_dir):
+            return
+
+        tmp_dir = f"{entry_dir}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.makedirs(tmp_dir)
+            size = 0
+            for index, image in enumerate(images):
+                cached_path = os.path.join(tmp_dir, f"{index}.png")
+                if 'path' in image:
+                    shutil.copyfile(image['path'], cached_path)
+                else:
+                    with open(cached_path, 'wb') as f:
+                        f.write(image['image_data'])
+                size += os.path.getsize(cached_path)
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+                json.dump({'size': size, 'images': [{'file_name': image['file_name'], 'type': image['type'],
+                                                     'seed': image.get('seed')} for image in images]}, f)
+            os.rename(tmp_dir, entry_dir)
+            logger.info(f"Result cached: {key} ({size} bytes)")
+        except OSError as e:
+            # Another worker may have stored the same key first
+            logger.debug(f"Could not store result {key}: {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        for shard in os.listdir(self.cache_dir):
+            shard_dir = os.path.join(self.cache_dir, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for key in os.listdir(shard_dir):
+                meta_path = os.path.join(shard_dir, key, 'meta.json')
+                try:
+                    with open(meta_path, 'r') as f:
+                        size = json.load(f)['size']
+                    entries.append((os.path.getmtime(meta_path), size, os.path.join(shard_dir, key)))
+                except (OSError, ValueError, KeyError):
+                    continue
+        return entries
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in ``max_bytes``."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, entry_dir in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            evicted += 1
+        if evicted:
+            logger.info(f"Evicted {evicted} result cache entries; {total} bytes remain")
+        return evicted
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            'enabled': self.enabled,
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / lookups if lookups else 0.0,
+            'max_bytes': self.max_bytes,
+        }
+
+
+result_cache = ResultCache()
@@ -0,0 +1,152 @@
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('imagine_cancel_scope', default=None)
+
+# Longest a blocked wait goes without checking for cancellation
+POLL_SECONDS = 1.0
+
+_STEP = re.compile(r'^Progress: Step (\d+) of (\d+)$')
+
+# Per process: {checkpoint: moving average of execution seconds}, used to value cancelled queued prompts
+_execution_seconds = {}
+_execution_lock = threading.Lock()
+
+
+class Cancelled(Exception):
+    """The generation was cancelled; ``reason`` is ``cancelled``, ``deadline`` or ``abandoned``."""
+
+    def __init__(self, reason, message=None):
+        super().__init__(message or f"Generation {reason}")
+        self.reason = reason
+
+
+def current():
+    """Return the CancelScope of the generation running in this context, or None."""
+    return _current.get()
+
+
+def check():
+    """Raise Cancelled if the generation running in this context has been cancelled or is past its deadline."""
+    scope = _current.get()
+    if scope is not None:
+        scope.check()
+
+
+class CancelScope:
+    """Cancellation state and deadline of one generation (or one batch), checked while it waits.
+
+    ``deadline`` is in seconds from now. ``marker_path`` names a file whose appearance cancels
+    the scope, so a cancel request handled by another gunicorn worker reaches the one running
+    the job. A scope with a ``parent`` is also cancelled when the parent is.
+    """
+
+    def __init__(self, deadline=None, marker_path=None, parent=None):
+        self.deadline = time.monotonic() + deadline if deadline else None
+        self.marker_path = marker_path
+        self.parent = parent
+        self.reason = None
+        self.gpu_seconds_saved = 0.0
+        self._marker_checked = 0.0
+
+    def cancel(self, reason='cancelled'):
+        if self.reason is None:
+            self.reason = reason
+
+    @property
+    def cancelled(self):
+        if self.reason is None:
+            if self.parent is not None and self.parent.cancelled:
+                self.reason = self.parent.reason
+            elif self.deadline is not None and time.monotonic() >= self.deadline:
+                self.reason = 'deadline'
+            elif self.marker_path is not None and time.monotonic() - self._marker_checked >= POLL_SECONDS:
+                self._marker_checked = time.monotonic()
+                if os.path.exists(self.marker_path):
+                    self.reason = 'cancelled'
+        return self.reason is not None
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled(self.reason, 'Deadline exceeded' if self.reason == 'deadline' else None)
+
+    def poll_timeout(self):
+        """How long a wait may block before it should check this scope again."""
+        if self.deadline is None:
+            return POLL_SECONDS
+        return max(min(POLL_SECONDS, self.deadline - time.monotonic()), 0.01)
+
+    def record_saved(self, seconds):
+        self.gpu_seconds_saved += seconds
+        if self.parent is not None:
+            self.parent.record_saved(seconds)
+
+    @contextmanager
+    def activate(self):
+        previous = _current.get()
+        _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.set(previous)
+
+
+def record_execution(ckpt_name, seconds):
+    with _execution_lock:
+        previous = _execution_seconds.get(ckpt_name)
+        _execution_seconds[ckpt_name] = seconds if previous is None else 0.8 * previous + 0.2 * seconds
+
+
+class PromptWatch:
+    """What one queued ComfyUI prompt has done so far, to value the GPU time a cancel saves."""
+
+    def __init__(self, prompt_id, ckpt_name):
+        self.prompt_id = prompt_id
+        self.ckpt_name = ckpt_name
+        self.started_at = None
+        self.fraction = None
+
+    def start(self):
+        self.started_at = time.perf_counter()
+
+    def progress(self, message):
+        match = _STEP.match(message)
+        if match and int(match.group(2)):
+            self.fraction = int(match.group(1)) / int(match.group(2))
+
+    @property
+    def running(self):
+        return self.started_at is not None
+
+    def remaining_seconds(self):
+        """Estimate the GPU seconds the prompt still needs: the rest of its sampler steps if it has
+        reported any, otherwise the recent average run time for its checkpoint."""
+        expected = _execution_seconds.get(self.ckpt_name)
+        if not self.running:
+            return expected or 0.0
+        elapsed = time.perf_counter() - self.started_at
+        if self.fraction:
+            return elapsed * (1 - self.fraction) / self.fraction
+        return max(expected - elapsed, 0.0) if expected else 0.0
+
+
+def record_cancellation(watch, reason, server_address):
+    """Count a prompt taken off a backend and the GPU seconds that saved, in metrics and the active scope."""
+    saved = watch.remaining_seconds()
+    stage = 'running' if watch.running else 'queued'
+    metrics.CANCELLATIONS.labels(reason, stage).inc()
+    metrics.GPU_SECONDS_SAVED.labels(reason).inc(saved)
+    scope = _current.get()
+    if scope is not None:
+        scope.record_saved(saved)
+    logger.info(f"Cancelled {stage} prompt {watch.prompt_id} on {server_address} ({reason}); "
+                f"saved about {saved:.1f} GPU seconds")
+    return saved
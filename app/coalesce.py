@@ -0,0 +1,296 @@
+import asyncio
+import contextvars
+import logging
+import os
+import queue
+import shutil
+import threading
+import uuid
+from app import cancellation
+from app.cancellation import CancelScope, Cancelled
+from app.previews import Preview
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    def __init__(self):
+        self.messages = []
+        # One queue per request still waiting on this generation, the one that started it first
+        self.members = []
+        self.finished = False
+        # Cancelled only when every member has gone, so one client leaving never stops it for the rest
+        self.scope = CancelScope()
+        # The event-loop task generating it, when started by run_async
+        self.task = None
+        # Set once the generation has stopped, so the GPU time its cancellation saved is known
+        self.done = threading.Event()
+
+
+def _copy_images(images):
+    """Give a follower its own copies of streamed output files; the leader's files get renamed away."""
+    copies = []
+    for image in images:
+        image = dict(image)
+        if image.get('path'):
+            directory, name = os.path.split(image['path'])
+            copy_path = os.path.join(directory, f".{uuid.uuid4().hex}_{name.lstrip('.')}")
+            shutil.copyfile(image['path'], copy_path)
+            image['path'] = copy_path
+        copies.append(image)
+    return copies
+
+
+def _discard(images):
+    """Delete the streamed output files of a result nobody is going to collect."""
+    for image in images:
+        if image.get('path'):
+            try:
+                os.remove(image['path'])
+            except FileNotFoundError:
+                pass
+
+
+class _Member(queue.Queue):
+    """The queue a request reading on a thread gets a flight's messages and result through."""
+
+    def close(self):
+        # A result handed over after this request stopped reading is never saved
+        while True:
+            try:
+                item = self.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, list):
+                _discard(item)
+
+
+class _AsyncMember:
+    """The queue a coroutine gets a flight's messages through; items may be put from any thread."""
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.closed = False
+
+    def put(self, item):
+        self.loop.call_soon_threadsafe(self._put, item)
+
+    def _put(self, item):
+        if not self.closed:
+            self.queue.put_nowait(item)
+        elif isinstance(item, list):
+            _discard(item)
+
+    def close(self):
+        self.closed = True
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if isinstance(item, list):
+                _discard(item)
+
+
+class SingleFlight:
+    """Folds identical concurrent generations in this process into one ComfyUI job.
+
+    The first caller for a key (the leader) starts the generation, on a background thread
+    from ``run`` or as a task on the event loop from ``run_async``; callers that arrive while
+    it is in flight (followers), from either, get its progress messages replayed and
+    forwarded, then their own copy of its result. Each caller waits under its own
+    CancelScope, and the generation is only cancelled once every caller has gone; the GPU
+    seconds that saved are credited to the scope of the caller whose leaving cancelled it.
+    """
+
+    # Longest the last caller to leave waits for the cancelled generation to report what it saved
+    wind_down_timeout = 5.0
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def run(self, key, make_generator):
+        member = _Member()
+        flight, leader, sharing = self._join(key, member)
+        if leader:
+            # The copied context carries the app context and the leader's trace to the thread
+            context = contextvars.copy_context()
+            threading.Thread(target=context.run, args=(self._drive, key, flight, make_generator),
+                             name='single-flight', daemon=True).start()
+        reason = 'abandoned'
+        scope = cancellation.current()
+        try:
+            if not leader:
+                logger.info(f"Coalesced request into in-flight generation {key[:12]} ({sharing} requests)")
+                yield f"Joined in-flight generation shared by {sharing} requests"
+            yield from self._follow(member, scope)
+        except Cancelled as e:
+            reason = e.reason
+            raise
+        finally:
+            if self._leave(key, flight, member, reason) and scope is not None:
+                self._credit(flight, scope)
+
+    async def run_async(self, key, make_generator):
+        """Like ``run`` for an async generator factory, waited on without blocking the event loop."""
+        member = _AsyncMember()
+        flight, leader, sharing = self._join(key, member)
+        if leader:
+            # The task runs in a copy of this context, so it keeps the app context and the leader's trace
+            flight.task = asyncio.get_running_loop().create_task(self._drive_async(key, flight, make_generator),
+                                                                 name='single-flight')
+        reason = 'abandoned'
+        scope = cancellation.current()
+        try:
+            if not leader:
+                logger.info(f"Coalesced request into in-flight generation {key[:12]} ({sharing} requests)")
+                yield f"Joined in-flight generation shared by {sharing} requests"
+            while True:
+                if scope is not None:
+                    scope.check()
+                    try:
+                        item = await asyncio.wait_for(member.queue.get(), scope.poll_timeout())
+                    except asyncio.TimeoutError:
+                        continue
+                else:
+                    item = await member.queue.get()
+                yield item
+                if isinstance(item, list):
+                    return
+        except Cancelled as e:
+            reason = e.reason
+            raise
+        finally:
+            if self._leave(key, flight, member, reason) and scope is not None:
+                # Waiting here must not stall the loop the generation itself may be running on
+                await asyncio.shield(asyncio.to_thread(self._credit, flight, scope))
+
+    def _join(self, key, member):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+            else:
+                for message in flight.messages:
+                    member.put(message)
+                self.coalesced += 1
+            flight.members.append(member)
+            return flight, leader, len(flight.members)
+
+    def _follow(self, member, scope):
+        while True:
+            if scope is not None:
+                scope.check()
+                try:
+                    item = member.get(timeout=scope.poll_timeout())
+                except queue.Empty:
+                    continue
+            else:
+                item = member.get()
+            yield item
+            if isinstance(item, list):
+                return
+
+    def _leave(self, key, flight, member, reason):
+        """Remove ``member`` from the flight; returns whether it was the last and so cancelled the generation."""
+        with self._lock:
+            flight.members.remove(member)
+            abandoned = not flight.members and not flight.finished
+            if abandoned:
+                self._release(key, flight)
+        if abandoned:
+            logger.info(f"Every request for generation {key[:12]} has gone; cancelling it")
+            flight.scope.cancel(reason)
+        member.close()
+        return abandoned
+
+    def _credit(self, flight, scope):
+        # The saving is recorded on the flight's scope by whatever took the prompt off the backend
+        if flight.done.wait(self.wind_down_timeout):
+            scope.record_saved(flight.scope.gpu_seconds_saved)
+
+    def _drive(self, key, flight, make_generator):
+        finished = False
+        try:
+            with flight.scope.activate():
+                for item in make_generator():
+                    if isinstance(item, list):
+                        self._finish(key, flight, item)
+                        finished = True
+                    else:
+                        self._publish(flight, item)
+        except Exception as e:
+            logger.exception(f"Shared generation {key[:12]} failed")
+            error = f"Error: {e}"
+        else:
+            error = "Error: The shared generation ended without a result"
+        self._end(key, flight, finished, error)
+
+    async def _drive_async(self, key, flight, make_generator):
+        finished = False
+        try:
+            with flight.scope.activate():
+                async for item in make_generator():
+                    if isinstance(item, list):
+                        await asyncio.to_thread(self._finish, key, flight, item)
+                        finished = True
+                    else:
+                        self._publish(flight, item)
+        except asyncio.CancelledError:
+            # The event loop is shutting down; the members still waiting must not hang
+            self._end(key, flight, finished, "Error: The shared generation was stopped")
+            raise
+        except Exception as e:
+            logger.exception(f"Shared generation {key[:12]} failed")
+            error = f"Error: {e}"
+        else:
+            error = "Error: The shared generation ended without a result"
+        self._end(key, flight, finished, error)
+
+    def _publish(self, flight, item):
+        with self._lock:
+            # Replaying stale previews to a late joiner is no use, and they are large
+            if not isinstance(item, Preview):
+                flight.messages.append(item)
+            for member in flight.members:
+                member.put(item)
+
+    def _end(self, key, flight, finished, error):
+        if not finished:
+            with self._lock:
+                self._release(key, flight)
+                flight.finished = True
+                for member in flight.members:
+                    member.put(error)
+                    member.put([])
+        flight.done.set()
+
+    def _finish(self, key, flight, images):
+        with self._lock:
+            self._release(key, flight)
+            flight.finished = True
+            members = list(flight.members)
+        # The first member takes the generated files themselves, the rest get copies
+        results = [images] + [_copy_images(images) for _ in members[1:]]
+        with self._lock:
+            # Members that left while the copies were made never read their queue again
+            for member, result in zip(members, results):
+                if member in flight.members:
+                    member.put(result)
+                else:
+                    _discard(result)
+        if not members:
+            _discard(images)
+
+    def _release(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self):
+        with self._lock:
+            return {'coalesced': self.coalesced, 'in_flight': len(self._flights)}
+
+
+single_flight = SingleFlight()
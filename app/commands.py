@@ -0,0 +1,30 @@
+import json
+import click
+from app.models import gallery_index
+from app.retention import retention
+from app.thumbnails import thumbnails
+
+
+def register_commands(app):
+    @app.cli.command('reconcile-gallery')
+    def reconcile_gallery():
+        """Sync the gallery index with the files in static/generated."""
+        added, removed = gallery_index.reconcile()
+        click.echo(f"Gallery index reconciled: {added} added, {removed} removed")
+
+    @app.cli.command('backfill-thumbnails')
+    @click.option('--force', is_flag=True, help='Recreate thumbnails that already exist.')
+    def backfill_thumbnails(force):
+        """Create missing gallery thumbnails for the files in static/generated."""
+        created, failed, elapsed = thumbnails.backfill(force=force)
+        rate = created / elapsed if elapsed else 0
+        click.echo(f"Thumbnails: {created} created, {failed} failed in {elapsed:.1f}s ({rate:.1f} images/s)")
+
+    @app.cli.command('retention')
+    @click.option('--delete', is_flag=True, help='Delete the files instead of only reporting them.')
+    def run_retention(delete):
+        """Apply the retention policy once; by default only report what would be deleted."""
+        report = retention.run(dry_run=not delete)
+        if report is None:
+            raise click.ClickException('A retention cycle is already running in another process')
+        click.echo(json.dumps(report, indent=2))
@@ -34,11 +34,17 @@ CHECKPOINTS = [
 ]
 
 
+def validate_seed(form, field):
+    if field.data != '-1' and not field.data.isdigit():
+        raise ValidationError('Seed must be -1 or a positive integer')
+
+
 class ImageGenerationForm(FlaskForm):
     positive_prompt = TextAreaField('Positive Prompt', validators=[DataRequired()])
     negative_prompt = TextAreaField('Negative Prompt')
 
     # Node #3 parameters
+    seed = StringField('Seed', validators=[Optional(), validate_seed], default='-1')
     steps = IntegerField('Steps', validators=[NumberRange(min=1, max=150)], default=20)
     cfg = FloatField('CFG Scale', validators=[NumberRange(min=1, max=30)], default=8)
     sampler_name = SelectField('Sampler', choices=[
@@ -92,11 +98,6 @@ class ImageGenerationForm(FlaskForm):
     submit = SubmitField('Generate Image')
 
 
-def validate_seed(form, field):
-    if field.data != '-1' and not field.data.isdigit():
-        raise ValidationError('Seed must be -1 or a positive integer')
-
-
 class ImageToImageForm(FlaskForm):
     input_image = FileField('Input Image', validators=[
         FileRequired(),
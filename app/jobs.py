@@ -0,0 +1,242 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from app.cancellation import CancelScope
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class Job:
+    def __init__(self, kind, job_id=None, trace=None, scope=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.kind = kind
+        self.trace = trace
+        self.scope = scope or CancelScope()
+        self.status = QUEUED
+        self.progress = None
+        self.filenames = []
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'filenames': self.filenames,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'trace': self.trace.to_dict() if self.trace is not None else None,
+            'gpu_seconds_saved': round(self.scope.gpu_seconds_saved, 3),
+        }
+
+
+class JobManager:
+    """Runs generation pipelines on a background executor and tracks their state.
+
+    Job state is written to one JSON file per job under ``JOBS_DIR`` so that any
+    gunicorn worker can answer ``GET /jobs/<id>``, not only the one running it. A cancel
+    request leaves a ``<id>.cancel`` marker next to it for the worker running the job.
+    Progress messages are written at most every ``JOB_PROGRESS_INTERVAL`` seconds, status
+    changes always; files untouched for ``JOB_TTL`` seconds are pruned as new jobs come in.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.jobs_dir = None
+        self.max_workers = 4
+        self.ttl = 86400
+        self.progress_interval = 1.0
+        self._pruned_at = 0
+        self._executor = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.jobs_dir = app.config['JOBS_DIR']
+        self.max_workers = app.config['JOB_WORKERS']
+        self.ttl = app.config['JOB_TTL']
+        self.progress_interval = app.config['JOB_PROGRESS_INTERVAL']
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        app.extensions['job_manager'] = self
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job')
+            return self._executor
+
+    def submit(self, kind, pipeline, job_id=None, trace=None, scope=None, on_finish=None):
+        """Queue ``pipeline(on_progress)`` and return its Job.
+
+        The pipeline runs inside an application context and must return the list
+        of saved output filenames, raising on failure. A ``trace`` the pipeline fills
+        in is reported with the job's status. The pipeline runs with ``scope`` (a new
+        CancelScope by default) active; cancel() cancels it. ``on_finish()`` is called
+        when the job ends, even if it was cancelled before the pipeline started.
+        """
+        job = Job(kind, job_id, trace, scope)
+        job.scope.marker_path = self._cancel_path(job.id)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._save(job)
+        app = self.app
+        self._get_executor().submit(self._run, app, job, pipeline, on_finish)
+        logger.info(f"Job {job.id} ({kind}) queued")
+        self._maybe_prune()
+        return job
+
+    def _run(self, app, job, pipeline, on_finish=None):
+        saved_at = [0.0]
+
+        def on_progress(message):
+            job.progress = message
+            # Samplers report every step; the final state is written when the job ends anyway
+            now = time.monotonic()
+            if now - saved_at[0] >= self.progress_interval:
+                saved_at[0] = now
+                self._save(job)
+
+        with app.app_context(), job.scope.activate():
+            try:
+                if job.scope.cancelled:
+                    job.status = CANCELLED
+                    logger.info(f"Job {job.id} cancelled before it started")
+                    return
+                job.status = RUNNING
+                job.started_at = time.time()
+                self._save(job)
+                job.filenames = pipeline(on_progress)
+                job.status = COMPLETED
+                logger.info(f"Job {job.id} completed: {job.filenames}")
+            except Exception as e:
+                job.error = str(e)
+                if job.scope.cancelled:
+                    job.status = CANCELLED
+                    logger.info(f"Job {job.id} cancelled ({job.scope.reason})")
+                else:
+                    logger.exception(f"Job {job.id} failed")
+                    job.status = FAILED
+            finally:
+                job.finished_at = time.time()
+                self._save(job)
+                with self._lock:
+                    self._jobs.pop(job.id, None)
+                try:
+                    os.remove(self._cancel_path(job.id))
+                except FileNotFoundError:
+                    pass
+                if on_finish is not None:
+                    try:
+                        on_finish()
+                    except Exception:
+                        logger.exception(f"Job {job.id} clean-up failed")
+
+    def cancel(self, job_id):
+        """Ask a queued or running job to stop and return its state, or None if it is unknown.
+
+        The job may be running in another worker, so besides cancelling it here if it is
+        ours, this leaves a marker file that the worker running it picks up within a second.
+        """
+        state = self.get(job_id)
+        if state is None or state['status'] not in (QUEUED, RUNNING):
+            return state
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            job.scope.cancel()
+        else:
+            with open(self._cancel_path(job_id), 'w'):
+                pass
+        logger.info(f"Job {job_id} cancellation requested")
+        return state
+
+    def get(self, job_id):
+        """Return the job's state as a dict, or None if it is unknown."""
+        if not job_id.isalnum():
+            return None
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        try:
+            with open(self._path(job_id), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _path(self, job_id):
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def _cancel_path(self, job_id):
+        return os.path.join(self.jobs_dir, f"{job_id}.cancel")
+
+    def _maybe_prune(self):
+        """Queue a prune() on the executor if the last one was over an hour (or ``JOB_TTL``) ago."""
+        if not self.ttl:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if self._pruned_at and now - self._pruned_at < min(self.ttl, 3600):
+                return
+            self._pruned_at = now
+        self._get_executor().submit(self.prune)
+
+    def prune(self, now=None):
+        """Delete job files under ``JOBS_DIR`` not written for ``JOB_TTL`` seconds; returns how many went.
+
+        Jobs this worker is still running are kept however long they have been quiet.
+        """
+        now = now or time.time()
+        with self._lock:
+            running = set(self._jobs)
+        removed = 0
+        try:
+            entries = list(os.scandir(self.jobs_dir))
+        except FileNotFoundError:
+            return 0
+        for entry in entries:
+            if entry.name.split('.', 1)[0] in running:
+                continue
+            try:
+                if now - entry.stat().st_mtime > self.ttl:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Failed to prune job file {entry.name}: {e}")
+        if removed:
+            logger.info(f"Pruned {removed} job files older than {self.ttl:.0f}s")
+        return removed
+
+    def _save(self, job):
+        path = self._path(job.id)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(job.to_dict(), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f"Failed to persist job {job.id}: {e}")
+
+
+job_manager = JobManager()
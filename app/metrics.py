@@ -0,0 +1,80 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from app import tracing
+
+logger = logging.getLogger(__name__)
+
+# Covers everything from a sub-millisecond disk write to a multi-minute SDXL render
+BUCKETS = (0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160, 320, float('inf'))
+
+STAGE_SECONDS = Histogram('imagine_stage_seconds', 'Time spent in each stage of a generation',
+                          ['stage', 'workflow', 'checkpoint'], buckets=BUCKETS)
+ERRORS = Counter('imagine_errors_total', 'Failed generations by exception type',
+                 ['type', 'workflow', 'checkpoint'])
+BYTES = Counter('imagine_bytes_total', 'Image bytes moved to and from ComfyUI', ['direction'])
+CANCELLATIONS = Counter('imagine_cancellations_total', 'Prompts removed from or interrupted on a backend',
+                        ['reason', 'stage'])
+GPU_SECONDS_SAVED = Counter('imagine_gpu_seconds_saved_total',
+                            'Estimated GPU seconds not spent on cancelled prompts', ['reason'])
+PREVIEW_FRAMES = Counter('imagine_preview_frames_total', 'Latent preview frames forwarded to or dropped for clients',
+                         ['outcome'])
+IN_FLIGHT = Gauge('imagine_jobs_in_flight', 'Generations currently talking to ComfyUI',
+                  ['workflow', 'checkpoint'], multiprocess_mode='livesum')
+
+
+class Stages:
+    """Records per-stage timings, errors and in-flight count for one generation.
+
+    Label children are resolved once per job, so each observation on the hot path is a
+    single histogram update. Timings are also added to the active request Trace, if any.
+    """
+
+    def __init__(self, workflow=None, checkpoint=None):
+        self.workflow = workflow or ''
+        self.checkpoint = checkpoint or ''
+        self.trace = tracing.current()
+        self._histograms = {}
+
+    def observe(self, stage, seconds):
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            histogram = self._histograms[stage] = STAGE_SECONDS.labels(stage, self.workflow, self.checkpoint)
+        histogram.observe(seconds)
+        if self.trace is not None:
+            self.trace.add(stage, seconds)
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    @contextmanager
+    def in_flight(self):
+        gauge = IN_FLIGHT.labels(self.workflow, self.checkpoint)
+        gauge.inc()
+        try:
+            yield
+        finally:
+            gauge.dec()
+
+    def error(self, exc):
+        ERRORS.labels(type(exc).__name__, self.workflow, self.checkpoint).inc()
+
+
+def count_bytes(direction, size):
+    BYTES.labels(direction).inc(size)
+
+
+def render():
+    """Return the exposition text for /metrics, merged across gunicorn workers when running multi-process."""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest()
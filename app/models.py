@@ -0,0 +1,237 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from app.storage import output_path, scan_outputs
+
+logger = logging.getLogger(__name__)
+
+TEXT_TO_IMAGE = 'text_to_image'
+IMAGE_TO_IMAGE = 'image_to_image'
+
+SORTS = {
+    'newest': 'created DESC',
+    'oldest': 'created ASC',
+    'largest': 'size DESC',
+    'smallest': 'size ASC',
+}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    filename TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL,
+    pinned INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS uploads (
+    filename TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+'''
+
+# Columns added after the first release, as (name, definition); older databases get them on startup
+MIGRATIONS = [
+    ('accessed', 'REAL'),
+    ('pinned', 'INTEGER NOT NULL DEFAULT 0'),
+]
+
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS images_kind_created ON images (kind, created);
+CREATE INDEX IF NOT EXISTS images_kind_size ON images (kind, size);
+CREATE INDEX IF NOT EXISTS images_pinned_accessed ON images (pinned, accessed);
+CREATE INDEX IF NOT EXISTS images_pinned_created ON images (pinned, created);
+CREATE INDEX IF NOT EXISTS uploads_accessed ON uploads (accessed);
+CREATE INDEX IF NOT EXISTS uploads_created ON uploads (created);
+'''
+
+# Eviction orders for candidates(): least recently used, or oldest first
+ORDERS = {
+    'lru': 'accessed',
+    'oldest': 'created',
+}
+
+
+def kind_for_filename(filename):
+    return IMAGE_TO_IMAGE if filename.startswith('generated_i2i_') else TEXT_TO_IMAGE
+
+
+class GalleryIndex:
+    """SQLite index of the images in the output store and the inputs in static/uploads.
+
+    /saves pages through it and app.retention picks eviction candidates from it, so
+    neither ever lists the directories. Rows are written when the app saves, serves or
+    deletes a file; ``reconcile`` brings the index back in line with files added or
+    removed out of band.
+    """
+
+    # Serving a file records the access at most this often, so downloads do not each write to SQLite
+    touch_interval = 300
+
+    def __init__(self, app=None):
+        self.db_path = None
+        self.generated_dir = None
+        self.uploads_dir = None
+        self._touched = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.db_path = app.config['GALLERY_DB']
+        self.generated_dir = os.path.join(app.root_path, 'static', 'generated')
+        self.uploads_dir = os.path.join(app.root_path, 'static', 'uploads')
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        created = not os.path.exists(self.db_path)
+        with closing(self._connect()) as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+            migrated = self._migrate(db)
+            db.executescript(INDEXES)
+        if (created or migrated) and os.path.isdir(self.generated_dir):
+            # First run against an existing deployment, or an upgrade: index what is already on disk
+            self.reconcile()
+        app.extensions['gallery_index'] = self
+
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=10)
+        db.row_factory = sqlite3.Row
+        return db
+
+    @staticmethod
+    def _migrate(db):
+        """Add missing columns to an older images table; returns True if anything changed."""
+        columns = {row['name'] for row in db.execute('PRAGMA table_info(images)')}
+        missing = [(name, definition) for name, definition in MIGRATIONS if name not in columns]
+        with db:
+            for name, definition in missing:
+                db.execute(f'ALTER TABLE images ADD COLUMN {name} {definition}')
+        return bool(missing)
+
+    def add(self, filename, size=None, created=None, kind=None):
+        if size is None:
+            size = os.path.getsize(output_path(self.generated_dir, filename))
+        created = created or time.time()
+        with closing(self._connect()) as db, db:
+            db.execute('INSERT OR REPLACE INTO images (filename, kind, size, created, accessed) '
+                       'VALUES (?, ?, ?, ?, ?)',
+                       (filename, kind or kind_for_filename(filename), size, created, created))
+
+    def remove(self, filename):
+        with closing(self._connect()) as db, db:
+            db.execute('DELETE FROM images WHERE filename = ?', (filename,))
+        with self._lock:
+            self._touched.pop(filename, None)
+
+    def touch(self, filename, now=None):
+        """Record that a generated image was served, for least-recently-used eviction."""
+        now = now or time.time()
+        with self._lock:
+            if now - self._touched.get(filename, 0) < self.touch_interval:
+                return
+            if len(self._touched) > 10000:
+                self._touched.clear()
+            self._touched[filename] = now
+        with closing(self._connect()) as db, db:
+            db.execute('UPDATE images SET accessed = ? WHERE filename = ?', (now, filename))
+
+    def set_pinned(self, filename, pinned=True):
+        """Pin an image so retention never deletes it; returns False if it is not indexed."""
+        with closing(self._connect()) as db, db:
+            cursor = db.execute('UPDATE images SET pinned = ? WHERE filename = ?', (int(pinned), filename))
+        return cursor.rowcount > 0
+
+    def add_upload(self, path, now=None):
+        """Index an input image in static/uploads, or mark an existing one as just used."""
+        now = now or time.time()
+        with closing(self._connect()) as db, db:
+            db.execute('INSERT INTO uploads (filename, size, created, accessed) VALUES (?, ?, ?, ?) '
+                       'ON CONFLICT (filename) DO UPDATE SET accessed = excluded.accessed',
+                       (os.path.basename(path), os.path.getsize(path), now, now))
+
+    def remove_upload(self, filename):
+        with closing(self._connect()) as db, db:
+            db.execute('DELETE FROM uploads WHERE filename = ?', (filename,))
+
+    def usage(self):
+        """Return the indexed bytes as a dict with ``generated``, ``uploads`` and ``pinned`` totals."""
+        with closing(self._connect()) as db:
+            generated, pinned = db.execute(
+                'SELECT COALESCE(SUM(size), 0), COALESCE(SUM(CASE WHEN pinned THEN size ELSE 0 END), 0) '
+                'FROM images').fetchone()
+            uploads = db.execute('SELECT COALESCE(SUM(size), 0) FROM uploads').fetchone()[0]
+        return {'generated': generated, 'uploads': uploads, 'pinned': pinned}
+
+    def candidates(self, order='lru', created_before=None):
+        """Yield unpinned files as dicts with area, filename, size, created and accessed, in eviction order.
+
+        ``area`` is ``generated`` or ``uploads``. Rows are read lazily, so stopping early
+        never loads the whole index. With ``created_before`` only older files are returned.
+        """
+        column = ORDERS.get(order, ORDERS['lru'])
+        cutoff = created_before if created_before is not None else float('inf')
+        query = (f"SELECT 'generated' AS area, filename, size, created, COALESCE(accessed, created) AS accessed "
+                 f"FROM images WHERE pinned = 0 AND created < :cutoff "
+                 f"UNION ALL "
+                 f"SELECT 'uploads' AS area, filename, size, created, accessed FROM uploads WHERE created < :cutoff "
+                 f"ORDER BY {column} ASC")
+        with closing(self._connect()) as db:
+            cursor = db.execute(query, {'cutoff': cutoff})
+            while True:
+                rows = cursor.fetchmany(256)
+                if not rows:
+                    return
+                for row in rows:
+                    yield dict(row)
+
+    def page(self, kind, page=1, per_page=48, sort='newest'):
+        """Return ``(images, total)`` for one page of ``kind``, as dicts with filename, size, created and pinned."""
+        order = SORTS.get(sort, SORTS['newest'])
+        with closing(self._connect()) as db:
+            total = db.execute('SELECT COUNT(*) FROM images WHERE kind = ?', (kind,)).fetchone()[0]
+            rows = db.execute(f'SELECT filename, size, created, pinned FROM images WHERE kind = ? ORDER BY {order} '
+                              f'LIMIT ? OFFSET ?', (kind, per_page, (page - 1) * per_page)).fetchall()
+        return [dict(row) for row in rows], total
+
+    def reconcile(self):
+        """Add files missing from the index and drop rows whose file is gone; returns (added, removed)."""
+        on_disk = scan_outputs(self.generated_dir)
+        uploads = self._scan_uploads(self.uploads_dir)
+
+        with closing(self._connect()) as db, db:
+            indexed = {row[0] for row in db.execute('SELECT filename FROM images')}
+            added = [name for name in on_disk if name not in indexed]
+            removed = [name for name in indexed if name not in on_disk]
+            db.executemany('INSERT INTO images (filename, kind, size, created, accessed) VALUES (?, ?, ?, ?, ?)',
+                           [(name, kind_for_filename(name), *on_disk[name], on_disk[name][1]) for name in added])
+            db.executemany('DELETE FROM images WHERE filename = ?', [(name,) for name in removed])
+
+            indexed = {row[0] for row in db.execute('SELECT filename FROM uploads')}
+            added_uploads = [name for name in uploads if name not in indexed]
+            removed_uploads = [name for name in indexed if name not in uploads]
+            db.executemany('INSERT INTO uploads (filename, size, created, accessed) VALUES (?, ?, ?, ?)',
+                           [(name, *uploads[name], uploads[name][1]) for name in added_uploads])
+            db.executemany('DELETE FROM uploads WHERE filename = ?', [(name,) for name in removed_uploads])
+        added, removed = len(added) + len(added_uploads), len(removed) + len(removed_uploads)
+        logger.info(f"Gallery index reconciled: {added} added, {removed} removed")
+        return added, removed
+
+    @staticmethod
+    def _scan_uploads(directory):
+        found = {}
+        if not os.path.isdir(directory):
+            return found
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.name.startswith('.') and entry.is_file():
+                    stat = entry.stat()
+                    found[entry.name] = (stat.st_size, stat.st_ctime)
+        return found
+
+
+gallery_index = GalleryIndex()
@@ -0,0 +1,110 @@
+import base64
+import io
+import json
+import logging
+import struct
+import time
+from flask import current_app
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+# Binary WebSocket event types ComfyUI sends while sampling
+PREVIEW_IMAGE = 1
+PREVIEW_IMAGE_WITH_METADATA = 4
+_IMAGE_TYPES = {1: 'image/jpeg', 2: 'image/png'}
+
+
+class Preview:
+    """One downscaled latent preview of a running prompt, as yielded by the generation pipeline."""
+
+    def __init__(self, data, mimetype, width, height):
+        self.data = data
+        self.mimetype = mimetype
+        self.width = width
+        self.height = height
+
+    def to_dict(self):
+        encoded = base64.b64encode(self.data).decode('ascii')
+        return {'image': f"data:{self.mimetype};base64,{encoded}", 'width': self.width, 'height': self.height}
+
+
+def _parse_frame(out):
+    """Split a binary message into ``(metadata, mimetype, image bytes)``, or None if it is not a preview."""
+    if len(out) < 8:
+        return None
+    event, value = struct.unpack('>II', out[:8])
+    if event == PREVIEW_IMAGE:
+        return {}, _IMAGE_TYPES.get(value, 'image/jpeg'), out[8:]
+    if event == PREVIEW_IMAGE_WITH_METADATA:
+        try:
+            metadata = json.loads(out[8:8 + value])
+        except ValueError:
+            return None
+        return metadata, metadata.get('image_type', 'image/jpeg'), out[8 + value:]
+    return None
+
+
+def frame_prompt_id(out):
+    """The prompt a binary preview frame belongs to, when ComfyUI says so (newer versions do)."""
+    frame = _parse_frame(out)
+    return frame[0].get('prompt_id') if frame is not None else None
+
+
+def render(image_bytes, max_size, quality):
+    """Downscale a preview image to at most ``max_size`` pixels on a side and re-encode it as JPEG."""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.draft('RGB', (max_size, max_size))
+        image.thumbnail((max_size, max_size))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=quality)
+        return Preview(buffer.getvalue(), 'image/jpeg', image.width, image.height)
+
+
+class PreviewThrottle:
+    """Turns a prompt's binary preview frames into at most ``fps`` small Preview items a second.
+
+    ComfyUI sends a frame per sampler step; frames that arrive sooner than ``1 / fps`` after
+    the last one forwarded are dropped before they are decoded, so a fast sampler costs
+    nothing beyond reading the WebSocket.
+    """
+
+    def __init__(self, fps, max_size=256, quality=70):
+        self.interval = 1.0 / fps
+        self.max_size = max_size
+        self.quality = quality
+        self._last = None
+
+    @classmethod
+    def from_config(cls):
+        """A throttle configured from ``PREVIEW_*``, or None when live previews are turned off."""
+        config = current_app.config
+        if config['PREVIEW_FPS'] <= 0:
+            return None
+        return cls(config['PREVIEW_FPS'], config['PREVIEW_MAX_SIZE'], config['PREVIEW_QUALITY'])
+
+    def take(self, out):
+        """Return the image bytes of ``out`` if it is a preview frame due to be forwarded, otherwise None."""
+        now = time.monotonic()
+        if self._last is not None and now - self._last < self.interval:
+            metrics.PREVIEW_FRAMES.labels('dropped').inc()
+            return None
+        frame = _parse_frame(out)
+        if frame is None:
+            return None
+        self._last = now
+        return frame[2]
+
+    def render(self, image_bytes):
+        """Downscale a frame taken by take(); returns None if it cannot be decoded."""
+        try:
+            preview = render(image_bytes, self.max_size, self.quality)
+        except Exception as e:
+            logger.warning(f"Could not decode a preview frame: {e}")
+            return None
+        metrics.PREVIEW_FRAMES.labels('sent').inc()
+        return preview
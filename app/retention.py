@@ -0,0 +1,186 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+from app.models import gallery_index
+from app.storage import output_path, sidecar_path
+from app.thumbnails import thumbnails
+
+logger = logging.getLogger(__name__)
+
+MODES = ('off', 'dry-run', 'delete')
+
+# How many of the files chosen for eviction a report lists by name
+REPORT_FILES = 50
+
+
+class RetentionManager:
+    """Keeps static/generated and static/uploads within an age limit and a byte budget.
+
+    Each cycle reads sizes and timestamps from the gallery index rather than walking the
+    directories. Files older than ``RETENTION_MAX_AGE_DAYS`` go first, then the least recently
+    used (or oldest, with ``RETENTION_ORDER = 'oldest'``) until both areas together fit in
+    ``RETENTION_MAX_BYTES``. Pinned images are never deleted, and nothing used within
+    ``RETENTION_MIN_AGE`` seconds is touched, so inputs and outputs of running generations
+    are safe. In ``dry-run`` mode the cycle only reports what it would delete.
+
+    A background thread runs a cycle every ``RETENTION_INTERVAL`` seconds in each worker; a
+    file lock in the instance directory makes sure only one worker evicts at a time.
+    """
+
+    def __init__(self, app=None):
+        self.mode = 'off'
+        self.max_bytes = 0
+        self.max_age = 0
+        self.order = 'lru'
+        self.interval = 600
+        self.min_age = 3600
+        self.lock_path = None
+        self.generated_dir = None
+        self.uploads_dir = None
+        self.last_report = None
+        self._thread = None
+        self._thread_pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.mode = app.config['RETENTION_MODE']
+        if self.mode not in MODES:
+            raise ValueError(f"RETENTION_MODE must be one of {', '.join(MODES)}, not {self.mode!r}")
+        self.max_bytes = app.config['RETENTION_MAX_BYTES']
+        self.max_age = app.config['RETENTION_MAX_AGE_DAYS'] * 24 * 3600
+        self.order = app.config['RETENTION_ORDER']
+        self.interval = app.config['RETENTION_INTERVAL']
+        self.min_age = app.config['RETENTION_MIN_AGE']
+        self.lock_path = os.path.join(app.config['INSTANCE_DIR'], 'retention.lock')
+        self.generated_dir = os.path.join(app.root_path, 'static', 'generated')
+        self.uploads_dir = os.path.join(app.root_path, 'static', 'uploads')
+        if self.mode != 'off':
+            # Started from the first request so each gunicorn worker gets its own thread after the fork
+            app.before_request(self.ensure_started)
+        app.extensions['retention'] = self
+
+    def ensure_started(self):
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._loop, name='retention', daemon=True)
+            self._thread_pid = os.getpid()
+        self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run(dry_run=self.mode != 'delete')
+            except Exception:
+                logger.exception("Retention cycle failed")
+
+    def plan(self, now=None):
+        """Return ``(chosen, usage, remaining_bytes)`` for a cycle.
+
+        ``chosen`` lists the files to delete in order, as candidates() dicts with a ``reason``
+        of ``age`` or ``budget``; ``usage`` is gallery_index.usage() before the cycle.
+        """
+        now = now or time.time()
+        usage = gallery_index.usage()
+        total = usage['generated'] + usage['uploads']
+        recent = now - self.min_age
+        chosen = []
+
+        if self.max_age:
+            for entry in gallery_index.candidates('oldest', created_before=now - self.max_age):
+                if entry['accessed'] <= recent:
+                    chosen.append(dict(entry, reason='age'))
+                    total -= entry['size']
+
+        if self.max_bytes and total > self.max_bytes:
+            taken = {(entry['area'], entry['filename']) for entry in chosen}
+            for entry in gallery_index.candidates(self.order):
+                if total <= self.max_bytes:
+                    break
+                if (entry['area'], entry['filename']) in taken or entry['accessed'] > recent:
+                    continue
+                chosen.append(dict(entry, reason='budget'))
+                total -= entry['size']
+        return chosen, usage, total
+
+    def run(self, dry_run=True, now=None):
+        """Run one cycle and return its report; returns None if another process is mid-cycle."""
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        with open(self.lock_path, 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.debug("Retention cycle already running in another process")
+                return None
+            started = time.monotonic()
+            chosen, usage, remaining = self.plan(now)
+            deleted = [] if dry_run else [entry for entry in chosen if self._delete(entry)]
+
+        report = {
+            'dry_run': dry_run,
+            'order': self.order,
+            'max_bytes': self.max_bytes,
+            'max_age_days': self.max_age / (24 * 3600),
+            'generated_bytes': usage['generated'],
+            'uploads_bytes': usage['uploads'],
+            'pinned_bytes': usage['pinned'],
+            'evicted_files': len(chosen if dry_run else deleted),
+            'evicted_bytes': sum(entry['size'] for entry in (chosen if dry_run else deleted)),
+            'by_reason': {reason: sum(1 for entry in chosen if entry['reason'] == reason)
+                          for reason in ('age', 'budget')},
+            'remaining_bytes': remaining,
+            # Pinned files, or files in use, can keep the total above the budget
+            'over_budget': bool(self.max_bytes and remaining > self.max_bytes),
+            'files': [{key: entry[key] for key in ('area', 'filename', 'size', 'reason')}
+                      for entry in chosen[:REPORT_FILES]],
+            'finished_at': time.time(),
+            'seconds': round(time.monotonic() - started, 3),
+        }
+        verb = 'would delete' if dry_run else 'deleted'
+        logger.info(f"Retention {verb} {report['evicted_files']} files ({report['evicted_bytes']} bytes); "
+                    f"{remaining} bytes remain of a {self.max_bytes} byte budget")
+        if report['over_budget']:
+            logger.warning(f"Retention could not get under budget; {usage['pinned']} bytes are pinned and "
+                           f"files used in the last {self.min_age:.0f}s are kept")
+        self.last_report = report
+        return report
+
+    def _delete(self, entry):
+        if entry['area'] == 'generated':
+            path = output_path(self.generated_dir, entry['filename'])
+            paths = [path, sidecar_path(path)]
+        else:
+            paths = [os.path.join(self.uploads_dir, entry['filename'])]
+        try:
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        except OSError as e:
+            logger.error(f"Retention could not delete {entry['filename']}: {e}")
+            return False
+        if entry['area'] == 'generated':
+            gallery_index.remove(entry['filename'])
+            thumbnails.remove(entry['filename'])
+        else:
+            gallery_index.remove_upload(entry['filename'])
+        return True
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'order': self.order,
+            'max_bytes': self.max_bytes,
+            'max_age_days': self.max_age / (24 * 3600),
+            'interval': self.interval,
+            'last_report': self.last_report,
+        }
+
+
+retention = RetentionManager()
@@ -1,8 +1,34 @@
+import hmac
 import os
+import json
+import mimetypes
 import logging
-from flask import Blueprint, render_template, request, jsonify, current_app, send_file, abort
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from flask import (Blueprint, render_template, request, jsonify, current_app, send_file, abort, url_for,
+                   Response, stream_with_context)
+from app.admission import AdmissionRejected, admission
+from app.backends import backend_pool
+from app.batch import BatchError, BatchManifest, build_archive, check_workflow, expand_batch, parse_jsonl
+from app.cache import result_cache
+from app.cancellation import CancelScope, Cancelled
+from app.coalesce import single_flight
 from app.forms import ImageGenerationForm, ImageToImageForm
+from app.jobs import job_manager, QUEUED, RUNNING
+from app import metrics
+from app.models import gallery_index, TEXT_TO_IMAGE, IMAGE_TO_IMAGE
+from app.previews import Preview
+from app.retention import retention
+from app.storage import output_store
+from app.scheduler import checkpoint_scheduler
+from app.thumbnails import thumbnails
+from app import tracing
+from app.tracing import Trace
+from app.uploads import save_upload
 from app.utils import generate_image, generate_image_to_image
+from app.workflows import workflow_registry
+from prometheus_client import CONTENT_TYPE_LATEST
 from werkzeug.utils import secure_filename
 
 main = Blueprint('main', __name__)
@@ -14,173 +40,564 @@ def index():
     return render_template('index.html')
 
 
+class GenerationError(Exception):
+    pass
+
+
+def _load_workflow(name):
+    try:
+        return workflow_registry.get(name)
+    except FileNotFoundError:
+        workflow_path = os.path.join(current_app.config['WORKFLOWS_DIR'], name)
+        logger.error(f"Workflow file not found: {workflow_path}")
+        raise GenerationError(f"Workflow file not found: {workflow_path}")
+
+
+def _parse_seed(value):
+    # Convert seed to integer, use -1 if it's not a valid integer
+    return int(value) if value and value.isdigit() else -1
+
+
+def _text_to_image_request(form, generate=None, previews=False):
+    """Bind an ImageGenerationForm to a generator factory and the metadata its outputs are stored with.
+
+    ``generate`` defaults to generate_image; the asyncio path passes generate_image_async. With
+    ``previews`` the generation also yields live latent previews (see _wants_previews).
+    """
+    generate = generate or generate_image
+    workflow = _load_workflow('base_workflow.json')
+    params = dict(
+        positive_prompt=form.positive_prompt.data,
+        negative_prompt=form.negative_prompt.data,
+        seed=_parse_seed(form.seed.data),
+        steps=form.steps.data,
+        cfg=form.cfg.data,
+        sampler_name=form.sampler_name.data,
+        scheduler=form.scheduler.data,
+        denoise=form.denoise.data,
+        ckpt_name=form.ckpt_name.data,
+        width=form.width.data,
+        height=form.height.data,
+        batch_size=form.batch_size.data
+    )
+    output_dir = _generated_dir()
+    return (lambda: generate(workflow, output_dir=output_dir, live_previews=previews, **params),
+            dict(params, kind='text_to_image', workflow=workflow.name))
+
+
+def _image_to_image_request(form, generate=None, previews=False):
+    """Store the uploaded image by content hash and bind an ImageToImageForm like _text_to_image_request."""
+    generate = generate or generate_image_to_image
+    workflow = _load_workflow('basic_image_to_image.json')
+
+    filepath = save_upload(form.input_image.data, os.path.join(current_app.root_path, 'static', 'uploads'))
+    gallery_index.add_upload(filepath)
+
+    params = dict(
+        positive_prompt=form.positive_prompt.data,
+        negative_prompt=form.negative_prompt.data,
+        seed=_parse_seed(form.seed.data),
+        steps=form.steps.data,
+        cfg=form.cfg.data,
+        sampler_name=form.sampler_name.data,
+        scheduler=form.scheduler.data,
+        denoise=form.denoise.data,
+        ckpt_name=form.ckpt_name.data
+    )
+    output_dir = _generated_dir()
+    return (lambda: generate(workflow, filepath, output_dir=output_dir, live_previews=previews, **params),
+            dict(params, kind='image_to_image', workflow=workflow.name, input_image=os.path.basename(filepath)))
+
+
+def _wants_previews():
+    """Whether the current streaming request gets live previews: yes unless ``PREVIEW_FPS`` is 0
+    or the request sends ``previews=0``."""
+    return current_app.config['PREVIEW_FPS'] > 0 and request.values.get('previews') != '0'
+
+
+def _generated_dir():
+    return output_store.root
+
+
+def _generation_events(image_generator, output_meta, trace=None, scope=None):
+    """Drain a generation generator, yielding ('progress', message) for each progress item
+    and ('preview', Preview) for each live preview.
+
+    Every generated image is saved under static/generated and a final ('result', filenames)
+    is yielded; raises GenerationError on failure. Stage timings are recorded in ``trace``,
+    and the generation stops when ``scope`` is cancelled or passes its deadline.
+    """
+    with trace.activate() if trace is not None else nullcontext(), \
+            scope.activate() if scope is not None else nullcontext():
+        generated_images = None
+        for item in image_generator:
+            if isinstance(item, str):
+                if item.startswith("Error:"):
+                    logger.error(f"Error during image generation: {item}")
+                    raise GenerationError(item)
+                logger.info(f"Generation progress: {item}")
+                yield 'progress', item
+            elif isinstance(item, Preview):
+                yield 'preview', item
+            elif isinstance(item, list):
+                generated_images = item
+        filenames = _save_outputs(generated_images, output_meta)
+    yield 'result', filenames
+
+
+def _save_outputs(generated_images, output_meta):
+    """Move each generated image into the output store with ``output_meta`` and return the new filenames."""
+    if not generated_images:
+        logger.warning("No image data received from the generation pipeline")
+        raise GenerationError('No image data received')
+
+    generated_images = [image for image in generated_images if 'error' not in image]
+    if not generated_images:
+        raise GenerationError('None of the generated images could be downloaded')
+
+    trace = tracing.current()
+    metadata = dict(output_meta, trace=trace.to_dict() if trace is not None else None)
+    filenames = []
+    stages = metrics.Stages(output_meta.get('workflow'), output_meta.get('ckpt_name'))
+    for image in generated_images:
+        with stages.stage('disk_write'):
+            filename = output_store.save(image, output_meta['kind'], metadata)
+        gallery_index.add(filename)
+        thumbnails.submit(filename)
+        filenames.append(filename)
+    logger.info(f"Images generated successfully: {filenames}")
+    return filenames
+
+
+def _run_generation(image_generator, output_meta, on_progress=None, trace=None, scope=None):
+    """Run _generation_events to completion and return the saved filenames."""
+    filenames = []
+    for event, payload in _generation_events(image_generator, output_meta, trace, scope):
+        if event == 'progress':
+            if on_progress is not None:
+                on_progress(payload)
+        elif event == 'result':
+            filenames = payload
+    return filenames
+
+
+def _new_trace(kind):
+    """Start a Trace for a generation, profiled if profiling is on or the request asks with the admin token."""
+    config = current_app.config
+    token = config['PROFILE_TOKEN']
+    profile = config['PROFILE_REQUESTS'] or bool(
+        token and hmac.compare_digest(request.headers.get('X-Profile', ''), token))
+    return Trace(kind, slow_seconds=config['SLOW_REQUEST_SECONDS'],
+                 profile_dir=config['PROFILE_DIR'] if profile else None)
+
+
+def _deadline():
+    """Seconds the current request's generation may take: ``GENERATION_DEADLINE``, or less if it asks."""
+    limit = current_app.config['GENERATION_DEADLINE']
+    requested = request.values.get('deadline', type=float)
+    if requested and requested > 0:
+        return min(requested, limit) if limit else requested
+    return limit or None
+
+
+def _admission_ticket(priority_class=None):
+    """Admit the current request; raises AdmissionRejected (answered with 429) when it is over a limit."""
+    client, client_class = admission.identify(request)
+    return admission.admit(client, priority_class or client_class)
+
+
+def _admit(make_generator):
+    """Admit the current request and make its generation wait for a slot, reporting its queue position.
+
+    Returns the wrapped generator factory and the admission ticket.
+    """
+    ticket = _admission_ticket()
+    return (lambda: admission.queue(ticket, make_generator)), ticket
+
+
+@main.errorhandler(AdmissionRejected)
+def admission_rejected(e):
+    response = jsonify({'success': False, 'error': str(e), 'retry_after': e.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+def _respond(kind, make_generator, output_meta):
+    """Run a generation inline, or as a background job when ``mode=job`` is requested."""
+    make_generator, ticket = _admit(make_generator)
+    trace = _new_trace(kind)
+    scope = CancelScope(deadline=_deadline())
+
+    def pipeline(on_progress):
+        return _run_generation(make_generator(), output_meta, on_progress, trace, scope)
+
+    if request.values.get('mode') == 'job':
+        # The job may sit behind others for a while before it polls; keep its place until it ends
+        admission.hold(ticket)
+        job = job_manager.submit(kind, pipeline, trace=trace, scope=scope,
+                                 on_finish=lambda: admission.release(ticket))
+        return jsonify({'success': True, 'job_id': job.id,
+                        'status_url': url_for('main.job_status', job_id=job.id),
+                        'cancel_url': url_for('main.cancel_job', job_id=job.id)}), 202
+
+    try:
+        filenames = pipeline(None)
+        return jsonify({'success': True, 'filename': filenames[0], 'filenames': filenames,
+                        'trace': trace.to_dict()})
+    except (GenerationError, Cancelled) as e:
+        return jsonify({'success': False, 'error': str(e), 'trace': trace.to_dict()})
+    except Exception as e:
+        logger.exception(f"Unexpected error during {kind} generation")
+        return jsonify({'success': False, 'error': str(e), 'trace': trace.to_dict()})
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _stream(kind, make_generator, output_meta):
+    """Run a generation inside the response, forwarding each progress item as a Server-Sent Event.
+
+    If the client disconnects, the server closes this generator on its next write, and the
+    generation's ComfyUI prompt is deleted or interrupted.
+    """
+    make_generator, _ = _admit(make_generator)
+    trace = _new_trace(kind)
+    scope = CancelScope(deadline=_deadline())
+
+    def events():
+        try:
+            for event, payload in _generation_events(make_generator(), output_meta, trace, scope):
+                if event == 'progress':
+                    yield _sse('progress', {'message': payload})
+                elif event == 'preview':
+                    yield _sse('preview', payload.to_dict())
+                else:
+                    yield _sse('result', {'success': True, 'filename': payload[0], 'filenames': payload,
+                                          'trace': trace.to_dict()})
+        except (GenerationError, Cancelled) as e:
+            yield _sse('error', {'success': False, 'error': str(e)})
+        except Exception as e:
+            logger.exception(f"Unexpected error during {kind} generation")
+            yield _sse('error', {'success': False, 'error': str(e)})
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Tell nginx not to buffer the stream so each event reaches the browser immediately
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def _invalid_form(form):
+    return jsonify({'success': False, 'error': 'Invalid form data', 'errors': form.errors}), 400
+
+
 @main.route('/generate', methods=['GET', 'POST'])
 def generate():
     form = ImageGenerationForm()
     if form.validate_on_submit():
-        workflow_path = os.path.join(current_app.config['WORKFLOWS_DIR'], 'base_workflow.json')
-        try:
-            with open(workflow_path, 'r') as f:
-                workflow = f.read()
-        except FileNotFoundError:
-            logger.error(f"Workflow file not found: {workflow_path}")
-            return jsonify({'success': False, 'error': f"Workflow file not found: {workflow_path}"})
-
         try:
-            image_generator = generate_image(
-                workflow,
-                form.positive_prompt.data,
-                form.negative_prompt.data,
-                steps=form.steps.data,
-                cfg=form.cfg.data,
-                sampler_name=form.sampler_name.data,
-                scheduler=form.scheduler.data,
-                denoise=form.denoise.data,
-                ckpt_name=form.ckpt_name.data,
-                width=form.width.data,
-                height=form.height.data,
-                batch_size=form.batch_size.data
-            )
-
-            generated_images = None
-            for item in image_generator:
-                if isinstance(item, str):
-                    if item.startswith("Error:"):
-                        logger.error(f"Error during image generation: {item}")
-                        return jsonify({'success': False, 'error': item})
-                    logger.info(f"Generation progress: {item}")
-                    print(item)
-                elif isinstance(item, list):
-                    generated_images = item
-
-            if generated_images and len(generated_images) > 0:
-                filename = secure_filename(f"generated_{form.positive_prompt.data[:10]}.png")
-                filepath = os.path.join(current_app.root_path, 'static', 'generated', filename)
-                os.makedirs(os.path.dirname(filepath), exist_ok=True)
-                with open(filepath, 'wb') as f:
-                    f.write(generated_images[0]['image_data'])
-                logger.info(f"Image generated successfully: {filename}")
-                return jsonify({'success': True, 'filename': filename})
-            else:
-                logger.warning("No image data received from generate_image function")
-                return jsonify({'success': False, 'error': 'No image data received'})
-        except Exception as e:
-            logger.exception("Unexpected error during image generation")
+            make_generator, output_meta = _text_to_image_request(form)
+        except GenerationError as e:
             return jsonify({'success': False, 'error': str(e)})
+        return _respond('text_to_image', make_generator, output_meta)
 
-    return render_template('generate.html', form=form, image_to_image=False)
+    return render_template('generate.html', form=form, image_to_image=False,
+                           stream_url=url_for('main.generate_stream'))
+
+
+@main.route('/generate/stream', methods=['POST'])
+def generate_stream():
+    form = ImageGenerationForm()
+    if not form.validate_on_submit():
+        return _invalid_form(form)
+    try:
+        make_generator, output_meta = _text_to_image_request(form, previews=_wants_previews())
+    except GenerationError as e:
+        return jsonify({'success': False, 'error': str(e)})
+    return _stream('text_to_image', make_generator, output_meta)
 
 
 @main.route('/generate_image_to_image', methods=['GET', 'POST'])
 def image_to_image_route():
     form = ImageToImageForm()
     if form.validate_on_submit():
-        workflow_path = os.path.join(current_app.config['WORKFLOWS_DIR'], 'basic_image_to_image.json')
         try:
-            with open(workflow_path, 'r') as f:
-                workflow = f.read()
-        except FileNotFoundError:
-            logger.error(f"Workflow file not found: {workflow_path}")
-            return jsonify({'success': False, 'error': f"Workflow file not found: {workflow_path}"})
-
-        input_image = form.input_image.data
-        filename = secure_filename(input_image.filename)
-        filepath = os.path.join(current_app.root_path, 'static', 'uploads', filename)
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        input_image.save(filepath)
+            make_generator, output_meta = _image_to_image_request(form)
+        except GenerationError as e:
+            return jsonify({'success': False, 'error': str(e)})
+        return _respond('image_to_image', make_generator, output_meta)
+
+    return render_template('generate.html', form=form, image_to_image=True,
+                           stream_url=url_for('main.image_to_image_stream'))
+
+
+@main.route('/generate_image_to_image/stream', methods=['POST'])
+def image_to_image_stream():
+    form = ImageToImageForm()
+    if not form.validate_on_submit():
+        return _invalid_form(form)
+    try:
+        make_generator, output_meta = _image_to_image_request(form, previews=_wants_previews())
+    except GenerationError as e:
+        return jsonify({'success': False, 'error': str(e)})
+    return _stream('image_to_image', make_generator, output_meta)
+
+
+@main.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    return jsonify({'success': True, **job})
+
+
+@main.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancel a queued or running job or batch; its ComfyUI prompts are deleted from the queue or interrupted."""
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    if job['status'] not in (QUEUED, RUNNING):
+        return jsonify({'success': False, 'error': f"Job is already {job['status']}", 'status': job['status']}), 409
+    return jsonify({'success': True, 'job_id': job_id,
+                    'status_url': url_for('main.job_status', job_id=job_id)}), 202
+
+
+def _manifest_path(batch_id):
+    return os.path.join(job_manager.jobs_dir, f"{batch_id}.manifest.json")
+
+
+@main.route('/batch', methods=['POST'])
+def batch():
+    try:
+        if 'jobs' in request.files:
+            spec = {'jobs': parse_jsonl(request.files['jobs'].stream), 'workflow': request.form.get('workflow')}
+        else:
+            spec = request.get_json(silent=True) or {}
+        items = expand_batch(spec, current_app.config['BATCH_MAX_ITEMS'])
+        workflow_name = spec.get('workflow') or 'base_workflow.json'
+        workflow = _load_workflow(workflow_name)
+        check_workflow(workflow)
+    except (BatchError, GenerationError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    # A batch holds one admission slot while it runs and always queues behind interactive requests
+    ticket = _admission_ticket('low')
+    batch_id = uuid.uuid4().hex
+    manifest = BatchManifest(_manifest_path(batch_id), batch_id, workflow_name, items)
+    output_dir = _generated_dir()
+    concurrency = current_app.config['BATCH_CONCURRENCY']
+    item_deadline = current_app.config['GENERATION_DEADLINE'] or None
+    # Cancelling the batch job cancels every item; each item also gets its own deadline
+    batch_scope = CancelScope()
+    app = current_app._get_current_object()
 
+    def run_item(index, params):
+        with app.app_context():
+            if batch_scope.cancelled:
+                manifest.update(index, status='cancelled')
+                return []
+            manifest.update(index, status='running')
+            trace = Trace('batch_item', slow_seconds=current_app.config['SLOW_REQUEST_SECONDS'])
+            scope = CancelScope(deadline=item_deadline, parent=batch_scope)
+            try:
+                output_meta = dict(params, kind='batch_item', workflow=workflow_name, batch_id=batch_id,
+                                   batch_index=index)
+                filenames = _run_generation(generate_image(workflow, output_dir=output_dir, **params),
+                                            output_meta, trace=trace, scope=scope)
+            except Exception as e:
+                status = 'cancelled' if scope.cancelled else 'failed'
+                logger.error(f"Batch {batch_id} item {index} {status}: {e}")
+                manifest.update(index, status=status, error=str(e), trace=trace.to_dict())
+                return []
+            manifest.update(index, status='completed', filenames=filenames, trace=trace.to_dict())
+            return filenames
+
+    def pipeline(on_progress):
+        # Keep several items in flight so ComfyUI's queue never runs dry between jobs; the
+        # checkpoint scheduler decides how many of them actually sit in its queue.
+        filenames = []
         try:
-            # Convert seed to integer, use -1 if it's not a valid integer
-            seed = int(form.seed.data) if form.seed.data.isdigit() else -1
-            image_generator = generate_image_to_image(
-                workflow,
-                filepath,
-                form.positive_prompt.data,
-                form.negative_prompt.data,
-                seed=seed,
-                steps=form.steps.data,
-                cfg=form.cfg.data,
-                sampler_name=form.sampler_name.data,
-                scheduler=form.scheduler.data,
-                denoise=form.denoise.data,
-                ckpt_name=form.ckpt_name.data
-            )
-
-            generated_images = None
-            for item in image_generator:
-                if isinstance(item, str):
-                    if item.startswith("Error:"):
-                        logger.error(f"Error during image-to-image generation: {item}")
-                        return jsonify({'success': False, 'error': item})
-                    logger.info(f"Generation progress: {item}")
-                    print(item)
-                elif isinstance(item, list):
-                    generated_images = item
-
-            if generated_images and len(generated_images) > 0:
-                output_filename = secure_filename(f"generated_i2i_{form.positive_prompt.data[:10]}.png")
-                output_filepath = os.path.join(current_app.root_path, 'static', 'generated', output_filename)
-                os.makedirs(os.path.dirname(output_filepath), exist_ok=True)
-                with open(output_filepath, 'wb') as f:
-                    f.write(generated_images[0]['image_data'])
-                logger.info(f"Image-to-image generated successfully: {output_filename}")
-                return jsonify({'success': True, 'filename': output_filename})
-            else:
-                logger.warning("No image data received from generate_image_to_image function")
-                return jsonify({'success': False, 'error': 'No image data received'})
-        except Exception as e:
-            logger.exception("Unexpected error during image-to-image generation")
-            return jsonify({'success': False, 'error': str(e)})
+            for message in admission.wait(ticket):
+                on_progress(message)
+            with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch') as executor:
+                futures = [executor.submit(run_item, index, params) for index, params in enumerate(items)]
+                for done, future in enumerate(as_completed(futures), 1):
+                    filenames += future.result()
+                    on_progress(f"Batch progress: {done}/{len(items)} items done")
+        finally:
+            admission.release(ticket)
+        manifest.finish()
+        batch_scope.check()
+        return filenames
 
-    return render_template('generate.html', form=form, image_to_image=True)
+    admission.hold(ticket)
+    job_manager.submit('batch', pipeline, job_id=batch_id, scope=batch_scope,
+                       on_finish=lambda: admission.release(ticket))
+    return jsonify({
+        'success': True,
+        'job_id': batch_id,
+        'items': len(items),
+        'status_url': url_for('main.job_status', job_id=batch_id),
+        'cancel_url': url_for('main.cancel_job', job_id=batch_id),
+        'manifest_url': url_for('main.batch_manifest', batch_id=batch_id),
+        'archive_url': url_for('main.batch_archive', batch_id=batch_id),
+    }), 202
 
 
-@main.route('/saves')
-def saves():
-    generated_dir = os.path.join(current_app.root_path, 'static', 'generated')
-    text_to_image = []
-    image_to_image = []
+def _load_manifest(batch_id):
+    if not batch_id.isalnum():
+        abort(404)
+    try:
+        return BatchManifest.load(_manifest_path(batch_id))
+    except (FileNotFoundError, ValueError):
+        abort(404)
+
+
+@main.route('/batch/<batch_id>/manifest')
+def batch_manifest(batch_id):
+    return jsonify(_load_manifest(batch_id))
+
+
+@main.route('/batch/<batch_id>/archive')
+def batch_archive(batch_id):
+    archive = build_archive(_load_manifest(batch_id), output_store.resolve)
+    return send_file(archive, mimetype='application/zip', as_attachment=True, download_name=f"batch_{batch_id}.zip")
+
+
+@main.route('/cache/stats')
+def cache_stats():
+    return jsonify({**result_cache.stats(), **single_flight.stats(), **thumbnails.stats()})
+
+
+@main.route('/admission')
+def admission_stats():
+    return jsonify(admission.stats())
 
-    for filename in os.listdir(generated_dir):
-        if filename.startswith('generated_'):
-            file_path = os.path.join(generated_dir, filename)
-            file_size = os.path.getsize(file_path)
-            creation_time = os.path.getctime(file_path)
 
-            file_info = {
-                'filename': filename,
-                'size': file_size,
-                'created': creation_time
-            }
+@main.route('/retention')
+def retention_stats():
+    return jsonify(retention.stats())
 
-            if filename.startswith('generated_i2i_'):
-                image_to_image.append(file_info)
-            else:
-                text_to_image.append(file_info)
 
-    return render_template('saves.html', text_to_image=text_to_image, image_to_image=image_to_image)
+@main.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype=CONTENT_TYPE_LATEST)
+
+
+@main.route('/backends')
+def backends():
+    return jsonify({'backends': backend_pool.status(), 'scheduler': checkpoint_scheduler.stats()})
+
+
+@main.route('/saves')
+def saves():
+    kind = request.args.get('kind', TEXT_TO_IMAGE)
+    if kind not in (TEXT_TO_IMAGE, IMAGE_TO_IMAGE):
+        kind = TEXT_TO_IMAGE
+    sort = request.args.get('sort', 'newest')
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = current_app.config['GALLERY_PAGE_SIZE']
+
+    images, total = gallery_index.page(kind, page, per_page, sort)
+    pages = max((total + per_page - 1) // per_page, 1)
+    return render_template('saves.html', images=images, kind=kind, sort=sort, page=page, pages=pages, total=total)
 
 
 @main.route('/result/<filename>')
 def result(filename):
-    return render_template('result.html', filename=filename)
+    if output_store.resolve(filename) is None:
+        abort(404)
+    return render_template('result.html', filename=filename, metadata=output_store.metadata(filename))
 
 
-@main.route('/download/<filename>')
-def download(filename):
+@main.route('/metadata/<filename>')
+def metadata(filename):
+    if output_store.resolve(filename) is None:
+        abort(404)
+    return jsonify(output_store.metadata(filename) or {})
+
+
+@main.route('/thumb/<filename>')
+def thumbnail(filename):
+    path = output_store.resolve(filename)
+    if path is None:
+        abort(404)
     try:
-        return send_file(os.path.join(current_app.root_path, 'static', 'generated', filename), as_attachment=True)
-    except FileNotFoundError:
+        thumb_path = thumbnails.ensure(filename)
+    except Exception as e:
+        logger.warning(f"Could not create thumbnail for {filename}, serving the original: {e}")
+        return send_file(path, max_age=3600)
+    return send_file(thumb_path, mimetype='image/webp', max_age=86400)
+
+
+_NOT_SERVED = ('.json', '.part', '.tmp')
+
+
+def _send_generated(filename, as_attachment=False):
+    """Send a generated image with a strong ETag, immutable caching and Range support.
+
+    With ``SENDFILE_MODE = 'x-accel'`` only the headers come from here and nginx streams
+    the bytes, so a gunicorn worker is never tied up pushing a large file to a slow client.
+    """
+    # Metadata sidecars and partial downloads share the folder but are not outputs
+    path = None if filename.endswith(_NOT_SERVED) else output_store.resolve(filename)
+    if path is None:
         abort(404)
+    stat = os.stat(path)
+    gallery_index.touch(filename)
+    # Outputs are written once and never modified, so size and mtime identify the bytes exactly
+    etag = f"{stat.st_size:x}-{stat.st_mtime_ns:x}"
+    max_age = current_app.config['GENERATED_MAX_AGE']
+
+    if current_app.config['SENDFILE_MODE'] == 'x-accel':
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = (f"{current_app.config['X_ACCEL_PREFIX'].rstrip('/')}/"
+                                                f"{output_store.relative_path(filename)}")
+        if as_attachment:
+            response.headers.set('Content-Disposition', 'attachment', filename=filename)
+        response.set_etag(etag)
+        response.last_modified = stat.st_mtime
+        response.make_conditional(request)
+    else:
+        response = send_file(path, as_attachment=as_attachment, etag=etag, last_modified=stat.st_mtime,
+                             max_age=max_age, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.immutable = True
+    return response
+
+
+@main.route('/static/generated/<filename>')
+def generated(filename):
+    return _send_generated(filename)
+
+
+@main.route('/download/<filename>')
+def download(filename):
+    return _send_generated(filename, as_attachment=True)
 
 
 @main.route('/delete/<filename>', methods=['POST'])
 def delete(filename):
-    file_path = os.path.join(current_app.root_path, 'static', 'generated', filename)
     try:
-        os.remove(file_path)
+        if not output_store.delete(filename):
+            return jsonify({'success': False, 'message': 'File not found'}), 404
+        gallery_index.remove(filename)
+        thumbnails.remove(filename)
         return jsonify({'success': True, 'message': 'File deleted successfully'})
-    except FileNotFoundError:
+    except ValueError:
         return jsonify({'success': False, 'message': 'File not found'}), 404
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@main.route('/pin/<filename>', methods=['POST'])
+def pin(filename):
+    """Pin an image so retention keeps it; ``pinned=0`` unpins it."""
+    pinned = request.values.get('pinned', '1') != '0'
+    if not gallery_index.set_pinned(secure_filename(filename), pinned):
+        return jsonify({'success': False, 'message': 'File not found'}), 404
+    return jsonify({'success': True, 'pinned': pinned})
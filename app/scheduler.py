@@ -0,0 +1,234 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing, contextmanager
+from flask import current_app
+from app.admission import process_alive
+from app.backends import backend_pool
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS slots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    server TEXT NOT NULL,
+    ckpt_name TEXT,
+    skipped INTEGER NOT NULL DEFAULT 0,
+    granted INTEGER NOT NULL DEFAULT 0,
+    pid INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS loaded (
+    server TEXT PRIMARY KEY,
+    ckpt_name TEXT,
+    swaps INTEGER NOT NULL DEFAULT 0
+);
+'''
+
+
+def checkpoint_of(prompt):
+    """Return the ``ckpt_name`` a bound prompt graph loads, or None."""
+    for node in prompt.values():
+        ckpt_name = node.get('inputs', {}).get('ckpt_name')
+        if isinstance(ckpt_name, str):
+            return ckpt_name
+    return None
+
+
+class Ticket:
+    def __init__(self, server_address, ckpt_name, on_grant=None):
+        self.id = None
+        self.server_address = server_address
+        self.ckpt_name = ckpt_name
+        self.on_grant = on_grant
+        self.created_at = time.time()
+        self.granted = False
+
+
+class CheckpointScheduler:
+    """Orders submissions to each backend, across all workers, so jobs on the same checkpoint run back to back.
+
+    At most ``SCHEDULER_MAX_ACTIVE`` prompts sit in a backend's ComfyUI queue at once; the
+    rest wait here. When a slot frees, the oldest waiting job that uses the backend's current
+    checkpoint goes next, unless the oldest waiting job has already been passed over
+    ``SCHEDULER_MAX_SKIPS`` times, in which case it goes.
+
+    The queue, the checkpoint each backend last loaded and its swap count live in a SQLite
+    database (``SCHEDULER_DB``) so that every gunicorn worker's jobs are grouped together.
+    A grant made by this worker reaches its waiter at once; one made by another worker is
+    seen on the next poll, after ``poll_interval`` seconds and then backing off to
+    ``max_poll_interval``, since each poll is a write transaction. Slots of workers that died are freed.
+    """
+
+    poll_interval = 0.25
+    # No longer than cancellation.POLL_SECONDS, so a cancelled waiter still leaves within a second
+    max_poll_interval = 1.0
+
+    def __init__(self, app=None):
+        self.db_path = None
+        self._cond = threading.Condition()
+        # This process's outstanding tickets by id, so grants made here can be delivered directly
+        self._tickets = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.db_path = app.config['SCHEDULER_DB']
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        with closing(self._connect()) as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+        app.extensions['checkpoint_scheduler'] = self
+
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        with closing(self._connect()) as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    def request(self, server_address, ckpt_name, on_grant=None):
+        """Enqueue a job for ``server_address``; the returned ticket may already be granted.
+
+        ``on_grant`` is called (under the scheduler's lock) when the ticket is granted, for
+        callers such as the asyncio path that cannot block in ``wait``.
+        """
+        ticket = Ticket(server_address, ckpt_name, on_grant)
+        with self._transaction() as db:
+            ticket.id = db.execute('INSERT INTO slots (server, ckpt_name, pid) VALUES (?, ?, ?)',
+                                   (server_address, ckpt_name, os.getpid())).lastrowid
+            with self._cond:
+                self._tickets[ticket.id] = ticket
+            granted = self._dispatch(db, server_address)
+        self._deliver(granted)
+        return ticket
+
+    def poll(self, ticket):
+        """Hand out any free slots on the ticket's backend and return whether ``ticket`` now holds one."""
+        if not ticket.granted:
+            with self._transaction() as db:
+                granted = self._dispatch(db, ticket.server_address)
+                if ticket.id not in granted:
+                    row = db.execute('SELECT granted FROM slots WHERE id = ?', (ticket.id,)).fetchone()
+                    if row is not None and row['granted']:
+                        granted.append(ticket.id)
+            self._deliver(granted)
+        return ticket.granted
+
+    def wait(self, ticket, timeout=None, check=None):
+        """Block until ``ticket`` is granted; ``check`` is called about once a second and may raise to give up.
+
+        A caller that gives up through ``check`` still owns the ticket and must release it.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        next_check = time.monotonic()
+        interval = self.poll_interval
+        while not self.poll(ticket):
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                self.release(ticket)
+                raise TimeoutError("Timed out waiting for a free GPU slot")
+            if check is not None and time.monotonic() >= next_check:
+                check()
+                next_check = time.monotonic() + 1.0
+            with self._cond:
+                if not ticket.granted:
+                    self._cond.wait(interval if remaining is None else min(remaining, interval))
+            interval = self.back_off(interval)
+
+    def back_off(self, interval):
+        """The next wait between polls of a ticket that is still waiting."""
+        return min(interval * 2, self.max_poll_interval)
+
+    def release(self, ticket):
+        with self._transaction() as db:
+            db.execute('DELETE FROM slots WHERE id = ?', (ticket.id,))
+            granted = self._dispatch(db, ticket.server_address)
+        with self._cond:
+            self._tickets.pop(ticket.id, None)
+        self._deliver(granted)
+
+    def _dispatch(self, db, server_address):
+        """Grant free slots on ``server_address`` inside transaction ``db``; returns the granted ticket ids."""
+        for (pid,) in db.execute('SELECT DISTINCT pid FROM slots').fetchall():
+            if not process_alive(pid):
+                logger.warning(f"Freeing checkpoint scheduler slots of exited worker {pid}")
+                db.execute('DELETE FROM slots WHERE pid = ?', (pid,))
+        rows = db.execute('SELECT id, ckpt_name, skipped, granted FROM slots WHERE server = ? ORDER BY id',
+                          (server_address,)).fetchall()
+        active = sum(1 for row in rows if row['granted'])
+        waiting = [dict(row) for row in rows if not row['granted']]
+        max_active = current_app.config['SCHEDULER_MAX_ACTIVE']
+        granted = []
+        if not waiting or active >= max_active:
+            return granted
+
+        loaded_row = db.execute('SELECT ckpt_name, swaps FROM loaded WHERE server = ?', (server_address,)).fetchone()
+        loaded = loaded_row['ckpt_name'] if loaded_row else None
+        swaps = loaded_row['swaps'] if loaded_row else 0
+        while waiting and active < max_active:
+            ticket = self._choose(waiting, loaded)
+            passed = waiting[:waiting.index(ticket)]
+            for row in passed:
+                row['skipped'] += 1
+            if passed:
+                db.execute(f"UPDATE slots SET skipped = skipped + 1 WHERE id IN ({','.join('?' * len(passed))})",
+                           [row['id'] for row in passed])
+            waiting.remove(ticket)
+            db.execute('UPDATE slots SET granted = 1 WHERE id = ?', (ticket['id'],))
+            granted.append(ticket['id'])
+            active += 1
+            if ticket['ckpt_name'] is not None:
+                if loaded is not None and loaded != ticket['ckpt_name']:
+                    swaps += 1
+                    logger.info(f"Backend {server_address} swapping checkpoint {loaded} -> {ticket['ckpt_name']}")
+                loaded = ticket['ckpt_name']
+        db.execute('INSERT INTO loaded (server, ckpt_name, swaps) VALUES (?, ?, ?) '
+                   'ON CONFLICT (server) DO UPDATE SET ckpt_name = excluded.ckpt_name, swaps = excluded.swaps',
+                   (server_address, loaded, swaps))
+        return granted
+
+    @staticmethod
+    def _choose(waiting, loaded):
+        oldest = waiting[0]
+        if oldest['skipped'] >= current_app.config['SCHEDULER_MAX_SKIPS']:
+            return oldest
+        return next((row for row in waiting if row['ckpt_name'] == loaded), oldest)
+
+    def _deliver(self, granted):
+        """Mark this process's tickets among ``granted`` as granted and wake their waiters."""
+        with self._cond:
+            for ticket_id in granted:
+                ticket = self._tickets.get(ticket_id)
+                if ticket is None or ticket.granted:
+                    continue
+                ticket.granted = True
+                # Lets the backend pool route later jobs to where this checkpoint is loaded
+                backend_pool.note_checkpoint(ticket.server_address, ticket.ckpt_name)
+                if ticket.on_grant is not None:
+                    ticket.on_grant()
+            self._cond.notify_all()
+
+    def stats(self):
+        with closing(self._connect()) as db:
+            rows = db.execute('SELECT server, granted, COUNT(*) AS count FROM slots GROUP BY server, granted').fetchall()
+            loaded = db.execute('SELECT server, ckpt_name, swaps FROM loaded').fetchall()
+        return {
+            'waiting': {row['server']: row['count'] for row in rows if not row['granted']},
+            'active': {row['server']: row['count'] for row in rows if row['granted']},
+            'loaded': {row['server']: row['ckpt_name'] for row in loaded},
+            'swaps': {row['server']: row['swaps'] for row in loaded},
+        }
+
+
+checkpoint_scheduler = CheckpointScheduler()
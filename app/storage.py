@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import re
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Filename prefix of the outputs of each kind of generation; the kind is also recorded in the sidecar
+PREFIXES = {
+    'text_to_image': 'generated',
+    'image_to_image': 'generated_i2i',
+    'batch_item': 'generated_batch',
+}
+
+_STORED_NAME = re.compile(r'^generated(?:_[a-z0-9]+)?_([0-9a-f]{32})(?:\.[a-z0-9]+)?$')
+
+
+def shard(filename):
+    """Return the subdirectory of a stored output, or '' for files from before the store (kept flat)."""
+    match = _STORED_NAME.match(filename)
+    return match.group(1)[:2] if match else ''
+
+
+def output_path(root, filename):
+    """Path of ``filename`` under ``root``, worked out from the name alone; raises ValueError for unsafe names."""
+    if not filename or filename.startswith('.') or os.path.basename(filename) != filename:
+        raise ValueError(f"Invalid output filename: {filename!r}")
+    return os.path.join(root, shard(filename), filename)
+
+
+def sidecar_path(path):
+    return f"{os.path.splitext(path)[0]}.json"
+
+
+def scan_outputs(root):
+    """Return ``{filename: (size, ctime)}`` for every output under ``root``, sharded or flat."""
+    found = {}
+    if not os.path.isdir(root):
+        return found
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if len(entry.name) != 2:
+                    continue
+                with os.scandir(entry.path) as shard_entries:
+                    candidates = list(shard_entries)
+            else:
+                candidates = [entry]
+            for candidate in candidates:
+                if candidate.name.startswith('generated_') and candidate.name.endswith('.png') \
+                        and candidate.is_file():
+                    stat = candidate.stat()
+                    found[candidate.name] = (stat.st_size, stat.st_ctime)
+    return found
+
+
+class OutputStore:
+    """Where generated images live: ``<static/generated>/<shard>/<prefix>_<id>.png``.
+
+    Every output gets a random 128-bit id, so two requests can never overwrite each other,
+    and the first two hex digits of the id pick one of 256 subdirectories. A filename is
+    enough to find the file and its JSON sidecar (prompt, seed, checkpoint, sampler and
+    stage timings) without listing or querying anything. Images saved before the store
+    existed stay where they are, flat in the root.
+    """
+
+    def __init__(self, app=None):
+        self.root = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.root = os.path.join(app.root_path, 'static', 'generated')
+        app.extensions['output_store'] = self
+
+    def path(self, filename):
+        return output_path(self.root, filename)
+
+    def relative_path(self, filename):
+        return os.path.relpath(self.path(filename), self.root).replace(os.sep, '/')
+
+    def resolve(self, filename):
+        """Return the path of a stored output, or None if there is no such file."""
+        try:
+            path = self.path(filename)
+        except ValueError:
+            return None
+        return path if os.path.isfile(path) else None
+
+    def save(self, image, kind, metadata=None):
+        """Store one pipeline image entry (``path`` or ``image_data``) and its sidecar; returns the new filename."""
+        filename = f"{PREFIXES.get(kind, PREFIXES['text_to_image'])}_{uuid.uuid4().hex}.png"
+        path = self.path(filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if 'path' in image:
+            # Already streamed to disk by the pipeline; just give it its final name
+            os.replace(image['path'], path)
+        else:
+            with open(path, 'wb') as f:
+                f.write(image['image_data'])
+        metadata = metadata or {}
+        # The seed the sampler actually used; a requested -1 becomes the drawn value
+        seed = image.get('seed') if image.get('seed') is not None else metadata.get('seed')
+        sidecar = dict(metadata, kind=kind, seed=seed, source=image.get('file_name'), created=time.time())
+        with open(sidecar_path(path), 'w') as f:
+            json.dump(sidecar, f, separators=(',', ':'))
+        return filename
+
+    def metadata(self, filename):
+        """Return the sidecar of ``filename`` as a dict, or None if it has none (or the name is invalid)."""
+        try:
+            with open(sidecar_path(self.path(filename)), 'r') as f:
+                return json.load(f)
+        except (ValueError, OSError):
+            return None
+
+    def delete(self, filename):
+        """Delete an output and its sidecar; returns False if the image did not exist."""
+        path = self.path(filename)
+        try:
+            os.remove(sidecar_path(path))
+        except FileNotFoundError:
+            pass
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def scan(self):
+        return scan_outputs(self.root)
+
+
+output_store = OutputStore()
@@ -0,0 +1,163 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from app.storage import output_path, scan_outputs, shard
+
+logger = logging.getLogger(__name__)
+
+
+def thumbnail_name(filename):
+    return f"{os.path.splitext(filename)[0]}.webp"
+
+
+def make_thumbnail(source_path, thumb_path, size, quality):
+    """Write a WebP preview of ``source_path`` no larger than ``size`` pixels on a side; returns its byte size.
+
+    Runs in the thumbnail process pool, so it only takes plain arguments.
+    """
+    from PIL import Image
+
+    os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+    tmp_path = f"{thumb_path}.{uuid.uuid4().hex}.part"
+    try:
+        with Image.open(source_path) as image:
+            image.draft('RGB', (size, size))
+            image.thumbnail((size, size))
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+            image.save(tmp_path, 'WEBP', quality=quality, method=4)
+        os.replace(tmp_path, thumb_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return os.path.getsize(thumb_path)
+
+
+class ThumbnailService:
+    """Creates small WebP previews of generated images for the gallery.
+
+    New outputs are thumbnailed in a process pool (``THUMBNAIL_WORKERS`` processes, started
+    lazily in each gunicorn worker) so resizing never holds the GIL of a request thread.
+    With ``THUMBNAIL_WORKERS`` set to 0 thumbnails are made inline instead.
+    """
+
+    def __init__(self, app=None):
+        self.generated_dir = None
+        self.thumbs_dir = None
+        self.size = 384
+        self.quality = 80
+        self.workers = 0
+        self.created = 0
+        self.failed = 0
+        self.seconds = 0.0
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.generated_dir = os.path.join(app.root_path, 'static', 'generated')
+        self.thumbs_dir = app.config['THUMBNAIL_DIR'] or os.path.join(app.root_path, 'static', 'thumbs')
+        self.size = app.config['THUMBNAIL_SIZE']
+        self.quality = app.config['THUMBNAIL_QUALITY']
+        self.workers = app.config['THUMBNAIL_WORKERS']
+        os.makedirs(self.thumbs_dir, exist_ok=True)
+        app.extensions['thumbnails'] = self
+
+    def path(self, filename):
+        # Sharded like the outputs themselves, so no directory grows without bound
+        return os.path.join(self.thumbs_dir, shard(filename), thumbnail_name(filename))
+
+    def _executor(self):
+        with self._lock:
+            # A pool inherited across gunicorn's fork is unusable; start a fresh one per process.
+            # Its workers are spawned, not forked, since forking a threaded worker can copy held locks
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _record(self, started, error=None):
+        with self._lock:
+            if error is None:
+                self.created += 1
+                self.seconds += time.monotonic() - started
+            else:
+                self.failed += 1
+
+    def _args(self, filename):
+        return output_path(self.generated_dir, filename), self.path(filename), self.size, self.quality
+
+    def submit(self, filename):
+        """Queue a thumbnail for a newly saved image; failures are logged, never raised."""
+        started = time.monotonic()
+        if not self.workers:
+            try:
+                make_thumbnail(*self._args(filename))
+                self._record(started)
+            except Exception as e:
+                self._record(started, e)
+                logger.warning(f"Could not create thumbnail for {filename}: {e}")
+            return None
+
+        def done(future):
+            error = future.exception()
+            self._record(started, error)
+            if error is not None:
+                logger.warning(f"Could not create thumbnail for {filename}: {error}")
+
+        future = self._executor().submit(make_thumbnail, *self._args(filename))
+        future.add_done_callback(done)
+        return future
+
+    def ensure(self, filename):
+        """Return the thumbnail path for ``filename``, creating it now if it does not exist yet."""
+        thumb_path = self.path(filename)
+        if not os.path.exists(thumb_path):
+            started = time.monotonic()
+            make_thumbnail(*self._args(filename))
+            self._record(started)
+        return thumb_path
+
+    def remove(self, filename):
+        try:
+            os.remove(self.path(filename))
+        except FileNotFoundError:
+            pass
+
+    def backfill(self, force=False):
+        """Thumbnail every generated image that lacks one; returns (created, failed, elapsed seconds)."""
+        filenames = [name for name in sorted(scan_outputs(self.generated_dir))
+                     if force or not os.path.exists(self.path(name))]
+        created = failed = 0
+        started = time.monotonic()
+        with ProcessPoolExecutor(max_workers=self.workers or None) as pool:
+            futures = {pool.submit(make_thumbnail, *self._args(name)): name for name in filenames}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    created += 1
+                except Exception as e:
+                    failed += 1
+                    logger.warning(f"Could not create thumbnail for {futures[future]}: {e}")
+        elapsed = time.monotonic() - started
+        logger.info(f"Thumbnail backfill: {created} created, {failed} failed in {elapsed:.1f}s")
+        return created, failed, elapsed
+
+    def stats(self):
+        with self._lock:
+            return {
+                'thumbnails_created': self.created,
+                'thumbnails_failed': self.failed,
+                # Time from an image being saved to its thumbnail being ready, queueing included
+                'thumbnail_avg_seconds': round(self.seconds / self.created, 3) if self.created else None,
+            }
+
+
+thumbnails = ThumbnailService()
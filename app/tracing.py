@@ -0,0 +1,94 @@
+import contextvars
+import cProfile
+import logging
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('imagine_trace', default=None)
+
+
+def current():
+    """Return the Trace of the generation running in this context, or None."""
+    return _current.get()
+
+
+class Trace:
+    """Stage timings for one generation, filled in by app.metrics.Stages while it is active.
+
+    With ``profile_dir`` set the generation also runs under cProfile and the stats are
+    written to ``<profile_dir>/<kind>_<trace id>.prof`` (open with pstats or snakeviz).
+    Generations taking ``slow_seconds`` or longer are logged with their full breakdown.
+    """
+
+    def __init__(self, kind, slow_seconds=None, profile_dir=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.slow_seconds = slow_seconds
+        self.profile_dir = profile_dir
+        self.profile_path = None
+        self.spans = []
+        self.started_at = time.perf_counter()
+        self.finished_at = None
+
+    def add(self, stage, seconds):
+        self.spans.append((stage, seconds))
+
+    @property
+    def total(self):
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+    @contextmanager
+    def activate(self):
+        previous = _current.get()
+        _current.set(self)
+        profiler = self._start_profiler()
+        try:
+            yield self
+        finally:
+            if profiler is not None:
+                self._save_profile(profiler)
+            _current.set(previous)
+            self.finish()
+
+    def _start_profiler(self):
+        if self.profile_dir is None:
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Only one profiler can be active per interpreter; another request already has it
+            logger.warning(f"Not profiling {self.kind} request {self.id}: {e}")
+            return None
+        return profiler
+
+    def _save_profile(self, profiler):
+        profiler.disable()
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir, f"{self.kind}_{self.id}.prof")
+            profiler.dump_stats(path)
+            self.profile_path = path
+            logger.info(f"Saved profile of {self.kind} request {self.id} to {path}")
+        except OSError as e:
+            logger.error(f"Failed to save profile of {self.kind} request {self.id}: {e}")
+
+    def finish(self):
+        self.finished_at = time.perf_counter()
+        if self.slow_seconds is not None and self.total >= self.slow_seconds:
+            logger.warning(f"Slow {self.kind} request {self.id} took {self.total:.2f}s: {self.breakdown()}")
+
+    def breakdown(self):
+        return ', '.join(f"{stage}={seconds:.3f}s" for stage, seconds in self.spans)
+
+    def to_dict(self):
+        return {
+            'trace_id': self.id,
+            'total_seconds': round(self.total, 4),
+            'stages': [{'stage': stage, 'seconds': round(seconds, 4)} for stage, seconds in self.spans],
+            'profile': os.path.basename(self.profile_path) if self.profile_path else None,
+        }
@@ -0,0 +1,43 @@
+import hashlib
+import logging
+import os
+import re
+import uuid
+from werkzeug.utils import secure_filename
+
+logger = logging.getLogger(__name__)
+
+_CONTENT_NAME = re.compile(r'^[0-9a-f]{64}\.[a-z0-9]+$')
+
+
+def is_content_addressed(filename):
+    return bool(_CONTENT_NAME.match(os.path.basename(filename)))
+
+
+def save_upload(file_storage, uploads_dir, chunk_size=64 * 1024):
+    """Stream an uploaded file into ``uploads_dir`` under ``<sha256>.<ext>`` and return its path.
+
+    The upload is hashed while it is written, so it is read exactly once; if the same
+    content is already stored, the new copy is dropped and the existing file reused.
+    """
+    ext = os.path.splitext(secure_filename(file_storage.filename or ''))[1].lower().lstrip('.') or 'png'
+    os.makedirs(uploads_dir, exist_ok=True)
+    tmp_path = os.path.join(uploads_dir, f".{uuid.uuid4().hex}.part")
+    digest = hashlib.sha256()
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in iter(lambda: file_storage.stream.read(chunk_size), b''):
+                digest.update(chunk)
+                f.write(chunk)
+        path = os.path.join(uploads_dir, f"{digest.hexdigest()}.{ext}")
+        if os.path.exists(path):
+            logger.info(f"Upload already stored as {os.path.basename(path)}")
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+            logger.info(f"Upload stored as {os.path.basename(path)}")
+        return path
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
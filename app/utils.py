@@ -2,18 +2,102 @@ import json
 import logging
 import random
 import os
+import queue
+import threading
+import time
 import websocket
 import requests
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from flask import current_app
 from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
 from requests_toolbelt import MultipartEncoder
+from urllib3.util.retry import Retry
+from app.backends import backend_pool, parse_backend_urls
+from app import cancellation
+from app.cache import result_cache
+from app.cancellation import Cancelled, PromptWatch, record_cancellation, record_execution
+from app.coalesce import single_flight
+from app.metrics import Stages, count_bytes
+from app.previews import PreviewThrottle
+from app.scheduler import checkpoint_scheduler, checkpoint_of
+from app.uploads import is_content_addressed
+from app.websocket_manager import get_websocket_manager
+from app.workflows import WorkflowTemplate
 
 logger = logging.getLogger(__name__)
 
+_sessions = {}
+_probe_sessions = {}
+_sessions_lock = threading.Lock()
+# (server_address, name) of content-addressed inputs this process knows a backend already has
+_uploaded_inputs = set()
+
+
+class PromptFailed(RuntimeError):
+    """ComfyUI reported that a prompt failed or was interrupted."""
+
+
+class ComfyUISession(requests.Session):
+    """requests.Session that applies a default (connect, read) timeout to every call."""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def get_session():
+    """Return this process's pooled keep-alive session for ComfyUI REST calls.
+
+    Idempotent GETs are retried on connection errors and 502/503/504; POSTs are not.
+    """
+    pid = os.getpid()
+    session = _sessions.get(pid)
+    if session is not None:
+        return session
+    with _sessions_lock:
+        session = _sessions.get(pid)
+        if session is None:
+            config = current_app.config
+            session = ComfyUISession((config['COMFYUI_CONNECT_TIMEOUT'], config['COMFYUI_READ_TIMEOUT']))
+            retry = Retry(total=config['COMFYUI_GET_RETRIES'], backoff_factor=0.3,
+                          status_forcelist=(502, 503, 504), allowed_methods=frozenset(['GET']))
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config['COMFYUI_POOL_SIZE'], max_retries=retry)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[pid] = session
+    return session
+
+
+def get_probe_session():
+    """Return this process's session for backend health probes.
+
+    Probes run while a job waits to be routed, so they get ``BACKEND_PROBE_TIMEOUT`` and no
+    retries: a backend that does not answer at once is skipped rather than waited on.
+    """
+    pid = os.getpid()
+    session = _probe_sessions.get(pid)
+    if session is not None:
+        return session
+    with _sessions_lock:
+        session = _probe_sessions.get(pid)
+        if session is None:
+            config = current_app.config
+            session = ComfyUISession(config['BACKEND_PROBE_TIMEOUT'])
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config['COMFYUI_POOL_SIZE'], max_retries=0)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _probe_sessions[pid] = session
+    return session
+
 
 def open_websocket_connection():
-    server_address = current_app.config['COMFYUI_URL']
+    server_address = parse_backend_urls(current_app.config['COMFYUI_URL'])[0]
     client_id = str(uuid.uuid4())
     ws = websocket.WebSocket()
     ws_url = f"ws://{server_address.replace('http://', '')}/ws?clientId={client_id}"
@@ -34,7 +118,7 @@ def queue_prompt(prompt, client_id, server_address):
     headers = {'Content-Type': 'application/json'}
     logger.debug(f"Queueing prompt: URL={url}, Data={data}")
     try:
-        response = requests.post(url, data=data, headers=headers)
+        response = get_session().post(url, data=data, headers=headers)
         response.raise_for_status()
         response_data = response.json()
         logger.info(f"Prompt queued successfully: {response_data}")
@@ -47,20 +131,61 @@ def queue_prompt(prompt, client_id, server_address):
         raise
 
 
+def cancel_prompt(prompt_id, server_address, running):
+    """Take ``prompt_id`` off ``server_address``: delete it from the queue, or interrupt it once it is executing.
+
+    ``/interrupt`` carries the prompt id so ComfyUI versions that accept it stop only that
+    prompt. It is never sent for a prompt that has not started, since older versions stop
+    whatever is running.
+    """
+    session = get_session()
+    if running:
+        response = session.post(f"{server_address}/interrupt", json={'prompt_id': prompt_id})
+    else:
+        response = session.post(f"{server_address}/queue", json={'delete': [prompt_id]})
+    response.raise_for_status()
+
+
 def get_image(filename, subfolder, folder_type, server_address):
     params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
     url = f"{server_address}/view?{urlencode(params)}"
     logger.debug(f"Fetching image: URL={url}")
     try:
-        response = requests.get(url)
+        response = get_session().get(url)
         response.raise_for_status()
         logger.info(f"Image fetched successfully: {filename}")
+        count_bytes('download', len(response.content))
         return response.content
     except requests.RequestException as e:
         logger.error(f"Failed to fetch image: {e}")
         raise
 
 
+def save_image(filename, subfolder, folder_type, server_address, dest_path, chunk_size=64 * 1024):
+    """Stream an output image from ComfyUI straight to ``dest_path`` without buffering it in memory."""
+    params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+    url = f"{server_address}/view?{urlencode(params)}"
+    tmp_path = f"{dest_path}.part"
+    logger.debug(f"Streaming image: URL={url} -> {dest_path}")
+    try:
+        with get_session().get(url, stream=True) as response:
+            response.raise_for_status()
+            size = 0
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    size += len(chunk)
+        os.replace(tmp_path, dest_path)
+        logger.info(f"Image saved successfully: {filename} ({size} bytes)")
+        count_bytes('download', size)
+        return size
+    except (IOError, requests.RequestException) as e:
+        logger.error(f"Failed to save image: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
 def upload_image(input_path, name, server_address, image_type="input", overwrite=False):
     logger.debug(f"Uploading image: {input_path}")
     try:
@@ -72,20 +197,53 @@ def upload_image(input_path, name, server_address, image_type="input", overwrite
             })
             headers = {'Content-Type': form.content_type}
             url = f"{server_address}/upload/image"
-            response = requests.post(url, data=form, headers=headers)
+            response = get_session().post(url, data=form, headers=headers)
             response.raise_for_status()
             logger.info(f"Image uploaded successfully: {name}")
+            count_bytes('upload', os.path.getsize(input_path))
             return response.content
     except (IOError, requests.RequestException) as e:
         logger.error(f"Failed to upload image: {e}")
         raise
 
 
+def input_image_exists(name, server_address):
+    """Return True if ComfyUI's input folder on ``server_address`` already holds ``name``."""
+    params = {"filename": name, "subfolder": "", "type": "input"}
+    try:
+        response = get_session().head(f"{server_address}/view?{urlencode(params)}")
+        return response.status_code == 200
+    except requests.RequestException as e:
+        logger.debug(f"Could not check for input image {name}: {e}")
+        return False
+
+
+def ensure_uploaded(input_path, name, server_address):
+    """Upload ``input_path`` as ``name`` unless the backend already has it.
+
+    Only content-addressed names (``<sha256>.<ext>``) are skipped, since for those an
+    existing file with the same name is guaranteed to have the same bytes.
+    """
+    if is_content_addressed(name):
+        key = (server_address, name)
+        if key in _uploaded_inputs:
+            logger.debug(f"Input image already on backend: {name}")
+            return False
+        if input_image_exists(name, server_address):
+            logger.info(f"Skipping upload, backend already has {name}")
+            _uploaded_inputs.add(key)
+            return False
+    upload_image(input_path, name, server_address)
+    if is_content_addressed(name):
+        _uploaded_inputs.add((server_address, name))
+    return True
+
+
 def get_history(prompt_id, server_address):
     url = f"{server_address}/history/{prompt_id}"
     logger.debug(f"Fetching history: URL={url}")
     try:
-        response = requests.get(url)
+        response = get_session().get(url)
         response.raise_for_status()
         history = response.json()
         logger.info(f"History fetched successfully for prompt {prompt_id}")
@@ -96,68 +254,186 @@ def get_history(prompt_id, server_address):
         raise
 
 
-def track_progress(prompt, ws, prompt_id):
+def _progress_event(out, node_ids, prompt_id, finished_nodes):
+    """Interpret one WebSocket message for ``prompt_id``.
+
+    Returns ``(progress, started, finished)``: a progress string to report (or None),
+    whether ComfyUI just started executing the prompt, and whether it has finished.
+    ``finished_nodes`` is updated in place.
+    """
+    if not isinstance(out, str):
+        # Binary preview frames; track_progress forwards them when previews are wanted
+        return None, False, False
+
+    message = json.loads(out)
+    logger.debug(f"Parsed WebSocket message: {message}")
+    if message['type'] == 'progress':
+        data = message['data']
+        return f"Progress: Step {data['value']} of {data['max']}", False, False
+    elif message['type'] in ['execution_start', 'execution_cached', 'executing']:
+        data = message['data']
+        if message['type'] == 'execution_start' and data.get('prompt_id') == prompt_id:
+            return None, True, False
+        elif 'node' in data:
+            progress = None
+            if data['node'] is not None and data['node'] not in finished_nodes:
+                finished_nodes.append(data['node'])
+                progress = f"Progress: {len(finished_nodes)}/{len(node_ids)} tasks done"
+            if data['node'] is None and data['prompt_id'] == prompt_id:
+                logger.info(f"Prompt {prompt_id} execution completed")
+                return progress, False, True
+            return progress, False, False
+        elif 'nodes' in data:
+            # Handle batch node execution
+            for node in data['nodes']:
+                if node not in finished_nodes:
+                    finished_nodes.append(node)
+            finished = set(finished_nodes) == set(node_ids) and data['prompt_id'] == prompt_id
+            if finished:
+                logger.info(f"Prompt {prompt_id} execution completed")
+            return f"Progress: {len(finished_nodes)}/{len(node_ids)} tasks done", False, finished
+        else:
+            logger.warning(f"Unexpected message structure: {data}")
+    elif message['type'] in ('execution_error', 'execution_interrupted'):
+        data = message['data']
+        if data.get('prompt_id') == prompt_id:
+            detail = data.get('exception_message') or 'interrupted'
+            raise PromptFailed(f"ComfyUI reported {message['type']} for prompt {prompt_id}: {detail}")
+    elif message['type'] == 'executed':
+        if 'prompt_id' in message['data'] and message['data']['prompt_id'] == prompt_id:
+            logger.info(f"Prompt {prompt_id} execution completed")
+            return None, False, True
+    return None, False, False
+
+
+def track_progress(prompt, ws, prompt_id, on_start=None, previews=None):
+    """Yield progress strings for ``prompt_id`` until it finishes; ``on_start`` is called when ComfyUI begins executing it.
+
+    Errors (a lost connection, a failed prompt) are raised rather than retried here. While a
+    CancelScope is active, each wait for a message wakes up at least once a second to check it
+    and Cancelled is raised once the generation is cancelled or past its deadline. With a
+    PreviewThrottle as ``previews``, ComfyUI's binary preview frames are yielded as Preview
+    items at the throttle's rate; otherwise they are ignored.
+    """
     node_ids = list(prompt.keys())
     finished_nodes = []
+    scope = cancellation.current()
 
     logger.debug(f"Tracking progress for prompt_id: {prompt_id}")
     logger.debug(f"Node IDs in prompt: {node_ids}")
 
     while True:
         try:
-            out = ws.recv()
-            logger.debug(f"Received WebSocket message: {out}")
-            if isinstance(out, str):
-                message = json.loads(out)
-                logger.debug(f"Parsed WebSocket message: {message}")
-                if message['type'] == 'progress':
-                    data = message['data']
-                    yield f"Progress: Step {data['value']} of {data['max']}"
-                elif message['type'] in ['execution_start', 'execution_cached', 'executing']:
-                    data = message['data']
-                    if 'node' in data:
-                        if data['node'] is not None and data['node'] not in finished_nodes:
-                            finished_nodes.append(data['node'])
-                            yield f"Progress: {len(finished_nodes)}/{len(node_ids)} tasks done"
-                        if data['node'] is None and data['prompt_id'] == prompt_id:
-                            logger.info(f"Prompt {prompt_id} execution completed")
-                            break
-                    elif 'nodes' in data:
-                        # Handle batch node execution
-                        for node in data['nodes']:
-                            if node not in finished_nodes:
-                                finished_nodes.append(node)
-                        yield f"Progress: {len(finished_nodes)}/{len(node_ids)} tasks done"
-                        if set(finished_nodes) == set(node_ids) and data['prompt_id'] == prompt_id:
-                            logger.info(f"Prompt {prompt_id} execution completed")
-                            break
-                    else:
-                        logger.warning(f"Unexpected message structure: {data}")
-                elif message['type'] == 'executed':
-                    if 'prompt_id' in message['data'] and message['data']['prompt_id'] == prompt_id:
-                        logger.info(f"Prompt {prompt_id} execution completed")
-                        break
+            if scope is not None:
+                scope.check()
+                try:
+                    out = ws.recv(timeout=scope.poll_timeout())
+                except queue.Empty:
+                    continue
             else:
-                logger.warning(f"Received non-string WebSocket message: {out}")
+                out = ws.recv()
+            logger.debug(f"Received WebSocket message: {out!r:.200}")
+            preview = None
+            if previews is not None and isinstance(out, bytes):
+                frame = previews.take(out)
+                if frame is not None:
+                    preview = previews.render(frame)
+            progress, started, finished = _progress_event(out, node_ids, prompt_id, finished_nodes)
+        except Cancelled:
+            raise
         except Exception as e:
             logger.error(f"Error during progress tracking: {e}")
-            yield f"Error: {str(e)}"
+            raise
+        if preview is not None:
+            yield preview
+        if started and on_start is not None:
+            on_start()
+        if progress is not None:
+            yield progress
+        if finished:
+            break
 
 
-def generate_image(workflow, positive_prompt, negative_prompt='', steps=20, cfg=8, sampler_name='euler',
-                   scheduler='normal', denoise=1, ckpt_name='SD15/cyberrealistic_classicV31.safetensors',
-                   width=512, height=512, batch_size=1, save_previews=False):
-    prompt = json.loads(workflow)
-    id_to_class_type = {id: details['class_type'] for id, details in prompt.items()}
+def _as_template(workflow):
+    """Accept either a WorkflowTemplate from the registry or a raw workflow JSON string."""
+    if isinstance(workflow, WorkflowTemplate):
+        return workflow
+    return WorkflowTemplate.from_json(workflow)
 
-    # Update node #3 (KSampler)
-    k_sampler = next((key for key, value in id_to_class_type.items() if value == 'KSampler'), None)
-    if k_sampler is None:
-        logger.error("KSampler not found in the workflow")
-        raise ValueError("KSampler not found in the workflow")
 
+def _draw_seed(prompt, k_sampler):
+    inputs = prompt[k_sampler]['inputs']
+    if inputs['seed'] == -1:
+        inputs['seed'] = random.randint(10 ** 14, 10 ** 15 - 1)
+
+
+def _tag_seed(images, prompt):
+    """Record the sampler seed the images were made with, so the output store can keep it."""
+    seed = next((node['inputs']['seed'] for node in prompt.values()
+                 if isinstance(node.get('inputs', {}).get('seed'), int)), None)
+    for image in images:
+        image['seed'] = seed
+
+
+def _generation_keys(request_key, seed):
+    """Return ``(coalesce_key, cache_key)`` for a bound request, each None where that does not apply."""
+    coalesce_key = request_key if current_app.config['COALESCE_ENABLED'] else None
+    # Only an explicit seed makes the output reproducible, so only then is it worth caching
+    cache_key = request_key if seed != -1 else None
+    return coalesce_key, cache_key
+
+
+def _coalesced_generation(request_key, seed, output_dir, make_generator):
+    """Run a generation through single-flight coalescing and, for explicit seeds, the result cache."""
+    coalesce_key, cache_key = _generation_keys(request_key, seed)
+
+    def run():
+        return _cached_generation(cache_key, output_dir, make_generator)
+
+    if coalesce_key is None:
+        yield from run()
+        return
+    yield from single_flight.run(coalesce_key, run)
+
+
+def _cached_generation(cache_key, output_dir, make_generator):
+    """Serve a generation from the result cache when possible, otherwise run it and store the outputs."""
+    if cache_key is not None:
+        images = result_cache.get(cache_key, output_dir)
+        if images is not None:
+            yield f"Cache hit: reusing stored result {cache_key[:12]}"
+            yield images
+            return
+
+    images = []
+    for item in make_generator():
+        if isinstance(item, list):
+            images = item
+        else:
+            yield item
+
+    if cache_key is not None and images:
+        result_cache.put(cache_key, images)
+
+    logger.info(f"Generated {len(images)} images")
+    yield images
+
+
+def _bind_text_to_image(workflow, positive_prompt, negative_prompt='', seed=-1, steps=20, cfg=8,
+                        sampler_name='euler', scheduler='normal', denoise=1,
+                        ckpt_name='SD15/cyberrealistic_classicV31.safetensors', width=512, height=512,
+                        batch_size=1):
+    """Bind text-to-image parameters into a copy of ``workflow``.
+
+    Returns ``(template, prompt, request_key)``; the key is taken before a random seed is drawn.
+    """
+    template = _as_template(workflow)
+    prompt = template.copy()
+
+    # Update node #3 (KSampler)
+    k_sampler = template.node_id('KSampler')
     prompt[k_sampler]['inputs'].update({
-        'seed': random.randint(10 ** 14, 10 ** 15 - 1),
+        'seed': seed,
         'steps': steps,
         'cfg': cfg,
         'sampler_name': sampler_name,
@@ -166,66 +442,43 @@ def generate_image(workflow, positive_prompt, negative_prompt='', steps=20, cfg=
     })
 
     # Update node #4 (CheckpointLoaderSimple)
-    checkpoint_loader = next((key for key, value in id_to_class_type.items() if value == 'CheckpointLoaderSimple'),
-                             None)
-    if checkpoint_loader is None:
-        logger.error("CheckpointLoaderSimple not found in the workflow")
-        raise ValueError("CheckpointLoaderSimple not found in the workflow")
-
-    prompt[checkpoint_loader]['inputs']['ckpt_name'] = ckpt_name
+    prompt[template.node_id('CheckpointLoaderSimple')]['inputs']['ckpt_name'] = ckpt_name
 
     # Update node #5 (EmptyLatentImage)
-    empty_latent = next((key for key, value in id_to_class_type.items() if value == 'EmptyLatentImage'), None)
-    if empty_latent is None:
-        logger.error("EmptyLatentImage not found in the workflow")
-        raise ValueError("EmptyLatentImage not found in the workflow")
-
-    prompt[empty_latent]['inputs'].update({
+    prompt[template.node_id('EmptyLatentImage')]['inputs'].update({
         'width': width,
         'height': height,
         'batch_size': batch_size
     })
 
     # Update prompts
-    positive_input_id = prompt[k_sampler]['inputs']['positive'][0]
-    prompt[positive_input_id]['inputs']['text'] = positive_prompt
+    prompt[template.positive_id]['inputs']['text'] = positive_prompt
 
     if negative_prompt:
-        negative_input_id = prompt[k_sampler]['inputs']['negative'][0]
-        prompt[negative_input_id]['inputs']['text'] = negative_prompt
+        prompt[template.negative_id]['inputs']['text'] = negative_prompt
 
     logger.info(
         f"Generating image with parameters: positive_prompt={positive_prompt}, negative_prompt={negative_prompt}, "
-        f"steps={steps}, cfg={cfg}, sampler_name={sampler_name}, scheduler={scheduler}, denoise={denoise}, "
+        f"seed={seed}, steps={steps}, cfg={cfg}, sampler_name={sampler_name}, scheduler={scheduler}, denoise={denoise}, "
         f"ckpt_name={ckpt_name}, width={width}, height={height}, batch_size={batch_size}")
 
-    image_generator = generate_image_by_prompt(prompt, save_previews)
-
-    images = []
-    for item in image_generator:
-        if isinstance(item, str):
-            yield item
-        elif isinstance(item, list):
-            images = item
-
-    logger.info(f"Generated {len(images)} images")
-    yield images
+    # Hash the prompt before a random seed is drawn, so identical "any seed" requests coalesce
+    request_key = result_cache.key(prompt)
+    _draw_seed(prompt, k_sampler)
+    return template, prompt, request_key
 
 
-def generate_image_to_image(workflow, input_path, positive_prompt, negative_prompt='', seed=-1, steps=20, cfg=8,
-                            sampler_name='euler_ancestral', scheduler='karras', denoise=0.8,
-                            ckpt_name='SDXL/juggernautXL_version5.safetensors', save_previews=False):
-    prompt = json.loads(workflow)
-    id_to_class_type = {id: details['class_type'] for id, details in prompt.items()}
+def _bind_image_to_image(workflow, input_path, positive_prompt, negative_prompt='', seed=-1, steps=20, cfg=8,
+                         sampler_name='euler_ancestral', scheduler='karras', denoise=0.8,
+                         ckpt_name='SDXL/juggernautXL_version5.safetensors'):
+    """Bind image-to-image parameters like _bind_text_to_image; returns ``(template, prompt, request_key)``."""
+    template = _as_template(workflow)
+    prompt = template.copy()
 
     # Update node #3 (KSampler)
-    k_sampler = next((key for key, value in id_to_class_type.items() if value == 'KSampler'), None)
-    if k_sampler is None:
-        logger.error("KSampler not found in the workflow")
-        raise ValueError("KSampler not found in the workflow")
-
+    k_sampler = template.node_id('KSampler')
     prompt[k_sampler]['inputs'].update({
-        'seed': seed if seed != -1 else random.randint(10 ** 14, 10 ** 15 - 1),
+        'seed': seed,
         'steps': steps,
         'cfg': cfg,
         'sampler_name': sampler_name,
@@ -234,120 +487,243 @@ def generate_image_to_image(workflow, input_path, positive_prompt, negative_prom
     })
 
     # Update node #4 (CheckpointLoaderSimple)
-    checkpoint_loader = next((key for key, value in id_to_class_type.items() if value == 'CheckpointLoaderSimple'),
-                             None)
-    if checkpoint_loader is None:
-        logger.error("CheckpointLoaderSimple not found in the workflow")
-        raise ValueError("CheckpointLoaderSimple not found in the workflow")
-
-    prompt[checkpoint_loader]['inputs']['ckpt_name'] = ckpt_name
+    prompt[template.node_id('CheckpointLoaderSimple')]['inputs']['ckpt_name'] = ckpt_name
 
     # Update prompts
-    positive_input_id = prompt[k_sampler]['inputs']['positive'][0]
-    prompt[positive_input_id]['inputs']['text'] = positive_prompt
+    prompt[template.positive_id]['inputs']['text'] = positive_prompt
 
     if negative_prompt:
-        negative_input_id = prompt[k_sampler]['inputs']['negative'][0]
-        prompt[negative_input_id]['inputs']['text'] = negative_prompt
+        prompt[template.negative_id]['inputs']['text'] = negative_prompt
 
     # Update input image
-    image_loader = next((key for key, value in id_to_class_type.items() if value == 'LoadImage'), None)
-    if image_loader is None:
-        logger.error("LoadImage not found in the workflow")
-        raise ValueError("LoadImage not found in the workflow")
-
     filename = os.path.basename(input_path)
-    prompt[image_loader]['inputs']['image'] = filename
+    prompt[template.node_id('LoadImage')]['inputs']['image'] = filename
 
     logger.info(f"Generating image-to-image with input: {input_path}, positive prompt: {positive_prompt}, "
                 f"negative prompt: {negative_prompt}, seed: {seed}, steps: {steps}, cfg: {cfg}, "
                 f"sampler_name: {sampler_name}, scheduler: {scheduler}, denoise: {denoise}, "
                 f"ckpt_name: {ckpt_name}")
 
-    image_generator = generate_image_by_prompt_and_image(prompt, input_path, filename, save_previews)
+    # A content-addressed input name already pins the image bytes, so there is no need to re-hash the file
+    request_key = result_cache.key(prompt, None if is_content_addressed(filename) else input_path)
+    _draw_seed(prompt, k_sampler)
+    return template, prompt, request_key
 
-    images = []
-    for item in image_generator:
-        if isinstance(item, str):
-            yield item
-        elif isinstance(item, list):
-            images = item
 
-    logger.info(f"Generated {len(images)} images")
-    yield images
+def generate_image(workflow, positive_prompt, negative_prompt='', seed=-1, steps=20, cfg=8, sampler_name='euler',
+                   scheduler='normal', denoise=1, ckpt_name='SD15/cyberrealistic_classicV31.safetensors',
+                   width=512, height=512, batch_size=1, save_previews=False, output_dir=None, live_previews=False):
+    template, prompt, request_key = _bind_text_to_image(
+        workflow, positive_prompt, negative_prompt, seed, steps, cfg, sampler_name, scheduler, denoise, ckpt_name,
+        width, height, batch_size)
 
+    yield from _coalesced_generation(
+        request_key, seed, output_dir,
+        lambda: generate_image_by_prompt(prompt, save_previews, output_dir, workflow=template.name,
+                                         live_previews=live_previews))
 
-def generate_image_by_prompt(prompt, save_previews=False):
-    ws, server_address, client_id = open_websocket_connection()
-    try:
-        prompt_id = queue_prompt(prompt, client_id, server_address)
-        yield f"Prompt queued with ID: {prompt_id}"
 
-        for progress in track_progress(prompt, ws, prompt_id):
-            yield progress
+def generate_image_to_image(workflow, input_path, positive_prompt, negative_prompt='', seed=-1, steps=20, cfg=8,
+                            sampler_name='euler_ancestral', scheduler='karras', denoise=0.8,
+                            ckpt_name='SDXL/juggernautXL_version5.safetensors', save_previews=False,
+                            output_dir=None, live_previews=False):
+    template, prompt, request_key = _bind_image_to_image(
+        workflow, input_path, positive_prompt, negative_prompt, seed, steps, cfg, sampler_name, scheduler, denoise,
+        ckpt_name)
+    filename = os.path.basename(input_path)
+
+    yield from _coalesced_generation(
+        request_key, seed, output_dir,
+        lambda: generate_image_by_prompt_and_image(prompt, input_path, filename, save_previews, output_dir,
+                                                   workflow=template.name, live_previews=live_previews))
 
-        history = get_history(prompt_id, server_address)
+
+def _run_prompt(prompt, server_address, ckpt_name, stages, save_previews, output_dir, before_queue=None,
+                live_previews=False):
+    """Queue ``prompt`` on ``server_address`` and yield progress strings followed by the fetched images.
+
+    Shared by generate_image_by_prompt and generate_image_by_prompt_and_image; each stage is
+    timed into ``stages``. With ``save_previews``, ComfyUI's temp images are kept along with the
+    outputs; with ``live_previews``, latent previews are yielded as Preview items while the prompt runs.
+    """
+    subscription = None
+    ticket = None
+    try:
+        with stages.stage('ws_connect'):
+            ws_manager = get_websocket_manager(server_address)
+        if before_queue is not None:
+            before_queue()
+        ticket = checkpoint_scheduler.request(server_address, ckpt_name)
+        if not ticket.granted:
+            yield "Waiting for a free GPU slot"
+            with stages.stage('slot_wait'):
+                checkpoint_scheduler.wait(ticket, check=cancellation.check)
+        with stages.stage('queue_prompt'):
+            prompt_id = queue_prompt(prompt, ws_manager.client_id, server_address)
+        subscription = ws_manager.subscribe(prompt_id)
+        queued_at = time.perf_counter()
+        watch = PromptWatch(prompt_id, ckpt_name)
+        previews = PreviewThrottle.from_config() if live_previews else None
+
+        def on_start():
+            watch.start()
+            stages.observe('comfy_queue_wait', watch.started_at - queued_at)
+
+        try:
+            yield f"Prompt queued with ID: {prompt_id}"
+            for progress in track_progress(prompt, subscription, prompt_id, on_start=on_start, previews=previews):
+                if isinstance(progress, str):
+                    watch.progress(progress)
+                yield progress
+        except PromptFailed:
+            raise
+        except BaseException as e:
+            # Cancelled, past its deadline, dropped by the client or lost track of: nobody will collect it
+            _abandon_prompt(watch, server_address, e)
+            raise
+        execution = time.perf_counter() - (watch.started_at or queued_at)
+        stages.observe('execution', execution)
+        record_execution(ckpt_name, execution)
+        checkpoint_scheduler.release(ticket)
+        ticket = None
+
+        with stages.stage('history_fetch'):
+            history = get_history(prompt_id, server_address)
         if prompt_id not in history:
             logger.error(f"No history found for prompt ID: {prompt_id}")
             yield f"Error: No history found for prompt ID: {prompt_id}"
             yield []
             return
 
-        images = get_images_from_history(history[prompt_id], server_address, save_previews)
+        with stages.stage('image_download'):
+            images = get_images_from_history(history[prompt_id], server_address, save_previews, output_dir)
+        _tag_seed(images, prompt)
         if not images:
             logger.warning(f"No images generated for prompt ID: {prompt_id}")
             yield "Warning: No images were generated"
+        failed = [image for image in images if 'error' in image]
+        if failed:
+            yield f"Warning: {len(failed)} of {len(images)} images could not be downloaded"
         yield images
+    finally:
+        if ticket is not None:
+            checkpoint_scheduler.release(ticket)
+        if subscription is not None:
+            subscription.close()
+
+
+def _abandon_reason(error):
+    if isinstance(error, Cancelled):
+        return error.reason
+    # The consumer closed the generator: the client went away
+    return 'abandoned' if isinstance(error, GeneratorExit) else 'error'
+
+
+def _abandon_prompt(watch, server_address, error):
+    """Take a prompt whose results nobody will collect off its backend, so the GPU moves on."""
+    try:
+        cancel_prompt(watch.prompt_id, server_address, watch.running)
+    except Exception as e:
+        logger.warning(f"Could not cancel prompt {watch.prompt_id} on {server_address}: {e}")
+        return
+    record_cancellation(watch, _abandon_reason(error), server_address)
+
+
+def generate_image_by_prompt(prompt, save_previews=False, output_dir=None, workflow=None, live_previews=False):
+    ckpt_name = checkpoint_of(prompt)
+    stages = Stages(workflow, ckpt_name)
+    # Every leg of this job (upload, queue, progress, fetch) stays on the backend picked here
+    server_address = backend_pool.acquire(ckpt_name)
+    try:
+        with stages.in_flight():
+            yield from _run_prompt(prompt, server_address, ckpt_name, stages, save_previews, output_dir,
+                                   live_previews=live_previews)
     except Exception as e:
         logger.error(f"Error in generate_image_by_prompt: {e}")
+        stages.error(e)
+        if isinstance(e, (ConnectionError, requests.ConnectionError, requests.Timeout)):
+            backend_pool.mark_failed(server_address, e)
         yield f"Error: {str(e)}"
         yield []
     finally:
-        ws.close()
+        backend_pool.release(server_address)
 
 
-def generate_image_by_prompt_and_image(prompt, input_path, filename, save_previews=False):
-    ws, server_address, client_id = open_websocket_connection()
-    try:
-        upload_image(input_path, filename, server_address)
-        prompt_id = queue_prompt(prompt, client_id, server_address)
-        yield f"Prompt queued with ID: {prompt_id}"
+def generate_image_by_prompt_and_image(prompt, input_path, filename, save_previews=False, output_dir=None,
+                                       workflow=None, live_previews=False):
+    ckpt_name = checkpoint_of(prompt)
+    stages = Stages(workflow, ckpt_name)
+    # Every leg of this job (upload, queue, progress, fetch) stays on the backend picked here
+    server_address = backend_pool.acquire(ckpt_name)
 
-        for progress in track_progress(prompt, ws, prompt_id):
-            yield progress
-
-        history = get_history(prompt_id, server_address)
-        if prompt_id not in history:
-            logger.error(f"No history found for prompt ID: {prompt_id}")
-            yield f"Error: No history found for prompt ID: {prompt_id}"
-            yield []
-            return
+    def upload():
+        with stages.stage('upload'):
+            ensure_uploaded(input_path, filename, server_address)
 
-        images = get_images_from_history(history[prompt_id], server_address, save_previews)
-        if not images:
-            logger.warning(f"No images generated for prompt ID: {prompt_id}")
-            yield "Warning: No images were generated"
-        yield images
+    try:
+        with stages.in_flight():
+            yield from _run_prompt(prompt, server_address, ckpt_name, stages, save_previews, output_dir,
+                                   before_queue=upload, live_previews=live_previews)
     except Exception as e:
         logger.error(f"Error in generate_image_by_prompt_and_image: {e}")
+        stages.error(e)
+        if isinstance(e, (ConnectionError, requests.ConnectionError, requests.Timeout)):
+            backend_pool.mark_failed(server_address, e)
         yield f"Error: {str(e)}"
         yield []
     finally:
-        ws.close()
+        backend_pool.release(server_address)
+
 
+def get_images_from_history(history, server_address, allow_preview=False, output_dir=None):
+    """Fetch every output image listed in a prompt's history, in output order.
 
-def get_images_from_history(history, server_address, allow_preview=False):
-    output_images = []
+    Downloads run concurrently on up to ``COMFYUI_FETCH_WORKERS`` threads. An image that
+    fails to download is returned with ``image_data`` None and an ``error`` message
+    instead of aborting the rest of the batch.
+
+    With ``output_dir`` set, each image is streamed to a uniquely named file in that
+    directory and its entry carries a ``path`` instead of ``image_data``.
+    """
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    wanted = []
     for node_id in history['outputs']:
         node_output = history['outputs'][node_id]
         if 'images' in node_output:
             for image in node_output['images']:
                 if (allow_preview and image['type'] == 'temp') or image['type'] == 'output':
-                    image_data = get_image(image['filename'], image['subfolder'], image['type'], server_address)
-                    output_images.append({
-                        'image_data': image_data,
-                        'file_name': image['filename'],
-                        'type': image['type']
-                    })
-    logger.info(f"Retrieved {len(output_images)} images from history")
-    return output_images
\ No newline at end of file
+                    wanted.append(image)
+
+    app = current_app._get_current_object()
+
+    def fetch(image):
+        entry = {'image_data': None, 'file_name': image['filename'], 'type': image['type']}
+        try:
+            with app.app_context():
+                if output_dir is not None:
+                    tmp_name = f".{uuid.uuid4().hex}_{os.path.basename(image['filename'])}"
+                    dest_path = os.path.join(output_dir, tmp_name)
+                    save_image(image['filename'], image['subfolder'], image['type'], server_address, dest_path)
+                    entry['path'] = dest_path
+                else:
+                    entry['image_data'] = get_image(image['filename'], image['subfolder'], image['type'],
+                                                    server_address)
+        except Exception as e:
+            entry['error'] = str(e)
+        return entry
+
+    if len(wanted) <= 1:
+        output_images = [fetch(image) for image in wanted]
+    else:
+        max_workers = min(len(wanted), current_app.config['COMFYUI_FETCH_WORKERS'])
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fetch') as executor:
+            output_images = list(executor.map(fetch, wanted))
+
+    failed = [image for image in output_images if 'error' in image]
+    if failed:
+        logger.error(f"Failed to retrieve {len(failed)} of {len(output_images)} images: "
+                     f"{[image['error'] for image in failed]}")
+    logger.info(f"Retrieved {len(output_images) - len(failed)} images from history")
+    return output_images
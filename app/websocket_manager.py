@@ -0,0 +1,184 @@
+import json
+import logging
+import os
+import queue
+import threading
+import uuid
+from collections import OrderedDict
+import websocket
+from app.previews import frame_prompt_id
+
+logger = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = 10
+RECONNECT_BACKOFF_INITIAL = 0.5
+RECONNECT_BACKOFF_MAX = 30
+# Messages that arrive for a prompt before anyone has subscribed to it (the window between
+# ComfyUI accepting /prompt and the caller subscribing) are held here, bounded per process.
+MAX_PENDING_PROMPTS = 64
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+class Subscription:
+    """Per-prompt message queue; ``recv()`` mirrors ``websocket.WebSocket.recv()``."""
+
+    def __init__(self, manager, prompt_id):
+        self.manager = manager
+        self.prompt_id = prompt_id
+        self.queue = queue.Queue()
+
+    def recv(self, timeout=None):
+        item = self.queue.get(timeout=timeout)
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        self.manager.unsubscribe(self)
+
+
+class WebSocketManager:
+    """One long-lived ComfyUI WebSocket shared by every generation in this process.
+
+    A background reader thread receives all messages for ``client_id`` and routes each one
+    to the subscription for its ``prompt_id``; messages without a ``prompt_id`` (older
+    ``progress`` events and binary preview frames without metadata) go to the prompt
+    currently executing. The connection is re-established with exponential backoff when it
+    drops.
+    """
+
+    subscription_class = Subscription
+
+    def __init__(self, server_address):
+        self.server_address = server_address
+        self.client_id = str(uuid.uuid4())
+        self.ws_url = f"ws://{server_address.replace('http://', '')}/ws?clientId={self.client_id}"
+        self._ws = None
+        self._subscriptions = {}
+        self._pending = OrderedDict()
+        self._current_prompt_id = None
+        self._lock = threading.Lock()
+        self._connected = threading.Event()
+        self._stopped = threading.Event()
+        self._last_error = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='comfyui-ws', daemon=True)
+        self._thread.start()
+
+    def wait_connected(self, timeout=CONNECT_TIMEOUT):
+        if not self._connected.wait(timeout):
+            raise ConnectionError(f"Failed to connect to WebSocket {self.ws_url}: {self._last_error}")
+
+    def subscribe(self, prompt_id):
+        subscription = self.subscription_class(self, prompt_id)
+        with self._lock:
+            self._subscriptions[prompt_id] = subscription
+            for message in self._pending.pop(prompt_id, []):
+                subscription.queue.put_nowait(message)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if self._subscriptions.get(subscription.prompt_id) is subscription:
+                del self._subscriptions[subscription.prompt_id]
+
+    def close(self):
+        self._stopped.set()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def _run(self):
+        backoff = RECONNECT_BACKOFF_INITIAL
+        while not self._stopped.is_set():
+            try:
+                ws = websocket.WebSocket(enable_multithread=True)
+                logger.debug(f"Attempting to connect to WebSocket: {self.ws_url}")
+                ws.connect(self.ws_url, timeout=CONNECT_TIMEOUT)
+                ws.settimeout(None)
+                self._ws = ws
+                self._connected.set()
+                logger.info(f"WebSocket connection established: {self.ws_url}")
+                backoff = RECONNECT_BACKOFF_INITIAL
+                while not self._stopped.is_set():
+                    self._dispatch(ws.recv())
+            except Exception as e:
+                if self._stopped.is_set():
+                    break
+                self._last_error = e
+                self._connected.clear()
+                logger.error(f"WebSocket connection lost: {e}; reconnecting in {backoff}s")
+                self._fail_subscriptions(e)
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX)
+            finally:
+                self._ws = None
+
+    def _dispatch(self, out):
+        prompt_id = None
+        finished = False
+        if isinstance(out, str):
+            message = json.loads(out)
+            data = message.get('data') or {}
+            prompt_id = data.get('prompt_id') if isinstance(data, dict) else None
+            if message.get('type') == 'status':
+                return
+            if prompt_id is not None and message.get('type') in ('execution_start', 'executing'):
+                self._current_prompt_id = prompt_id
+                finished = message['type'] == 'executing' and data.get('node') is None
+            elif prompt_id is not None and message.get('type') in ('execution_error', 'execution_interrupted'):
+                finished = prompt_id == self._current_prompt_id
+        else:
+            prompt_id = frame_prompt_id(out)
+        if prompt_id is None:
+            prompt_id = self._current_prompt_id
+        if prompt_id is None:
+            logger.debug(f"Dropping WebSocket message with no active prompt: {out!r:.200}")
+            return
+
+        with self._lock:
+            subscription = self._subscriptions.get(prompt_id)
+            if subscription is not None:
+                subscription.queue.put_nowait(out)
+            else:
+                self._pending.setdefault(prompt_id, []).append(out)
+                self._pending.move_to_end(prompt_id)
+                while len(self._pending) > MAX_PENDING_PROMPTS:
+                    self._pending.popitem(last=False)
+        if finished:
+            self._current_prompt_id = None
+
+    def _fail_subscriptions(self, error):
+        # Messages sent while we were disconnected are lost, so waiting subscribers would
+        # otherwise block forever on a completion event that never arrives.
+        with self._lock:
+            for subscription in self._subscriptions.values():
+                subscription.queue.put_nowait(ConnectionError(f"WebSocket connection lost: {error}"))
+
+
+def get_websocket_manager(server_address):
+    """Return this process's connected WebSocketManager for ``server_address``, starting it if needed."""
+    key = (os.getpid(), server_address)
+    with _managers_lock:
+        manager = _managers.get(key)
+        if manager is None:
+            manager = WebSocketManager(server_address)
+            manager.start()
+            _managers[key] = manager
+    manager.wait_connected()
+    return manager
+
+
+def close_websocket_managers():
+    with _managers_lock:
+        managers = list(_managers.values())
+        _managers.clear()
+    for manager in managers:
+        manager.close()
@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Node class types that generate_image / generate_image_to_image bind parameters into
+ROLES = ('KSampler', 'CheckpointLoaderSimple', 'EmptyLatentImage', 'LoadImage')
+
+
+class WorkflowTemplate:
+    """A parsed ComfyUI API workflow with the ids of the nodes we bind parameters into.
+
+    ``roles`` maps each class type in ROLES to the first node of that type, and
+    ``positive_id`` / ``negative_id`` are the text encode nodes feeding the KSampler.
+    """
+
+    def __init__(self, graph, name=None, mtime=None):
+        self.graph = graph
+        self.name = name
+        self.mtime = mtime
+        self.roles = {}
+        for node_id, node in graph.items():
+            class_type = node['class_type']
+            if class_type in ROLES and class_type not in self.roles:
+                self.roles[class_type] = node_id
+
+        self.positive_id = None
+        self.negative_id = None
+        k_sampler = self.roles.get('KSampler')
+        if k_sampler is not None:
+            inputs = graph[k_sampler]['inputs']
+            if 'positive' in inputs:
+                self.positive_id = inputs['positive'][0]
+            if 'negative' in inputs:
+                self.negative_id = inputs['negative'][0]
+
+    @classmethod
+    def from_json(cls, workflow, name=None, mtime=None):
+        return cls(json.loads(workflow), name=name, mtime=mtime)
+
+    def node_id(self, role):
+        node_id = self.roles.get(role)
+        if node_id is None:
+            logger.error(f"{role} not found in the workflow")
+            raise ValueError(f"{role} not found in the workflow")
+        return node_id
+
+    def copy(self):
+        """Return a per-request prompt graph whose node ``inputs`` can be modified freely.
+
+        Only the node dicts and their ``inputs`` are copied; input values are never
+        mutated in place, so sharing them with the template is safe.
+        """
+        return {node_id: {**node, 'inputs': dict(node['inputs'])} for node_id, node in self.graph.items()}
+
+
+class WorkflowRegistry:
+    """Loads every workflow in ``WORKFLOWS_DIR`` once and reloads a file when its mtime changes."""
+
+    def __init__(self, app=None):
+        self.workflows_dir = None
+        self._templates = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.workflows_dir = app.config['WORKFLOWS_DIR']
+        with self._lock:
+            self._templates = {}
+        if os.path.isdir(self.workflows_dir):
+            for name in sorted(os.listdir(self.workflows_dir)):
+                if name.endswith('.json'):
+                    try:
+                        self.get(name)
+                    except (OSError, ValueError, KeyError) as e:
+                        logger.error(f"Failed to load workflow {name}: {e}")
+        app.extensions['workflow_registry'] = self
+
+    def names(self):
+        with self._lock:
+            return sorted(self._templates)
+
+    def get(self, name):
+        """Return the WorkflowTemplate for ``name``; raises FileNotFoundError if it does not exist."""
+        path = os.path.join(self.workflows_dir, os.path.basename(name))
+        mtime = os.stat(path).st_mtime
+        with self._lock:
+            template = self._templates.get(name)
+        if template is not None and template.mtime == mtime:
+            return template
+
+        with open(path, 'r') as f:
+            template = WorkflowTemplate.from_json(f.read(), name=name, mtime=mtime)
+        logger.info(f"Loaded workflow {name}: roles={template.roles}")
+        with self._lock:
+            self._templates[name] = template
+        return template
+
+
+workflow_registry = WorkflowRegistry()
@@ -0,0 +1,41 @@
+import atexit
+import os
+import re
+
+
+def _prepare_prometheus_dir():
+    """Share Prometheus samples between uvicorn workers the way gunicorn.conf.py does for gunicorn.
+
+    Each worker writes its samples to files under PROMETHEUS_MULTIPROC_DIR and /metrics merges
+    them. The variable has to be set before prometheus_client is imported. uvicorn has no
+    start-up hook in the parent process, so each worker removes the files of processes that
+    are no longer running instead of clearing the directory.
+    """
+    path = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR',
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'prometheus'))
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        match = re.search(r'_(\d+)\.db$', name)
+        if match is None:
+            continue
+        try:
+            os.kill(int(match.group(1)), 0)
+        except ProcessLookupError:
+            try:
+                os.remove(os.path.join(path, name))
+            except FileNotFoundError:
+                pass
+        except PermissionError:
+            pass
+
+
+_prepare_prometheus_dir()
+
+from prometheus_client import multiprocess
+from app import create_app
+from app.asgi import AsyncGenerationApp
+
+atexit.register(multiprocess.mark_process_dead, os.getpid())
+
+# uvicorn asgi:app --workers 4
+app = AsyncGenerationApp(create_app())
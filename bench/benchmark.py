@@ -0,0 +1,254 @@
+"""Drive the real app under gunicorn against the fake ComfyUI server and report throughput.
+
+For every combination of ``--worker-class`` and ``--workers`` this starts a fake ComfyUI,
+starts gunicorn on ``run:app`` (or uvicorn on ``asgi:app`` for ``asgi``) pointed at it, fires ``--requests`` text-to-image
+generations from ``--concurrency`` clients (each with its own session and CSRF token) and
+reports requests/s, p50/p95/p99 latency and the peak resident memory of the workers.
+
+    python -m bench.benchmark --workers 1,2,4 --worker-class sync,gthread,asgi --requests 200 --concurrency 32
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from app.storage import output_path, shard, sidecar_path
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GENERATED_DIR = os.path.join(ROOT, 'app', 'static', 'generated')
+THUMBS_DIR = os.path.join(ROOT, 'app', 'static', 'thumbs')
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+FORM = {
+    'negative_prompt': '',
+    'seed': '-1',
+    'cfg': '8',
+    'sampler_name': 'euler',
+    'scheduler': 'normal',
+    'denoise': '1',
+    'ckpt_name': 'SD15/cyberrealistic_classicV31.safetensors',
+    'width': '512',
+    'height': '512',
+    'batch_size': '1',
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def child_pids(parent_pid):
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name is in parentheses and may contain spaces; ppid follows it
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == parent_pid:
+            pids.append(int(entry))
+    return pids
+
+
+def rss_bytes(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class MemorySampler(threading.Thread):
+    """Samples the RSS of the server's workers while the load runs and keeps the peaks."""
+
+    def __init__(self, master_pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.master_pid = master_pid
+        self.interval = interval
+        self.peak_total = 0
+        self.peak_worker = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            # uvicorn with a single worker serves from the parent process itself
+            pids = child_pids(self.master_pid) or [self.master_pid]
+            sizes = [rss_bytes(pid) for pid in pids]
+            self.peak_total = max(self.peak_total, sum(sizes))
+            self.peak_worker = max([self.peak_worker] + sizes)
+
+
+def run_client(base_url, indexes, steps, latencies, failures, filenames):
+    session = requests.Session()
+    page = session.get(f"{base_url}/generate", timeout=30)
+    token = CSRF_TOKEN.search(page.text).group(1)
+    for index in indexes:
+        # A distinct prompt per request so coalescing and the result cache never kick in
+        form = dict(FORM, csrf_token=token, positive_prompt=f"benchmark request {index}", steps=str(steps))
+        started = time.perf_counter()
+        try:
+            response = session.post(f"{base_url}/generate", data=form, timeout=600)
+            data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            failures.append(str(e))
+            continue
+        elapsed = time.perf_counter() - started
+        if data.get('success'):
+            latencies.append(elapsed)
+            filenames.extend(data.get('filenames', []))
+        else:
+            failures.append(data.get('error'))
+
+
+def run_config(args, worker_class, workers):
+    fake_port = free_port()
+    app_port = free_port()
+    instance_dir = tempfile.mkdtemp(prefix='imagine-bench-')
+    fake = subprocess.Popen([sys.executable, '-m', 'bench.fake_comfyui', '--port', str(fake_port),
+                             '--gpus', str(args.gpus), '--queue-latency', str(args.queue_latency),
+                             '--step-seconds', str(args.step_seconds), '--image-size', str(args.image_size)],
+                            cwd=ROOT, stdout=subprocess.DEVNULL)
+    env = dict(os.environ, COMFYUI_URL=f"http://127.0.0.1:{fake_port}", INSTANCE_DIR=instance_dir,
+               PROMETHEUS_MULTIPROC_DIR=os.path.join(instance_dir, 'prometheus'),
+               RESULT_CACHE_ENABLED='0', COALESCE_ENABLED='0', SCHEDULER_MAX_ACTIVE=str(args.concurrency),
+               # Every client comes from 127.0.0.1, so per-client rate limits would turn most requests into 429s
+               ADMISSION_ENABLED='0')
+    if worker_class == 'asgi':
+        # The asyncio path from asgi.py, served by uvicorn instead of gunicorn
+        command = [sys.executable, '-m', 'uvicorn', '--workers', str(workers), '--host', '127.0.0.1',
+                   '--port', str(app_port), '--no-access-log', 'asgi:app']
+    else:
+        command = [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-k', worker_class,
+                   '-b', f"127.0.0.1:{app_port}", '--timeout', '600']
+        if worker_class == 'gthread':
+            command += ['--threads', str(args.threads)]
+        command.append('run:app')
+    gunicorn = subprocess.Popen(command, cwd=ROOT, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{app_port}"
+    latencies, failures, filenames = [], [], []
+    try:
+        wait_for(f"http://127.0.0.1:{fake_port}/system_stats")
+        wait_for(base_url)
+        sampler = MemorySampler(gunicorn.pid)
+        sampler.start()
+        shares = [list(range(n, args.requests, args.concurrency)) for n in range(args.concurrency)]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            futures = [executor.submit(run_client, base_url, share, args.steps, latencies, failures, filenames)
+                       for share in shares]
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    failures.append(f"client failed: {e}")
+        elapsed = time.perf_counter() - started
+        sampler.stopped.set()
+    finally:
+        gunicorn.send_signal(signal.SIGTERM)
+        fake.terminate()
+        gunicorn.wait(30)
+        fake.wait(30)
+        for filename in filenames:
+            path = output_path(GENERATED_DIR, filename)
+            for path in (path, sidecar_path(path),
+                         os.path.join(THUMBS_DIR, shard(filename), f"{os.path.splitext(filename)[0]}.webp")):
+                if os.path.exists(path):
+                    os.remove(path)
+        shutil.rmtree(instance_dir, ignore_errors=True)
+
+    return {
+        'worker_class': worker_class,
+        'workers': workers,
+        'requests': args.requests,
+        'failed': len(failures),
+        'seconds': round(elapsed, 2),
+        'requests_per_second': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'peak_worker_rss_mb': round(sampler.peak_worker / 1024 ** 2, 1),
+        'peak_total_rss_mb': round(sampler.peak_total / 1024 ** 2, 1),
+        'errors': sorted(set(map(str, failures)))[:5],
+    }
+
+
+def print_table(results):
+    columns = ('worker_class', 'workers', 'requests', 'failed', 'requests_per_second', 'p50', 'p95', 'p99',
+               'peak_worker_rss_mb', 'peak_total_rss_mb')
+    print(' '.join(f"{column:>20}" for column in columns))
+    for result in results:
+        cells = []
+        for column in columns:
+            value = result[column]
+            cells.append(f"{value:>20.3f}" if isinstance(value, float) else f"{str(value):>20}")
+        print(' '.join(cells))
+        for error in result['errors']:
+            print(f"    error: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default='4', help='comma-separated gunicorn worker counts')
+    parser.add_argument('--worker-class', default='sync',
+                        help="comma-separated gunicorn worker classes, or 'asgi' for uvicorn running asgi:app")
+    parser.add_argument('--threads', type=int, default=8, help='threads per worker for gthread')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--steps', type=int, default=20, help='sampler steps per request')
+    parser.add_argument('--gpus', type=int, default=1, help='fake ComfyUI: prompts executed concurrently')
+    parser.add_argument('--queue-latency', type=float, default=0.0, help='fake ComfyUI: seconds before each prompt')
+    parser.add_argument('--step-seconds', type=float, default=0.01, help='fake ComfyUI: seconds per step')
+    parser.add_argument('--image-size', type=int, default=512, help='fake ComfyUI: output width and height')
+    parser.add_argument('--json', metavar='PATH', help='also write the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    for worker_class in args.worker_class.split(','):
+        for workers in args.workers.split(','):
+            print(f"Running {args.requests} requests against {workers} {worker_class} workers...", flush=True)
+            results.append(run_config(args, worker_class.strip(), int(workers)))
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
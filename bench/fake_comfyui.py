@@ -0,0 +1,396 @@
+"""A stand-in ComfyUI server for load tests and end-to-end tests.
+
+Implements the parts of ComfyUI's API that Imagine Server uses (``/prompt``, ``/ws``,
+``/history/<id>``, ``/view``, ``/upload/image``, ``/queue``, ``/interrupt`` and ``/system_stats``) with
+configurable queueing and execution latency and output image size. Prompts run one at a
+time per simulated GPU, so queue wait grows with load the way it does on a real box.
+
+    python -m bench.fake_comfyui --port 8188 --gpus 1 --step-seconds 0.05 --image-size 512
+"""
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import struct
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+def make_png(width, height, seed=0):
+    """Return an RGB PNG of noise; noise does not compress, so its size tracks a real render's."""
+    noise = random.Random(seed).randbytes(width * 3 * height)
+    row_bytes = width * 3
+    raw = b''.join(b'\x00' + noise[y * row_bytes:(y + 1) * row_bytes] for y in range(height))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(raw, 1)) + chunk(b'IEND', b'')
+
+
+class WebSocketClient:
+    """Server side of one ``/ws`` connection; frames are written under a lock from any thread."""
+
+    def __init__(self, handler, client_id):
+        self.handler = handler
+        self.client_id = client_id
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def send(self, payload):
+        opcode = 0x1 if isinstance(payload, str) else 0x2
+        data = payload.encode('utf-8') if isinstance(payload, str) else payload
+        length = len(data)
+        if length < 126:
+            header = struct.pack('>BB', 0x80 | opcode, length)
+        elif length < 1 << 16:
+            header = struct.pack('>BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('>BBQ', 0x80 | opcode, 127, length)
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.handler.wfile.write(header + data)
+                self.handler.wfile.flush()
+            except OSError:
+                self.closed = True
+
+    def send_json(self, message_type, data):
+        self.send(json.dumps({'type': message_type, 'data': data}))
+
+    def read_frames(self):
+        """Read client frames until it closes; answers pings so clients that keep alive stay connected."""
+        rfile = self.handler.rfile
+        while not self.closed:
+            header = rfile.read(2)
+            if len(header) < 2:
+                break
+            opcode = header[0] & 0x0f
+            length = header[1] & 0x7f
+            if length == 126:
+                length = struct.unpack('>H', rfile.read(2))[0]
+            elif length == 127:
+                length = struct.unpack('>Q', rfile.read(8))[0]
+            mask = rfile.read(4) if header[1] & 0x80 else b'\x00\x00\x00\x00'
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(rfile.read(length)))
+            if opcode == 0x8:
+                break
+            if opcode == 0x9:
+                with self.lock:
+                    self.handler.wfile.write(struct.pack('>BB', 0x8a, len(payload)) + payload)
+                    self.handler.wfile.flush()
+        self.closed = True
+
+
+class FakeComfyUI:
+    """The simulated backend: a prompt queue drained by ``gpus`` executor threads.
+
+    Each prompt waits ``queue_latency`` seconds after it is dequeued, then runs for
+    ``steps * step_seconds`` (``steps`` read from its KSampler) while sending ComfyUI's
+    ``execution_start`` / ``executing`` / ``progress`` messages, and a binary preview frame
+    per step, to the submitting client.
+    Prompts deleted from the queue never run, and an interrupted prompt stops at its next
+    step with ``execution_interrupted``; both are recorded in ``deleted`` and ``interrupted``.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, gpus=1, queue_latency=0.0, step_seconds=0.01,
+                 image_size=64, images_per_prompt=None):
+        self.queue_latency = queue_latency
+        self.step_seconds = step_seconds
+        self.image_size = image_size
+        self.images_per_prompt = images_per_prompt
+        self.clients = {}
+        self.history = {}
+        self.uploads = {}
+        self.pending = []
+        self.running = []
+        self.completed = 0
+        self.deleted = []
+        self.interrupted = []
+        self._interrupts = set()
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self._images = {}
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.gpus = [threading.Thread(target=self._execute_forever, name=f'fake-gpu-{n}', daemon=True)
+                     for n in range(gpus)]
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        for gpu in self.gpus:
+            gpu.start()
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-comfyui', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for _ in self.gpus:
+            self.queue.put(None)
+
+    def image_bytes(self, filename):
+        # Every output of one size is the same noise image; build it once
+        image = self._images.get(self.image_size)
+        if image is None:
+            image = self._images[self.image_size] = make_png(self.image_size, self.image_size)
+        return image
+
+    def submit(self, prompt, client_id):
+        prompt_id = str(uuid.uuid4())
+        with self.lock:
+            number = self.completed + len(self.pending) + len(self.running)
+            self.pending.append(prompt_id)
+        self.queue.put((prompt_id, prompt, client_id))
+        return prompt_id, number
+
+    def delete(self, prompt_ids):
+        with self.lock:
+            for prompt_id in prompt_ids:
+                if prompt_id in self.pending:
+                    self.pending.remove(prompt_id)
+                    self.deleted.append(prompt_id)
+
+    def interrupt(self, prompt_id=None):
+        """Stop ``prompt_id`` if it is running, or every running prompt when none is given."""
+        with self.lock:
+            if prompt_id is None:
+                self._interrupts.update(self.running)
+            elif prompt_id in self.running:
+                self._interrupts.add(prompt_id)
+
+    def _execute_forever(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            prompt_id, prompt, client_id = item
+            with self.lock:
+                if prompt_id not in self.pending:
+                    continue  # deleted from the queue while it waited
+                self.pending.remove(prompt_id)
+                self.running.append(prompt_id)
+            completed = False
+            try:
+                completed = self._execute(prompt_id, prompt, client_id)
+            finally:
+                with self.lock:
+                    self.running.remove(prompt_id)
+                    if completed:
+                        self.completed += 1
+                    else:
+                        self._interrupts.discard(prompt_id)
+                        self.interrupted.append(prompt_id)
+
+    def _send(self, client_id, message_type, data):
+        client = self.clients.get(client_id)
+        if client is not None:
+            client.send_json(message_type, data)
+
+    def _send_preview(self, client_id):
+        client = self.clients.get(client_id)
+        if client is not None:
+            # ComfyUI's PREVIEW_IMAGE event (1) carrying a PNG (image type 2)
+            client.send(struct.pack('>II', 1, 2) + self.image_bytes(None))
+
+    def _execute(self, prompt_id, prompt, client_id):
+        if self.queue_latency:
+            time.sleep(self.queue_latency)
+        self._send(client_id, 'execution_start', {'prompt_id': prompt_id})
+        steps, batch_size = 1, 1
+        for node in prompt.values():
+            inputs = node.get('inputs', {})
+            if node.get('class_type') == 'KSampler':
+                steps = int(inputs.get('steps') or 1)
+            if 'batch_size' in inputs:
+                batch_size = int(inputs['batch_size'] or 1)
+
+        for node_id, node in prompt.items():
+            self._send(client_id, 'executing', {'node': node_id, 'prompt_id': prompt_id})
+            if node.get('class_type') == 'KSampler':
+                for step in range(1, steps + 1):
+                    time.sleep(self.step_seconds)
+                    if prompt_id in self._interrupts:
+                        self._send(client_id, 'execution_interrupted', {'prompt_id': prompt_id, 'node_id': node_id,
+                                                                        'node_type': 'KSampler'})
+                        return False
+                    self._send(client_id, 'progress', {'value': step, 'max': steps, 'prompt_id': prompt_id,
+                                                       'node': node_id})
+                    self._send_preview(client_id)
+
+        count = self.images_per_prompt or batch_size
+        images = [{'filename': f"fake_{prompt_id[:8]}_{n:05d}_.png", 'subfolder': '', 'type': 'output'}
+                  for n in range(count)]
+        output_node = next((node_id for node_id, node in prompt.items() if node.get('class_type') == 'SaveImage'),
+                           '9')
+        self.history[prompt_id] = {'prompt': [0, prompt_id, prompt, {}, [output_node]],
+                                   'outputs': {output_node: {'images': images}},
+                                   'status': {'status_str': 'success', 'completed': True}}
+        self._send(client_id, 'executing', {'node': None, 'prompt_id': prompt_id})
+        return True
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+            def _json(self, data, status=200):
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _body(self):
+                return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path == '/ws':
+                    return self._websocket(query.get('clientId', [uuid.uuid4().hex])[0])
+                if url.path.startswith('/history/'):
+                    prompt_id = url.path[len('/history/'):]
+                    entry = fake.history.get(prompt_id)
+                    return self._json({prompt_id: entry} if entry else {})
+                if url.path == '/view':
+                    return self._view(query, head=False)
+                if url.path == '/queue':
+                    with fake.lock:
+                        return self._json({'queue_running': [[0, p] for p in fake.running],
+                                           'queue_pending': [[0, p] for p in fake.pending]})
+                if url.path == '/system_stats':
+                    return self._json({'devices': [{'name': 'fake', 'vram_free': 8 * 1024 ** 3}]})
+                self._json({'error': 'not found'}, 404)
+
+            def do_HEAD(self):
+                url = urlparse(self.path)
+                if url.path == '/view':
+                    return self._view(parse_qs(url.query), head=True)
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                if url.path == '/prompt':
+                    data = json.loads(self._body() or b'{}')
+                    prompt_id, number = fake.submit(data.get('prompt') or {}, data.get('client_id'))
+                    return self._json({'prompt_id': prompt_id, 'number': number, 'node_errors': {}})
+                if url.path == '/upload/image':
+                    body = self._body()
+                    name = self._multipart_filename(body) or f"{uuid.uuid4().hex}.png"
+                    fake.uploads[name] = len(body)
+                    return self._json({'name': name, 'subfolder': '', 'type': 'input'})
+                if url.path == '/queue':
+                    data = json.loads(self._body() or b'{}')
+                    if data.get('clear'):
+                        with fake.lock:
+                            data['delete'] = list(fake.pending)
+                    fake.delete(data.get('delete') or [])
+                    return self._json({})
+                if url.path == '/interrupt':
+                    data = json.loads(self._body() or b'{}')
+                    fake.interrupt(data.get('prompt_id'))
+                    return self._json({})
+                self._json({'error': 'not found'}, 404)
+
+            def _multipart_filename(self, body):
+                marker = b'filename="'
+                start = body.find(marker)
+                if start < 0:
+                    return None
+                start += len(marker)
+                return body[start:body.index(b'"', start)].decode('utf-8')
+
+            def _view(self, query, head):
+                filename = query.get('filename', [''])[0]
+                folder_type = query.get('type', ['output'])[0]
+                if folder_type == 'input':
+                    exists = filename in fake.uploads
+                    body = b'' if head or not exists else b'\x89PNG'
+                else:
+                    exists = filename.startswith('fake_')
+                    body = fake.image_bytes(filename) if exists else b''
+                self.send_response(200 if exists else 404)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if not head:
+                    self.wfile.write(body)
+
+            def _websocket(self, client_id):
+                key = self.headers.get('Sec-WebSocket-Key', '')
+                accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode('ascii')).digest()).decode('ascii')
+                self.send_response(101, 'Switching Protocols')
+                self.send_header('Upgrade', 'websocket')
+                self.send_header('Connection', 'Upgrade')
+                self.send_header('Sec-WebSocket-Accept', accept)
+                self.end_headers()
+                self.wfile.flush()
+
+                client = WebSocketClient(self, client_id)
+                fake.clients[client_id] = client
+                client.send_json('status', {'status': {'exec_info': {'queue_remaining': len(fake.pending)}},
+                                            'sid': client_id})
+                try:
+                    client.read_frames()
+                finally:
+                    if fake.clients.get(client_id) is client:
+                        del fake.clients[client_id]
+                    self.close_connection = True
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8188)
+    parser.add_argument('--gpus', type=int, default=1, help='prompts executed concurrently')
+    parser.add_argument('--queue-latency', type=float, default=0.0, help='seconds before each prompt starts')
+    parser.add_argument('--step-seconds', type=float, default=0.05, help='seconds per sampler step')
+    parser.add_argument('--image-size', type=int, default=512, help='width and height of output images')
+    parser.add_argument('--images-per-prompt', type=int, default=None,
+                        help='outputs per prompt (default: the prompt\'s batch_size)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+    fake = FakeComfyUI(args.host, args.port, gpus=args.gpus, queue_latency=args.queue_latency,
+                       step_seconds=args.step_seconds, image_size=args.image_size,
+                       images_per_prompt=args.images_per_prompt)
+    fake.start()
+    print(f"Fake ComfyUI listening on {fake.url}", flush=True)
+    try:
+        fake._thread.join()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,14 +6,132 @@ load_dotenv()
 
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'fallback-secret-key'
+    # One or more ComfyUI backends, comma separated
     COMFYUI_URL = os.environ.get('COMFYUI_URL') or 'http://localhost:8188'
     FLASK_ENV = os.environ.get('FLASK_ENV') or 'production'
     DEBUG = os.environ.get('FLASK_DEBUG', '0') == '1'
     LOG_LEVEL = os.environ.get('LOG_LEVEL') or 'INFO'
 
+    # Pooled HTTP session used for ComfyUI REST calls
+    COMFYUI_POOL_SIZE = int(os.environ.get('COMFYUI_POOL_SIZE') or 10)
+    COMFYUI_CONNECT_TIMEOUT = float(os.environ.get('COMFYUI_CONNECT_TIMEOUT') or 5)
+    COMFYUI_READ_TIMEOUT = float(os.environ.get('COMFYUI_READ_TIMEOUT') or 60)
+    COMFYUI_GET_RETRIES = int(os.environ.get('COMFYUI_GET_RETRIES') or 3)
+    # Concurrent image downloads per finished prompt
+    COMFYUI_FETCH_WORKERS = int(os.environ.get('COMFYUI_FETCH_WORKERS') or 4)
+    # Backend routing: how long /queue and /system_stats results are reused, and how long a failed backend is skipped
+    BACKEND_STATS_TTL = float(os.environ.get('BACKEND_STATS_TTL') or 2)
+    BACKEND_RETRY_AFTER = float(os.environ.get('BACKEND_RETRY_AFTER') or 30)
+    # Seconds a health probe may take before the backend counts as failed; probes are never retried
+    BACKEND_PROBE_TIMEOUT = float(os.environ.get('BACKEND_PROBE_TIMEOUT') or 1)
+    # Prefer a backend that already has the checkpoint loaded if it is at most this many jobs busier
+    BACKEND_AFFINITY_SLACK = int(os.environ.get('BACKEND_AFFINITY_SLACK') or 2)
+
+    # Checkpoint-affinity scheduling, shared by all workers: prompts kept in a backend's queue at once,
+    # and how often the oldest waiting job may be passed over for one on the loaded checkpoint
+    SCHEDULER_MAX_ACTIVE = int(os.environ.get('SCHEDULER_MAX_ACTIVE') or 2)
+    SCHEDULER_MAX_SKIPS = int(os.environ.get('SCHEDULER_MAX_SKIPS') or 4)
+
+    # Admission control in front of every generation, shared by all workers: a token bucket per client
+    # (ADMISSION_RATE requests a minute, bursts of ADMISSION_BURST), at most ADMISSION_CLIENT_QUEUE requests
+    # admitted and ADMISSION_CLIENT_CONCURRENCY running per client, ADMISSION_MAX_RUNNING running in total and
+    # ADMISSION_MAX_BACKLOG admitted in total; anything over a limit gets 429 with Retry-After
+    ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', '1') == '1'
+    ADMISSION_RATE = float(os.environ.get('ADMISSION_RATE') or 30)
+    ADMISSION_BURST = float(os.environ.get('ADMISSION_BURST') or 10)
+    ADMISSION_CLIENT_QUEUE = int(os.environ.get('ADMISSION_CLIENT_QUEUE') or 8)
+    ADMISSION_CLIENT_CONCURRENCY = int(os.environ.get('ADMISSION_CLIENT_CONCURRENCY') or 2)
+    ADMISSION_MAX_RUNNING = int(os.environ.get('ADMISSION_MAX_RUNNING') or 8)
+    ADMISSION_MAX_BACKLOG = int(os.environ.get('ADMISSION_MAX_BACKLOG') or 64)
+    # Longest an admitted request waits for a slot, and how long waiting lifts it by one priority class
+    ADMISSION_MAX_WAIT = float(os.environ.get('ADMISSION_MAX_WAIT') or 600)
+    ADMISSION_AGING = float(os.environ.get('ADMISSION_AGING') or 60)
+    # Clients sending "X-API-Key: <key>" get the key's priority class (high, normal or low): "key1:high,key2:low";
+    # everyone else is identified by address and gets ADMISSION_DEFAULT_CLASS. Batches always run as low.
+    ADMISSION_API_KEYS = os.environ.get('ADMISSION_API_KEYS') or ''
+    ADMISSION_DEFAULT_CLASS = os.environ.get('ADMISSION_DEFAULT_CLASS') or 'normal'
+    # Reverse proxies in front of the app whose X-Forwarded-For is trusted for the client address
+    TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES') or 0)
+
     # Corrected path to the workflows directory
     WORKFLOWS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workflows')
 
+    # Runtime state (job status files, caches, indexes)
+    INSTANCE_DIR = os.environ.get('INSTANCE_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
+
+    # Shared admission control state
+    ADMISSION_DB = os.environ.get('ADMISSION_DB') or os.path.join(INSTANCE_DIR, 'admission.sqlite3')
+    # Shared checkpoint scheduler queue
+    SCHEDULER_DB = os.environ.get('SCHEDULER_DB') or ADMISSION_DB
+
+    # Gallery metadata index used by /saves
+    GALLERY_DB = os.environ.get('GALLERY_DB') or os.path.join(INSTANCE_DIR, 'gallery.sqlite3')
+    GALLERY_PAGE_SIZE = int(os.environ.get('GALLERY_PAGE_SIZE') or 48)
+
+    # Retention of static/generated and static/uploads: 'off', 'dry-run' (only log and report what would go)
+    # or 'delete'. Files older than RETENTION_MAX_AGE_DAYS are removed, then least recently used ('lru') or
+    # oldest ('oldest') files until RETENTION_MAX_BYTES is met; 0 disables either limit. Pinned images are kept.
+    RETENTION_MODE = os.environ.get('RETENTION_MODE') or 'off'
+    RETENTION_MAX_BYTES = int(os.environ.get('RETENTION_MAX_BYTES') or 0)
+    RETENTION_MAX_AGE_DAYS = float(os.environ.get('RETENTION_MAX_AGE_DAYS') or 0)
+    RETENTION_ORDER = os.environ.get('RETENTION_ORDER') or 'lru'
+    RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL') or 600)
+    # Files saved, served or used as input this recently are never deleted
+    RETENTION_MIN_AGE = float(os.environ.get('RETENTION_MIN_AGE') or 3600)
+
+    # WebP previews shown in the gallery; THUMBNAIL_WORKERS=0 makes them inline instead of in a process pool
+    THUMBNAIL_DIR = os.environ.get('THUMBNAIL_DIR')
+    THUMBNAIL_SIZE = int(os.environ.get('THUMBNAIL_SIZE') or 384)
+    THUMBNAIL_QUALITY = int(os.environ.get('THUMBNAIL_QUALITY') or 80)
+    THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS') or 2)
+
+    # Who sends generated files: '' streams them from Python, 'x-accel' hands them to nginx through
+    # X-Accel-Redirect (see deploy.sh), 'x-sendfile' emits X-Sendfile for Apache/lighttpd
+    SENDFILE_MODE = os.environ.get('SENDFILE_MODE') or ''
+    USE_X_SENDFILE = SENDFILE_MODE == 'x-sendfile'
+    X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX') or '/internal/generated/'
+    # Generated files never change once written, so browsers may keep them this long
+    GENERATED_MAX_AGE = int(os.environ.get('GENERATED_MAX_AGE') or 365 * 24 * 3600)
+
+    # Generations slower than this are logged with their stage breakdown
+    SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS') or 120)
+    # cProfile every generation (PROFILE_REQUESTS=1), or only requests sending "X-Profile: <PROFILE_TOKEN>"
+    PROFILE_REQUESTS = os.environ.get('PROFILE_REQUESTS', '0') == '1'
+    PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(INSTANCE_DIR, 'profiles')
+
+    # Longest a generation (or one batch item) may run, queueing included, before it is cancelled and its
+    # ComfyUI prompt deleted or interrupted; requests may ask for less with a "deadline" field. 0 disables it
+    GENERATION_DEADLINE = float(os.environ.get('GENERATION_DEADLINE') or 1800)
+
+    # Live latent previews on the streaming routes: at most PREVIEW_FPS frames a second (0 turns them
+    # off), downscaled to PREVIEW_MAX_SIZE pixels on a side
+    PREVIEW_FPS = float(os.environ.get('PREVIEW_FPS') or 2)
+    PREVIEW_MAX_SIZE = int(os.environ.get('PREVIEW_MAX_SIZE') or 256)
+    PREVIEW_QUALITY = int(os.environ.get('PREVIEW_QUALITY') or 70)
+
+    # Background generation jobs
+    JOBS_DIR = os.environ.get('JOBS_DIR') or os.path.join(INSTANCE_DIR, 'jobs')
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS') or 4)
+    # Job status files are deleted this many seconds after their last write (0 keeps them), and a running job's
+    # progress is written at most every JOB_PROGRESS_INTERVAL seconds
+    JOB_TTL = float(os.environ.get('JOB_TTL') or 7 * 24 * 3600)
+    JOB_PROGRESS_INTERVAL = float(os.environ.get('JOB_PROGRESS_INTERVAL') or 1)
+    # Batch and sweep submissions: largest accepted batch, and items of one batch kept in flight at once
+    BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS') or 1000)
+    BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY') or 4)
+
+    # Cache of outputs for generations with an explicit seed
+    RESULT_CACHE_ENABLED = os.environ.get('RESULT_CACHE_ENABLED', '1') == '1'
+    RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR') or os.path.join(INSTANCE_DIR, 'result_cache')
+    RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES') or 2 * 1024 ** 3)
+
+    # Fold identical in-flight generations in a worker into a single ComfyUI job
+    COALESCE_ENABLED = os.environ.get('COALESCE_ENABLED', '1') == '1'
+
+    # Threads per uvicorn worker for requests asgi.py hands to Flask (pages, downloads, job polls, mode=job)
+    ASGI_THREADS = int(os.environ.get('ASGI_THREADS') or 8)
+
     # Logging configuration
     import logging
     logging.basicConfig(
@@ -86,6 +86,8 @@ WorkingDirectory=$APP_DIR
 ExecStart=$VENV_DIR/bin/gunicorn -w 4 -b 127.0.0.1:${PORT} run:app
 Restart=always
 Environment="PATH=$VENV_DIR/bin:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
+Environment="SENDFILE_MODE=x-accel"
+Environment="TRUSTED_PROXIES=1"
 
 [Install]
 WantedBy=multi-user.target
@@ -104,12 +106,25 @@ server {
     listen 80;
     server_name $DOMAIN;
 
+    # Sidecar metadata and partially written files are never served
+    location ~ "^/static/generated/.*\.(json|part|tmp)\$" {
+        return 404;
+    }
+
+    # /static/generated/ images and downloads go through the app, which records the access for
+    # retention's LRU order; nginx then streams the bytes from here via X-Accel-Redirect
+    location /internal/generated/ {
+        internal;
+        alias $APP_DIR/app/static/generated/;
+    }
+
     location / {
         proxy_pass http://localhost:${PORT};
         proxy_http_version 1.1;
         proxy_set_header Upgrade \$http_upgrade;
         proxy_set_header Connection 'upgrade';
         proxy_set_header Host \$host;
+        proxy_set_header X-Forwarded-For \$remote_addr;
         proxy_cache_bypass \$http_upgrade;
     }
 }
@@ -0,0 +1,17 @@
+# Picked up automatically by gunicorn when started from the project directory (see deploy.sh)
+import os
+import shutil
+
+
+def on_starting(server):
+    # Each worker writes its Prometheus samples to files here and /metrics merges them;
+    # stale files from the previous run would otherwise be counted again
+    path = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR',
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'prometheus'))
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -4,12 +4,38 @@ from app.utils import open_websocket_connection
 from unittest.mock import Mock, patch
 
 @pytest.fixture
-def app():
+def app(tmp_path):
     app = create_app()
+    instance = tmp_path / 'instance'
     app.config.update({
         "TESTING": True,
-        "COMFYUI_URL": "http://localhost:8188"
+        "COMFYUI_URL": "http://localhost:8188",
+        "INSTANCE_DIR": str(instance),
+        "ADMISSION_DB": str(instance / 'admission.sqlite3'),
+        "SCHEDULER_DB": str(instance / 'admission.sqlite3'),
+        "GALLERY_DB": str(instance / 'gallery.sqlite3'),
+        "JOBS_DIR": str(instance / 'jobs'),
+        "RESULT_CACHE_DIR": str(instance / 'result_cache'),
+        "PROFILE_DIR": str(instance / 'profiles'),
+        "THUMBNAIL_DIR": str(tmp_path / 'thumbs'),
     })
+    # Keep outputs, thumbnails and runtime state out of the source tree
+    from app.admission import admission
+    from app.cache import result_cache
+    from app.jobs import job_manager
+    from app.models import gallery_index
+    from app.retention import retention
+    from app.scheduler import checkpoint_scheduler
+    from app.storage import output_store
+    from app.thumbnails import thumbnails
+    for extension in (admission, checkpoint_scheduler, job_manager, result_cache, gallery_index, thumbnails, retention):
+        extension.init_app(app)
+    generated_dir = str(tmp_path / 'generated')
+    output_store.root = gallery_index.generated_dir = thumbnails.generated_dir = retention.generated_dir = generated_dir
+    # Make thumbnails inline so tests do not start a process pool
+    thumbnails.workers = 0
+    # Route tests post from one address faster than any sane rate limit; tests/test_admission.py covers it
+    admission.enabled = False
     yield app
 
 @pytest.fixture
@@ -25,5 +51,5 @@ def mock_websocket():
 
 @pytest.fixture
 def mock_requests():
-    with patch('app.utils.requests') as mock_req:
-        yield mock_req
\ No newline at end of file
+    with patch('app.utils.get_session') as mock_get_session:
+        yield mock_get_session.return_value
\ No newline at end of file
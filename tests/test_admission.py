@@ -0,0 +1,183 @@
+import pytest
+from app.admission import AdmissionController, AdmissionRejected
+
+NOW = 1_000_000.0
+
+
+class FakeApp:
+    def __init__(self, tmp_path, **config):
+        self.config = {
+            'ADMISSION_ENABLED': True,
+            'ADMISSION_DB': str(tmp_path / 'admission.sqlite3'),
+            'ADMISSION_RATE': 60,
+            'ADMISSION_BURST': 100,
+            'ADMISSION_CLIENT_QUEUE': 100,
+            'ADMISSION_CLIENT_CONCURRENCY': 100,
+            'ADMISSION_MAX_RUNNING': 100,
+            'ADMISSION_MAX_BACKLOG': 100,
+            'ADMISSION_MAX_WAIT': 600,
+            'ADMISSION_AGING': 0,
+            'ADMISSION_API_KEYS': '',
+            'ADMISSION_DEFAULT_CLASS': 'normal',
+            **config,
+        }
+        self.extensions = {}
+
+
+def controller(tmp_path, **config):
+    return AdmissionController(FakeApp(tmp_path, **config))
+
+
+def test_token_bucket_rejects_with_retry_after(tmp_path):
+    admission = controller(tmp_path, ADMISSION_BURST=2, ADMISSION_RATE=6)
+    admission.admit('ip:a', now=NOW)
+    admission.admit('ip:a', now=NOW)
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.admit('ip:a', now=NOW + 1)
+    # 6 a minute refills one token every 10 seconds; one second of it has passed
+    assert rejected.value.retry_after == 9
+    admission.admit('ip:b', now=NOW + 1)
+    admission.admit('ip:a', now=NOW + 10)
+
+
+def test_backlog_cap_turns_low_priority_away_first(tmp_path):
+    admission = controller(tmp_path, ADMISSION_MAX_BACKLOG=4, ADMISSION_MAX_RUNNING=1)
+    for client in ('ip:a', 'ip:b'):
+        admission.admit(client, 'normal', now=NOW)
+    with pytest.raises(AdmissionRejected, match='Server is busy'):
+        admission.admit('ip:c', 'low', now=NOW)
+    admission.admit('ip:c', 'normal', now=NOW)
+    admission.admit('ip:d', 'high', now=NOW)
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.admit('ip:e', 'high', now=NOW)
+    assert rejected.value.retry_after >= 1
+
+
+def test_per_client_queue_limit(tmp_path):
+    admission = controller(tmp_path, ADMISSION_CLIENT_QUEUE=1)
+    admission.admit('ip:a', now=NOW)
+    with pytest.raises(AdmissionRejected, match='for this client'):
+        admission.admit('ip:a', now=NOW)
+    admission.admit('key:x', 'high', now=NOW)
+    admission.admit('key:x', 'high', now=NOW)
+
+
+def test_slots_go_by_priority_then_fair_share(tmp_path):
+    admission = controller(tmp_path, ADMISSION_MAX_RUNNING=2, ADMISSION_CLIENT_CONCURRENCY=2)
+    hog_first = admission.admit('ip:hog', now=NOW)
+    hog_second = admission.admit('ip:hog', now=NOW + 1)
+    polite = admission.admit('ip:polite', now=NOW + 2)
+    batch = admission.admit('ip:batch', 'low', now=NOW + 3)
+    urgent = admission.admit('key:vip', 'high', now=NOW + 4)
+
+    assert admission.poll(urgent, now=NOW + 5) is None
+    assert admission.poll(hog_first, now=NOW + 5) is None
+    assert admission.poll(hog_second, now=NOW + 5) == 2
+
+    admission.release(urgent, now=NOW + 6)
+    # The hog already has a generation running, so the other client goes next
+    assert admission.poll(hog_second, now=NOW + 6) == 1
+    assert admission.poll(polite, now=NOW + 6) is None
+    assert admission.poll(batch, now=NOW + 6) == 2
+    assert admission.stats()['running'] == 2
+
+
+def test_client_concurrency_leaves_slots_to_others(tmp_path):
+    admission = controller(tmp_path, ADMISSION_MAX_RUNNING=4, ADMISSION_CLIENT_CONCURRENCY=1)
+    first = admission.admit('ip:a', now=NOW)
+    second = admission.admit('ip:a', now=NOW)
+    assert admission.poll(first, now=NOW) is None
+    assert admission.poll(second, now=NOW) == 1
+    assert admission.poll(admission.admit('ip:b', now=NOW), now=NOW) is None
+
+
+def test_aging_lifts_waiting_low_priority_requests(tmp_path):
+    admission = controller(tmp_path, ADMISSION_MAX_RUNNING=1, ADMISSION_AGING=60)
+    admission.stale_seconds = 1000
+    old_batch = admission.admit('ip:batch', 'low', now=NOW)
+    fresh = admission.admit('ip:user', now=NOW + 150)
+    assert admission.poll(fresh, now=NOW + 150) == 1
+    assert admission.poll(old_batch, now=NOW + 150) is None
+
+
+def test_queue_reports_position_and_releases(tmp_path):
+    admission = controller(tmp_path, ADMISSION_MAX_RUNNING=1)
+    admission.poll_interval = 0
+    running = admission.admit('ip:a')
+    assert admission.poll(running) is None
+    waiting = admission.admit('ip:b')
+    output = admission.queue(waiting, lambda: iter(['Progress: Step 1 of 1', []]))
+    assert next(output) == 'Queue position: 1'
+    admission.release(running)
+    assert list(output) == ['Progress: Step 1 of 1', []]
+    assert admission.stats()['running'] == 0
+    assert admission.stats()['waiting'] == 0
+
+
+def test_queue_times_out(tmp_path):
+    admission = controller(tmp_path, ADMISSION_MAX_RUNNING=1, ADMISSION_MAX_WAIT=0)
+    admission.poll(admission.admit('ip:a'))
+    output = list(admission.queue(admission.admit('ip:b'), lambda: iter(['never'])))
+    assert output[-2].startswith('Error: Timed out') and output[-1] == []
+
+
+def test_dead_workers_and_unpolled_tickets_are_dropped(tmp_path, monkeypatch):
+    admission = controller(tmp_path, ADMISSION_MAX_RUNNING=1)
+    stuck = admission.admit('ip:a', now=NOW)
+    admission.poll(stuck, now=NOW)
+    monkeypatch.setattr('app.admission.process_alive', lambda pid: False)
+    assert admission.stats()['running'] == 1
+    assert admission.poll(admission.admit('ip:b', now=NOW), now=NOW) is None
+    monkeypatch.undo()
+
+    forgotten = admission.admit('ip:c', now=NOW)
+    assert admission.poll(admission.admit('ip:d', now=NOW + 1), now=NOW + 100) == 1
+    # A forgotten ticket that polls again rejoins at its original place
+    assert admission.poll(forgotten, now=NOW + 100) == 1
+
+
+def test_held_tickets_are_not_dropped(tmp_path):
+    admission = controller(tmp_path, ADMISSION_MAX_RUNNING=1)
+    admission.poll(admission.admit('ip:a', now=NOW), now=NOW)
+    queued_job = admission.admit('ip:b', now=NOW)
+    admission.hold(queued_job)
+    admission.heartbeat(now=NOW + 20)
+    admission.heartbeat(now=NOW + 40)
+    admission.poll(admission.admit('ip:c', now=NOW + 45), now=NOW + 45)
+    assert admission.stats()['waiting'] == 2
+    admission.release(queued_job)
+    admission.heartbeat(now=NOW + 50)
+    assert admission.stats()['waiting'] == 1
+
+
+def test_dropped_tickets_rejoin_only_within_limits(tmp_path):
+    admission = controller(tmp_path, ADMISSION_MAX_RUNNING=1, ADMISSION_CLIENT_QUEUE=2)
+    admission.poll(admission.admit('ip:a', now=NOW), now=NOW)
+    forgotten = admission.admit('ip:b', now=NOW)
+    # The forgotten ticket is dropped as stale and its client fills the queue again
+    admission.admit('ip:b', now=NOW + 100)
+    admission.admit('ip:b', now=NOW + 100)
+    with pytest.raises(AdmissionRejected, match='for this client'):
+        admission.poll(forgotten, now=NOW + 100)
+
+
+def test_identify_by_api_key_or_address(tmp_path):
+    admission = controller(tmp_path, ADMISSION_API_KEYS='secret:high')
+
+    class Request:
+        remote_addr = '10.0.0.1'
+
+        def __init__(self, headers):
+            self.headers = headers
+
+    client, priority_class = admission.identify(Request({'X-API-Key': 'secret'}))
+    assert client.startswith('key:') and 'secret' not in client and priority_class == 'high'
+    assert admission.identify(Request({'X-API-Key': 'wrong'})) == ('ip:10.0.0.1', 'normal')
+    with pytest.raises(ValueError):
+        controller(tmp_path, ADMISSION_API_KEYS='secret:urgent')
+
+
+def test_disabled_admits_everything(tmp_path):
+    admission = controller(tmp_path, ADMISSION_ENABLED=False)
+    assert admission.admit('ip:a') is None
+    assert list(admission.queue(None, lambda: iter(['x']))) == ['x']
@@ -0,0 +1,236 @@
+import asyncio
+import json
+import threading
+import time
+import pytest
+from urllib.parse import urlencode
+from bench.fake_comfyui import FakeComfyUI
+from app import routes
+from app.asgi import AsyncGenerationApp
+from app.cache import result_cache
+from app.models import gallery_index
+from app.storage import output_store
+from app.async_utils import AsyncComfyUIClient, close_clients, generate_image_async
+from app.workflows import workflow_registry
+
+FORM = {
+    'positive_prompt': 'async lighthouse',
+    'negative_prompt': '',
+    'seed': '7',
+    'steps': '3',
+    'cfg': '8',
+    'sampler_name': 'euler',
+    'scheduler': 'normal',
+    'denoise': '1',
+    'ckpt_name': 'SD15/cyberrealistic_classicV31.safetensors',
+    'width': '512',
+    'height': '512',
+    'batch_size': '1',
+}
+
+
+@pytest.fixture
+def fake_comfyui(app, monkeypatch):
+    fake = FakeComfyUI(step_seconds=0.001, image_size=16).start()
+    app.config.update(COMFYUI_URL=fake.url, WTF_CSRF_ENABLED=False)
+    monkeypatch.setattr(result_cache, 'enabled', False)
+    yield fake
+    fake.stop()
+
+
+async def _collect(generator):
+    try:
+        return [item async for item in generator]
+    finally:
+        await close_clients()
+
+
+async def _call(asgi_app, path, form, disconnect_on=None):
+    body = urlencode(form).encode('utf-8')
+    scope = {'type': 'http', 'http_version': '1.1', 'method': 'POST', 'scheme': 'http', 'path': path,
+             'raw_path': path.encode('ascii'), 'query_string': b'', 'root_path': '',
+             'server': ('testserver', 80), 'client': ('127.0.0.1', 1234),
+             'headers': [(b'host', b'testserver'),
+                         (b'content-type', b'application/x-www-form-urlencoded'),
+                         (b'content-length', str(len(body)).encode('ascii'))]}
+    messages = []
+    received = []
+    finished = asyncio.Event()
+
+    async def receive():
+        if not received:
+            received.append(True)
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        await finished.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        messages.append(message)
+        if message['type'] == 'http.response.body' and not message.get('more_body'):
+            finished.set()
+        elif disconnect_on is not None and disconnect_on in message.get('body', b''):
+            # The client goes away after seeing this
+            finished.set()
+
+    try:
+        await asgi_app(scope, receive, send)
+    finally:
+        await close_clients()
+    status = messages[0]['status']
+    return status, b''.join(message.get('body', b'') for message in messages[1:])
+
+
+def _remove_generated(app, filenames):
+    for filename in filenames:
+        output_store.delete(filename)
+        gallery_index.remove(filename)
+
+
+def test_generate_image_async_end_to_end(app, fake_comfyui, tmp_path):
+    with app.app_context():
+        workflow = workflow_registry.get('base_workflow.json')
+        output = asyncio.run(_collect(generate_image_async(workflow, positive_prompt='a lighthouse', steps=3,
+                                                           batch_size=2, output_dir=str(tmp_path))))
+    assert "Progress: Step 3 of 3" in output
+    images = output[-1]
+    assert len(images) == 2
+    assert all(open(image['path'], 'rb').read().startswith(b'\x89PNG') for image in images)
+    assert fake_comfyui.completed == 1
+
+
+def test_identical_async_generations_are_coalesced(app, fake_comfyui, tmp_path):
+    app.config['COALESCE_ENABLED'] = True
+    fake_comfyui.step_seconds = 0.02
+    workflow = workflow_registry.get('base_workflow.json')
+
+    async def generate():
+        return [item async for item in generate_image_async(workflow, positive_prompt='a shared lighthouse', seed=7,
+                                                            steps=5, output_dir=str(tmp_path))]
+
+    async def both():
+        try:
+            return await asyncio.gather(generate(), generate())
+        finally:
+            await close_clients()
+
+    with app.app_context():
+        first, second = asyncio.run(both())
+    assert fake_comfyui.completed == 1
+    assert "Joined in-flight generation shared by 2 requests" in second
+    assert len(first[-1]) == len(second[-1]) == 1
+    assert first[-1][0]['path'] != second[-1][0]['path']
+
+
+def test_asgi_generate_returns_json(app, fake_comfyui):
+    status, body = asyncio.run(_call(AsyncGenerationApp(app), '/generate', FORM))
+    data = json.loads(body)
+    assert status == 200
+    assert data['success'], data
+    assert data['trace']['stages']
+    _remove_generated(app, data['filenames'])
+    assert fake_comfyui.completed == 1
+
+
+def test_asgi_generate_stream_sends_events(app, fake_comfyui):
+    status, body = asyncio.run(_call(AsyncGenerationApp(app), '/generate/stream', FORM))
+    events = body.decode('utf-8').strip().split('\n\n')
+    assert status == 200
+    assert events[0].startswith('event: progress')
+    assert any(event.startswith('event: preview') for event in events)
+    assert events[-1].startswith('event: result')
+    result = json.loads(events[-1].split('data: ', 1)[1])
+    _remove_generated(app, result['filenames'])
+
+
+def test_asgi_invalid_form_falls_back_to_flask(app, fake_comfyui):
+    status, body = asyncio.run(_call(AsyncGenerationApp(app), '/generate/stream', {'positive_prompt': ''}))
+    assert status == 400
+    assert json.loads(body)['error'] == 'Invalid form data'
+    assert fake_comfyui.completed == 0
+
+
+def test_asgi_disconnect_interrupts_the_prompt(app, fake_comfyui):
+    fake_comfyui.step_seconds = 0.02
+    status, body = asyncio.run(_call(AsyncGenerationApp(app), '/generate/stream', dict(FORM, steps='50'),
+                                     disconnect_on=b'Step 2 of 50'))
+    assert status == 200
+    assert b'event: result' not in body
+    deadline = time.time() + 5
+    while not fake_comfyui.interrupted:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    assert fake_comfyui.completed == 0
+
+
+def test_image_downloads_are_bounded_by_fetch_workers(app, fake_comfyui, tmp_path, monkeypatch):
+    app.config['COMFYUI_FETCH_WORKERS'] = 2
+    fake_comfyui.images_per_prompt = 6
+    active = []
+    peak = []
+    fetch_image = AsyncComfyUIClient.fetch_image
+
+    async def counting_fetch(self, image, output_dir=None):
+        active.append(1)
+        peak.append(len(active))
+        try:
+            await asyncio.sleep(0.01)
+            return await fetch_image(self, image, output_dir)
+        finally:
+            active.pop()
+
+    monkeypatch.setattr(AsyncComfyUIClient, 'fetch_image', counting_fetch)
+    with app.app_context():
+        workflow = workflow_registry.get('base_workflow.json')
+        output = asyncio.run(_collect(generate_image_async(workflow, positive_prompt='a lighthouse', steps=1,
+                                                           output_dir=str(tmp_path))))
+    assert len(output[-1]) == 6
+    assert max(peak) == 2
+
+
+def test_asgi_admission_runs_off_the_event_loop(app, fake_comfyui, monkeypatch):
+    threads = []
+    admission_ticket = routes._admission_ticket
+
+    def recording_ticket(*args):
+        threads.append(threading.current_thread())
+        return admission_ticket(*args)
+
+    monkeypatch.setattr(routes, '_admission_ticket', recording_ticket)
+    status, body = asyncio.run(_call(AsyncGenerationApp(app), '/generate', FORM))
+    assert status == 200
+    _remove_generated(app, json.loads(body)['filenames'])
+    assert threads and threads[0] is not threading.main_thread()
+
+
+def test_flask_requests_run_concurrently_under_asgi(app, monkeypatch):
+    # Each request waits for the other; run one at a time, the barrier would time out
+    barrier = threading.Barrier(2, timeout=5)
+
+    def slow_app(environ, start_response):
+        barrier.wait()
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'done']
+
+    monkeypatch.setattr(app, 'wsgi_app', slow_app)
+    asgi_app = AsyncGenerationApp(app)
+
+    async def get(path):
+        scope = {'type': 'http', 'http_version': '1.1', 'method': 'GET', 'scheme': 'http', 'path': path,
+                 'raw_path': path.encode('ascii'), 'query_string': b'', 'root_path': '',
+                 'server': ('testserver', 80), 'client': ('127.0.0.1', 1234), 'headers': [(b'host', b'testserver')]}
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        await asgi_app(scope, receive, send)
+        return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+    async def both():
+        return await asyncio.gather(get('/jobs/a'), get('/jobs/b'))
+
+    assert asyncio.run(both()) == [(200, b'done'), (200, b'done')]
+    asgi_app.executor.shutdown()
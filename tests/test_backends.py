@@ -0,0 +1,65 @@
+from unittest.mock import Mock, patch
+from app.backends import BackendPool, parse_backend_urls
+from app.utils import get_probe_session
+
+
+def fake_session(queues, down=()):
+    def get(url):
+        base, endpoint = url.rsplit('/', 1)
+        if base in down:
+            raise ConnectionError(f"{base} is down")
+        response = Mock()
+        if endpoint == 'queue':
+            response.json.return_value = {'queue_running': [[0]] if queues[base] else [],
+                                          'queue_pending': [[0]] * max(queues[base] - 1, 0)}
+        else:
+            response.json.return_value = {'devices': [{'vram_free': 1024}]}
+        return response
+    session = Mock()
+    session.get.side_effect = get
+    return session
+
+
+def test_parse_backend_urls():
+    assert parse_backend_urls("http://a:8188, http://b:8188/") == ["http://a:8188", "http://b:8188"]
+    assert parse_backend_urls("http://localhost:8188") == ["http://localhost:8188"]
+
+
+def test_single_backend_is_not_probed(app):
+    with app.app_context(), patch('app.utils.get_probe_session') as get_probe_session:
+        pool = BackendPool()
+        assert pool.acquire() == "http://localhost:8188"
+        get_probe_session.assert_not_called()
+
+
+def test_routes_to_least_loaded_backend(app):
+    app.config['COMFYUI_URL'] = "http://a:8188,http://b:8188"
+    session = fake_session({"http://a:8188": 3, "http://b:8188": 1})
+    with app.app_context(), patch('app.utils.get_probe_session', return_value=session):
+        pool = BackendPool()
+        assert pool.acquire() == "http://b:8188"
+        assert pool.acquire() == "http://b:8188"
+        # b now has 1 queued + 2 assigned, a has 3 queued; ties prefer the first listed backend
+        assert pool.acquire() == "http://a:8188"
+
+
+def test_dead_backend_is_skipped_until_retry(app):
+    app.config['COMFYUI_URL'] = "http://a:8188,http://b:8188"
+    session = fake_session({"http://a:8188": 0, "http://b:8188": 5}, down={"http://a:8188"})
+    with app.app_context(), patch('app.utils.get_probe_session', return_value=session):
+        pool = BackendPool()
+        assert pool.acquire() == "http://b:8188"
+        status = {backend['url']: backend for backend in pool.status()}
+        assert status["http://a:8188"]['healthy'] is False
+
+        pool.mark_failed("http://b:8188", "refused")
+        # With every backend down, the one that has been down longest is still tried
+        assert pool.acquire() == "http://a:8188"
+
+
+def test_probe_session_has_short_timeout_and_no_retries(app):
+    app.config['BACKEND_PROBE_TIMEOUT'] = 0.5
+    with app.app_context(), patch.dict('app.utils._probe_sessions', clear=True):
+        session = get_probe_session()
+    assert session.timeout == 0.5
+    assert session.get_adapter("http://a:8188").max_retries.total == 0
@@ -0,0 +1,128 @@
+import io
+import time
+import zipfile
+import pytest
+from unittest.mock import patch
+from app.batch import BatchError, expand_batch, expand_sweep, parse_jsonl
+from app.jobs import job_manager, COMPLETED, FAILED
+
+
+def test_expand_sweep_is_cross_product():
+    items = expand_sweep({"base": {"positive_prompt": "fox"},
+                          "axes": {"cfg": [5, 7], "steps": [10, 20, 30]}})
+    assert len(items) == 6
+    assert items[0] == {"positive_prompt": "fox", "cfg": 5, "steps": 10}
+    assert items[-1] == {"positive_prompt": "fox", "cfg": 7, "steps": 30}
+
+
+def test_expand_batch_validates_items():
+    with pytest.raises(BatchError, match="unknown parameters"):
+        expand_batch({"jobs": [{"positive_prompt": "fox", "colour": "red"}]}, 10)
+    with pytest.raises(BatchError, match="no positive_prompt"):
+        expand_batch({"jobs": [{"steps": 10}]}, 10)
+    with pytest.raises(BatchError, match="limit is 2"):
+        expand_batch({"jobs": [{"positive_prompt": "fox"}] * 3}, 2)
+
+
+@pytest.mark.parametrize("params, message", [
+    ({"steps": 100000}, "invalid steps"),
+    ({"width": 8192}, "invalid width"),
+    ({"cfg": "lots"}, "invalid cfg"),
+    ({"ckpt_name": "SD15/not_a_checkpoint.safetensors"}, "invalid ckpt_name"),
+    ({"ckpt_name": ""}, "no ckpt_name"),
+    ({"sampler_name": "rm -rf"}, "invalid sampler_name"),
+    ({"seed": "abc"}, "invalid seed"),
+    ({"batch_size": 64}, "invalid batch_size"),
+])
+def test_expand_batch_enforces_form_limits(params, message):
+    with pytest.raises(BatchError, match=message):
+        expand_batch({"jobs": [dict(params, positive_prompt="fox")]}, 10)
+
+
+def test_expand_batch_coerces_values_like_the_form():
+    items = expand_batch({"jobs": [{"positive_prompt": "fox", "steps": "30", "cfg": 7, "seed": "42"}]}, 10)
+    assert items == [{"positive_prompt": "fox", "steps": 30, "cfg": 7.0, "seed": 42}]
+
+
+def test_parse_jsonl():
+    stream = io.BytesIO(b'{"positive_prompt": "a"}\n\n{"positive_prompt": "b"}\n')
+    assert parse_jsonl(stream) == [{"positive_prompt": "a"}, {"positive_prompt": "b"}]
+    with pytest.raises(BatchError, match="Line 1"):
+        parse_jsonl(io.BytesIO(b'not json\n'))
+
+
+@patch('app.routes.generate_image')
+def test_batch_sweep_end_to_end(mock_generate_image, client, app):
+    def fake_generate_image(workflow, output_dir=None, **params):
+        if params['cfg'] == 9:
+            return iter(["Error: out of memory", []])
+        return iter([[{"image_data": f"cfg={params['cfg']:g}".encode(), "file_name": "x.png", "type": "output"}]])
+    mock_generate_image.side_effect = fake_generate_image
+
+    response = client.post('/batch', json={
+        "sweep": {"base": {"positive_prompt": "fox"}, "axes": {"cfg": [5, 7, 9]}}
+    })
+    assert response.status_code == 202
+    batch_id = response.json['job_id']
+
+    deadline = time.time() + 5
+    while job_manager.get(batch_id)['status'] not in (COMPLETED, FAILED) and time.time() < deadline:
+        time.sleep(0.01)
+    assert job_manager.get(batch_id)['status'] == COMPLETED
+
+    manifest = client.get(response.json['manifest_url']).json
+    assert [item['status'] for item in manifest['items']] == ['completed', 'completed', 'failed']
+    assert manifest['items'][2]['error'] == "Error: out of memory"
+
+    archive = zipfile.ZipFile(io.BytesIO(client.get(response.json['archive_url']).data))
+    names = archive.namelist()
+    assert 'manifest.json' in names
+    assert archive.read(manifest['items'][1]['filenames'][0]) == b"cfg=7"
+
+
+def test_batch_rejects_bad_spec(client, app):
+    response = client.post('/batch', json={"jobs": []})
+    assert response.status_code == 400
+    response = client.post('/batch', json={"jobs": [{"positive_prompt": "a"}], "workflow": "missing.json"})
+    assert response.status_code == 400
+    assert client.get('/batch/doesnotexist/manifest').status_code == 404
+
+
+@pytest.mark.parametrize("body, message", [
+    ([{"positive_prompt": "a"}], "must be a JSON object"),
+    ({"sweep": ["cfg"]}, "Sweep must be an object"),
+    ({"jobs": {"positive_prompt": "a"}}, "jobs must be a list"),
+    ({"jobs": [{"positive_prompt": "a"}], "workflow": 3}, "must be a file name"),
+    ({"jobs": [{"positive_prompt": "a"}], "workflow": "basic_image_to_image.json"}, "not a text-to-image workflow"),
+])
+def test_batch_rejects_malformed_requests(client, app, body, message):
+    response = client.post('/batch', json=body)
+    assert response.status_code == 400
+    assert message in response.get_json()['error']
+
+
+@patch('app.routes.generate_image')
+def test_cancel_batch_stops_every_item(mock_generate_image, client, app):
+    from app import cancellation
+    from app.jobs import CANCELLED
+
+    def fake_generate_image(workflow, output_dir=None, **params):
+        yield "Prompt queued with ID: test_id"
+        while True:
+            cancellation.check()
+            time.sleep(0.01)
+    mock_generate_image.side_effect = fake_generate_image
+
+    response = client.post('/batch', json={"jobs": [{"positive_prompt": f"fox {n}"} for n in range(6)]})
+    batch_id = response.json['job_id']
+    deadline = time.time() + 5
+    while 'running' not in {item['status'] for item in client.get(f'/batch/{batch_id}/manifest').json['items']}:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    assert client.post(response.json['cancel_url']).status_code == 202
+
+    while job_manager.get(batch_id)['status'] != CANCELLED:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    statuses = {item['status'] for item in client.get(f'/batch/{batch_id}/manifest').json['items']}
+    assert statuses == {'cancelled'}
@@ -0,0 +1,86 @@
+import os
+import time
+import pytest
+from unittest.mock import patch
+from app.cache import ResultCache
+from app.utils import generate_image
+
+WORKFLOW = '{"3": {"class_type": "KSampler", "inputs": {"positive": ["6"], "negative": ["7"]}}, "4": {"class_type": "CheckpointLoaderSimple", "inputs": {}}, "5": {"class_type": "EmptyLatentImage", "inputs": {}}, "6": {"class_type": "CLIPTextEncode", "inputs": {}}, "7": {"class_type": "CLIPTextEncode", "inputs": {}}}'
+
+
+class FakeApp:
+    def __init__(self, cache_dir, max_bytes=1024 ** 2):
+        self.config = {
+            'RESULT_CACHE_ENABLED': True,
+            'RESULT_CACHE_DIR': str(cache_dir),
+            'RESULT_CACHE_MAX_BYTES': max_bytes,
+        }
+        self.extensions = {}
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache(FakeApp(tmp_path / "cache"))
+
+
+def test_key_ignores_dict_order():
+    assert ResultCache.key({"a": 1, "b": {"c": 2}}) == ResultCache.key({"b": {"c": 2}, "a": 1})
+    assert ResultCache.key({"a": 1}) != ResultCache.key({"a": 2})
+
+
+def test_key_includes_input_image(tmp_path):
+    first = tmp_path / "first.png"
+    second = tmp_path / "second.png"
+    first.write_bytes(b"first")
+    second.write_bytes(b"second")
+    assert ResultCache.key({"a": 1}, str(first)) != ResultCache.key({"a": 1}, str(second))
+
+
+def test_put_then_get(cache, tmp_path):
+    key = ResultCache.key({"a": 1})
+    assert cache.get(key) is None
+
+    streamed = tmp_path / "streamed.png"
+    streamed.write_bytes(b"from disk")
+    cache.put(key, [
+        {"image_data": b"in memory", "file_name": "a.png", "type": "output"},
+        {"image_data": None, "file_name": "b.png", "type": "output", "path": str(streamed)},
+        {"image_data": None, "file_name": "c.png", "type": "output", "error": "timeout"},
+    ])
+
+    images = cache.get(key)
+    assert [image["image_data"] for image in images] == [b"in memory", b"from disk"]
+
+    output_dir = tmp_path / "generated"
+    images = cache.get(key, str(output_dir))
+    assert open(images[1]["path"], "rb").read() == b"from disk"
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 1
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResultCache(FakeApp(tmp_path / "cache", max_bytes=10))
+    old_key, new_key = ResultCache.key({"n": 1}), ResultCache.key({"n": 2})
+    cache.put(old_key, [{"image_data": b"123456", "file_name": "a.png", "type": "output"}])
+    meta = os.path.join(cache._entry_dir(old_key), "meta.json")
+    os.utime(meta, (time.time() - 60, time.time() - 60))
+
+    cache.put(new_key, [{"image_data": b"123456", "file_name": "b.png", "type": "output"}])
+
+    assert cache.get(old_key) is None
+    assert cache.get(new_key) is not None
+
+
+def test_generate_image_with_seed_uses_cache(app, tmp_path):
+    cache = ResultCache(FakeApp(tmp_path / "cache"))
+    images = [{"image_data": b"image_data", "file_name": "test.png", "type": "output"}]
+
+    with app.app_context(), patch('app.utils.result_cache', cache), \
+            patch('app.utils.generate_image_by_prompt', return_value=iter([images])) as mock_generate:
+        first = list(generate_image(WORKFLOW, "test positive", seed=42))
+        second = list(generate_image(WORKFLOW, "test positive", seed=42))
+
+    mock_generate.assert_called_once()
+    assert first[-1] == images
+    assert second[0].startswith("Cache hit")
+    assert second[-1][0]["image_data"] == b"image_data"
@@ -0,0 +1,106 @@
+import time
+import pytest
+from bench.fake_comfyui import FakeComfyUI
+from app import cancellation
+from app.cancellation import CancelScope, Cancelled, PromptWatch
+from app.utils import generate_image
+from app.websocket_manager import close_websocket_managers
+from app.workflows import workflow_registry
+
+
+@pytest.fixture
+def fake_comfyui(app):
+    fake = FakeComfyUI(step_seconds=0.02).start()
+    app.config.update(COMFYUI_URL=fake.url, RESULT_CACHE_ENABLED=False, COALESCE_ENABLED=False)
+    yield fake
+    close_websocket_managers()
+    fake.stop()
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "condition not met in time"
+        time.sleep(0.01)
+
+
+def test_scope_deadline_marker_and_parent(tmp_path):
+    assert not CancelScope().cancelled
+    scope = CancelScope(deadline=0.01)
+    time.sleep(0.02)
+    with pytest.raises(Cancelled, match='Deadline exceeded'):
+        scope.check()
+    assert scope.reason == 'deadline'
+
+    marker = tmp_path / 'job.cancel'
+    scope = CancelScope(marker_path=str(marker))
+    assert not scope.cancelled
+    marker.touch()
+    scope._marker_checked = 0
+    assert scope.cancelled and scope.reason == 'cancelled'
+
+    parent = CancelScope()
+    child = CancelScope(parent=parent)
+    with child.activate():
+        cancellation.check()
+        parent.cancel()
+        with pytest.raises(Cancelled):
+            cancellation.check()
+    assert cancellation.current() is None
+    child.record_saved(2.5)
+    assert parent.gpu_seconds_saved == 2.5
+
+
+def test_prompt_watch_estimates_remaining_gpu_time(monkeypatch):
+    monkeypatch.setattr(cancellation, '_execution_seconds', {})
+    watch = PromptWatch('p1', 'ckpt')
+    assert watch.remaining_seconds() == 0.0
+    cancellation.record_execution('ckpt', 10.0)
+    assert watch.remaining_seconds() == 10.0
+
+    watch.start()
+    watch.started_at -= 4
+    assert 5.9 < watch.remaining_seconds() <= 6.0
+    watch.progress('Progress: Step 1 of 4')
+    assert 11.9 < watch.remaining_seconds() < 12.1
+
+
+def test_abandoned_stream_interrupts_the_running_prompt(app, fake_comfyui):
+    scope = CancelScope()
+    with app.app_context(), scope.activate():
+        output = generate_image(workflow_registry.get('base_workflow.json'), 'a slow render', steps=50)
+        for item in output:
+            if item == 'Progress: Step 2 of 50':
+                break
+        # What the server does when the client of a stream goes away
+        output.close()
+        wait_until(lambda: fake_comfyui.interrupted)
+    assert fake_comfyui.completed == 0
+    assert scope.gpu_seconds_saved > 0
+
+
+def test_abandoned_coalesced_stream_credits_the_saving_to_its_scope(app, fake_comfyui):
+    app.config['COALESCE_ENABLED'] = True
+    scope = CancelScope()
+    with app.app_context(), scope.activate():
+        output = generate_image(workflow_registry.get('base_workflow.json'), 'a shared slow render', steps=50)
+        for item in output:
+            if item == 'Progress: Step 2 of 50':
+                break
+        output.close()
+        wait_until(lambda: fake_comfyui.interrupted)
+    assert fake_comfyui.completed == 0
+    assert scope.gpu_seconds_saved > 0
+
+
+def test_deadline_deletes_a_queued_prompt(app, fake_comfyui):
+    # Keep the only simulated GPU busy so the next prompt waits in ComfyUI's queue
+    blocker, _ = fake_comfyui.submit({'1': {'class_type': 'KSampler', 'inputs': {'steps': 200}}}, 'someone-else')
+    wait_until(lambda: blocker in fake_comfyui.running)
+    with app.app_context(), CancelScope(deadline=0.5).activate():
+        output = list(generate_image(workflow_registry.get('base_workflow.json'), 'never rendered', steps=3))
+    assert output[-2] == 'Error: Deadline exceeded'
+    assert output[-1] == []
+    assert len(fake_comfyui.deleted) == 1
+    assert fake_comfyui.interrupted == []
+    fake_comfyui.interrupt(blocker)
@@ -0,0 +1,163 @@
+import os
+import threading
+import time
+import pytest
+from app import cancellation
+from app.cancellation import CancelScope, Cancelled
+from app.coalesce import SingleFlight
+
+
+def test_followers_share_the_leaders_generation(tmp_path):
+    flight = SingleFlight()
+    release = threading.Event()
+    output = tmp_path / ".tmp_out.png"
+    output.write_bytes(b"rendered")
+    calls = []
+
+    def make_generator():
+        calls.append(1)
+        yield "Prompt queued with ID: test_id"
+        release.wait(5)
+        yield "Progress: 1/1 tasks done"
+        yield [{"image_data": None, "file_name": "out.png", "type": "output", "path": str(output)}]
+
+    leader = flight.run("key", make_generator)
+    assert next(leader) == "Prompt queued with ID: test_id"
+
+    results = []
+    follower = threading.Thread(target=lambda: results.append(list(flight.run("key", make_generator))))
+    follower.start()
+    while flight.stats()["coalesced"] == 0:
+        pass
+    release.set()
+    leader_items = list(leader)
+    follower.join(5)
+
+    assert len(calls) == 1
+    follower_items = results[0]
+    assert follower_items[0] == "Joined in-flight generation shared by 2 requests"
+    assert follower_items[1:3] == ["Prompt queued with ID: test_id", "Progress: 1/1 tasks done"]
+    follower_path = follower_items[-1][0]["path"]
+    assert follower_path != leader_items[-1][0]["path"]
+    assert open(follower_path, "rb").read() == b"rendered"
+    assert flight.stats() == {"coalesced": 1, "in_flight": 0}
+
+
+def test_followers_keep_the_generation_when_the_leader_leaves():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def make_generator():
+        calls.append(1)
+        yield "Prompt queued with ID: test_id"
+        release.wait(5)
+        # Still running for the follower, so it has not been cancelled
+        cancellation.check()
+        yield "Progress: 1/1 tasks done"
+        yield [{"image_data": b"rendered", "file_name": "out.png", "type": "output"}]
+
+    leader = flight.run("key", make_generator)
+    assert next(leader) == "Prompt queued with ID: test_id"
+    follower = flight.run("key", make_generator)
+    assert next(follower) == "Joined in-flight generation shared by 2 requests"
+    leader.close()
+    release.set()
+
+    assert list(follower) == ["Prompt queued with ID: test_id", "Progress: 1/1 tasks done",
+                              [{"image_data": b"rendered", "file_name": "out.png", "type": "output"}]]
+    assert len(calls) == 1
+
+
+def test_generation_is_cancelled_once_everyone_leaves():
+    flight = SingleFlight()
+    stopped = []
+
+    def make_generator():
+        yield "Prompt queued with ID: test_id"
+        try:
+            while True:
+                cancellation.check()
+                time.sleep(0.01)
+        except Cancelled as e:
+            stopped.append(e.reason)
+            yield f"Error: {e}"
+            yield []
+
+    leader = flight.run("key", make_generator)
+    next(leader)
+    follower = flight.run("key", make_generator)
+    next(follower)
+    leader.close()
+    time.sleep(0.05)
+    assert not stopped
+    follower.close()
+    deadline = time.time() + 5
+    while not stopped:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    assert stopped == ["abandoned"]
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_follower_honours_its_own_deadline():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def make_generator():
+        yield "Prompt queued with ID: test_id"
+        release.wait(5)
+        yield []
+
+    leader = flight.run("key", make_generator)
+    next(leader)
+    started = time.monotonic()
+    with CancelScope(deadline=0.2).activate():
+        follower = flight.run("key", make_generator)
+        with pytest.raises(Cancelled):
+            list(follower)
+    assert time.monotonic() - started < 1
+    release.set()
+    assert list(leader) == [[]]
+
+
+def test_results_nobody_collects_are_deleted(tmp_path):
+    flight = SingleFlight()
+    release = threading.Event()
+    output = tmp_path / ".tmp_out.png"
+    output.write_bytes(b"rendered")
+
+    def make_generator():
+        yield "Prompt queued with ID: test_id"
+        release.wait(5)
+        yield [{"image_data": None, "file_name": "out.png", "type": "output", "path": str(output)}]
+
+    leader = flight.run("key", make_generator)
+    next(leader)
+    gone = flight.run("key", make_generator)
+    next(gone)
+    gone.close()
+    stays = flight.run("key", make_generator)
+    next(stays)
+    release.set()
+    assert list(leader)[-1][0]["path"] == str(output)
+    follower_path = list(stays)[-1][0]["path"]
+    # Only the leader's file and the remaining follower's copy were written
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted([output.name, os.path.basename(follower_path)])
+
+    # A result that arrives after its only request has gone is deleted too
+    lone = flight.run("key", make_generator)
+    next(lone)
+    lone.close()
+    deadline = time.time() + 5
+    while output.exists():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_sequential_requests_are_not_coalesced():
+    flight = SingleFlight()
+    make_generator = lambda: iter(["done", []])
+    assert list(flight.run("key", make_generator)) == ["done", []]
+    assert list(flight.run("key", make_generator)) == ["done", []]
+    assert flight.stats()["coalesced"] == 0
@@ -0,0 +1,53 @@
+import pytest
+from bench.fake_comfyui import FakeComfyUI
+from app.previews import Preview
+from app.utils import generate_image, generate_image_to_image
+from app.websocket_manager import close_websocket_managers
+from app.workflows import workflow_registry
+
+
+@pytest.fixture
+def fake_comfyui(app):
+    fake = FakeComfyUI(step_seconds=0.001, image_size=16).start()
+    app.config.update(COMFYUI_URL=fake.url, RESULT_CACHE_ENABLED=False)
+    yield fake
+    close_websocket_managers()
+    fake.stop()
+
+
+def test_generate_image_end_to_end(app, fake_comfyui):
+    with app.app_context():
+        workflow = workflow_registry.get('base_workflow.json')
+        output = list(generate_image(workflow, 'a lighthouse at dusk', steps=3, batch_size=2))
+    assert "Progress: Step 3 of 3" in output
+    images = output[-1]
+    assert len(images) == 2
+    assert all(image['image_data'].startswith(b'\x89PNG') for image in images)
+    assert fake_comfyui.completed == 1
+    # The drawn seed travels with the images so the output store can record it
+    assert len({image['seed'] for image in images}) == 1 and isinstance(images[0]['seed'], int)
+
+
+def test_generate_image_to_image_end_to_end(app, fake_comfyui, tmp_path):
+    input_path = tmp_path / 'input.png'
+    input_path.write_bytes(b'input image')
+    with app.app_context():
+        workflow = workflow_registry.get('basic_image_to_image.json')
+        output = list(generate_image_to_image(workflow, str(input_path), 'make it snow', steps=2,
+                                              output_dir=str(tmp_path / 'out')))
+    assert 'input.png' in fake_comfyui.uploads
+    images = output[-1]
+    assert len(images) == 1
+    assert open(images[0]['path'], 'rb').read().startswith(b'\x89PNG')
+
+
+def test_generate_image_streams_previews(app, fake_comfyui):
+    app.config.update(PREVIEW_FPS=1000, PREVIEW_MAX_SIZE=8)
+    with app.app_context():
+        workflow = workflow_registry.get('base_workflow.json')
+        output = list(generate_image(workflow, 'a lighthouse at dusk', steps=3, live_previews=True))
+        plain = list(generate_image(workflow, 'a lighthouse at dusk', steps=3))
+    previews = [item for item in output if isinstance(item, Preview)]
+    assert previews and all((preview.width, preview.height) == (8, 8) for preview in previews)
+    assert len(output[-1]) == 1
+    assert not any(isinstance(item, Preview) for item in plain)
@@ -3,9 +3,7 @@ from app.forms import ImageGenerationForm, ImageToImageForm
 from werkzeug.datastructures import FileStorage
 
 @pytest.fixture
-def app():
-    from app import create_app
-    app = create_app()
+def app(app):
     app.config['WTF_CSRF_ENABLED'] = False
     return app
 
@@ -0,0 +1,210 @@
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from flask import url_for
+from unittest.mock import patch
+from app import cancellation
+from app.jobs import JobManager, job_manager, CANCELLED, COMPLETED, FAILED
+
+
+@pytest.fixture
+def app(app):
+    app.config['WTF_CSRF_ENABLED'] = False
+    return app
+
+
+def wait_for(manager, job_id, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = manager.get(job_id)
+        if job['status'] in (COMPLETED, FAILED, CANCELLED):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"Job {job_id} did not finish")
+
+
+def test_job_completes(app):
+    manager = JobManager(app)
+
+    def pipeline(on_progress):
+        on_progress("Progress: 1/1 tasks done")
+        return ['generated_test.png']
+
+    job = manager.submit('text_to_image', pipeline)
+    result = wait_for(manager, job.id)
+    assert result['status'] == COMPLETED
+    assert result['progress'] == "Progress: 1/1 tasks done"
+    assert result['filenames'] == ['generated_test.png']
+
+
+def test_job_failure_is_recorded(app):
+    manager = JobManager(app)
+
+    def pipeline(on_progress):
+        raise RuntimeError("boom")
+
+    job = manager.submit('text_to_image', pipeline)
+    result = wait_for(manager, job.id)
+    assert result['status'] == FAILED
+    assert result['error'] == "boom"
+
+
+def test_job_state_is_shared_through_jobs_dir(app):
+    manager = JobManager(app)
+    job = manager.submit('text_to_image', lambda on_progress: ['a.png'])
+
+    other_worker = JobManager(app)
+    assert wait_for(other_worker, job.id)['filenames'] == ['a.png']
+    assert other_worker.get('missing') is None
+    assert other_worker.get('../etc') is None
+
+
+def test_on_finish_runs_even_if_cancelled_before_start(app):
+    manager = JobManager(app)
+    finished = []
+    scope = cancellation.CancelScope()
+    scope.cancel()
+    job = manager.submit('text_to_image', lambda on_progress: ['a.png'], scope=scope,
+                         on_finish=lambda: finished.append(True))
+    assert wait_for(manager, job.id)['status'] == CANCELLED
+    deadline = time.time() + 5
+    while not finished and time.time() < deadline:
+        time.sleep(0.01)
+    assert finished == [True]
+
+
+def test_progress_writes_are_throttled(app):
+    app.config['JOB_PROGRESS_INTERVAL'] = 60
+    manager = JobManager(app)
+
+    def pipeline(on_progress):
+        for step in range(1, 21):
+            on_progress(f"Progress: {step}/20 steps")
+        return ['a.png']
+
+    with patch.object(manager, '_save', wraps=manager._save) as save:
+        job = manager.submit('text_to_image', pipeline)
+        result = wait_for(manager, job.id)
+    # Queued, running, the first progress message and the final state
+    assert save.call_count == 4
+    assert result['progress'] == "Progress: 20/20 steps"
+
+
+def test_prune_removes_stale_job_files(app):
+    manager = JobManager(app)
+    old = manager.submit('text_to_image', lambda on_progress: ['a.png'])
+    wait_for(manager, old.id)
+    with open(manager._cancel_path('gone'), 'w'):
+        pass
+    recent = manager.submit('text_to_image', lambda on_progress: ['b.png'])
+    wait_for(manager, recent.id)
+    # The final state is written just after the status flips
+    while manager._jobs:
+        time.sleep(0.01)
+    week_ago = time.time() - 8 * 24 * 3600
+    for path in (manager._path(old.id), manager._cancel_path('gone')):
+        os.utime(path, (week_ago, week_ago))
+
+    assert manager.prune() == 2
+    assert manager.get(old.id) is None
+    assert manager.get(recent.id)['filenames'] == ['b.png']
+
+
+@patch('app.routes.generate_image')
+def test_generate_post_job_mode(mock_generate_image, client, app):
+    mock_generate_image.return_value = iter([
+        "Prompt queued with ID: test_id",
+        [{"image_data": b"test_image_data", "file_name": "test.png", "type": "output"}]
+    ])
+
+    with app.test_request_context():
+        data = {
+            'positive_prompt': 'job mode prompt',
+            'steps': 20,
+            'cfg': 7.5,
+            'sampler_name': 'euler',
+            'scheduler': 'normal',
+            'denoise': 1,
+            'ckpt_name': 'SD15/cyberrealistic_classicV31.safetensors',
+            'width': 512,
+            'height': 512,
+            'batch_size': 1,
+            'mode': 'job'
+        }
+        response = client.post(url_for('main.generate'), data=data)
+        assert response.status_code == 202
+        job_id = response.json['job_id']
+
+        result = wait_for(job_manager, job_id)
+        assert result['status'] == COMPLETED
+
+        response = client.get(response.json['status_url'])
+        assert response.status_code == 200
+        [filename] = response.json['filenames']
+        assert re.match(r'^generated_[0-9a-f]{32}\.png$', filename)
+
+
+def test_queued_jobs_keep_their_admission_places(client, app, monkeypatch):
+    from app.admission import admission
+    monkeypatch.setattr(admission, 'enabled', True)
+    monkeypatch.setattr(admission, 'client_queue', 3)
+    monkeypatch.setattr(admission, 'stale_seconds', 0.6)
+    release = threading.Event()
+
+    def blocked_generation(workflow, **params):
+        release.wait(10)
+        yield []
+
+    data = {'positive_prompt': 'queued job', 'steps': 20, 'cfg': 7.5, 'sampler_name': 'euler',
+            'scheduler': 'normal', 'denoise': 1, 'ckpt_name': 'SD15/cyberrealistic_classicV31.safetensors',
+            'width': 512, 'height': 512, 'batch_size': 1, 'mode': 'job'}
+    with patch('app.routes.generate_image', side_effect=blocked_generation), \
+            patch.object(job_manager, '_executor', ThreadPoolExecutor(max_workers=1)):
+        try:
+            assert [client.post('/generate', data=data).status_code for _ in range(3)] == [202] * 3
+            # Long enough for tickets nothing polls to count as stale
+            time.sleep(1)
+            assert client.post('/generate', data=data).status_code == 429
+        finally:
+            release.set()
+
+
+def test_job_status_not_found(client, app):
+    with app.test_request_context():
+        response = client.get(url_for('main.job_status', job_id='doesnotexist'))
+        assert response.status_code == 404
+
+
+def _wait_for_cancel(on_progress):
+    on_progress("Rendering")
+    while True:
+        cancellation.check()
+        time.sleep(0.01)
+
+
+def test_cancel_job_route(client, app):
+    job = job_manager.submit('text_to_image', _wait_for_cancel)
+    wait_until_running = time.time() + 5
+    while job_manager.get(job.id)['progress'] != "Rendering":
+        assert time.time() < wait_until_running
+        time.sleep(0.01)
+
+    response = client.post(f'/jobs/{job.id}/cancel')
+    assert response.status_code == 202
+    result = wait_for(job_manager, job.id)
+    assert result['status'] == CANCELLED
+    assert result['error'] == 'Generation cancelled'
+
+    assert client.post(f'/jobs/{job.id}/cancel').status_code == 409
+    assert client.post('/jobs/doesnotexist/cancel').status_code == 404
+
+
+def test_cancel_reaches_a_job_in_another_worker(app):
+    manager = JobManager(app)
+    job = manager.submit('text_to_image', _wait_for_cancel)
+    other_worker = JobManager(app)
+    assert other_worker.cancel(job.id)['status'] in ('queued', 'running')
+    assert wait_for(manager, job.id)['status'] == CANCELLED
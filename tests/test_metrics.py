@@ -0,0 +1,39 @@
+from app.metrics import Stages, count_bytes, render
+
+
+def sample(text, line_start):
+    for line in text.splitlines():
+        if line.startswith(line_start):
+            return float(line.rsplit(' ', 1)[1])
+    return 0.0
+
+
+def test_stages_record_histograms_errors_and_in_flight():
+    stages = Stages('test_workflow.json', 'test.safetensors')
+    labels = 'checkpoint="test.safetensors",stage="queue_prompt",workflow="test_workflow.json"'
+    before = sample(render().decode(), f'imagine_stage_seconds_count{{{labels}}}')
+
+    with stages.stage('queue_prompt'):
+        pass
+    with stages.in_flight():
+        text = render().decode()
+        assert sample(text, 'imagine_jobs_in_flight{checkpoint="test.safetensors",workflow="test_workflow.json"}') == 1
+    stages.error(TimeoutError())
+
+    text = render().decode()
+    assert sample(text, f'imagine_stage_seconds_count{{{labels}}}') == before + 1
+    assert sample(text, 'imagine_jobs_in_flight{checkpoint="test.safetensors",workflow="test_workflow.json"}') == 0
+    assert sample(text, 'imagine_errors_total{checkpoint="test.safetensors",type="TimeoutError"') >= 1
+
+
+def test_count_bytes():
+    before = sample(render().decode(), 'imagine_bytes_total{direction="upload"}')
+    count_bytes('upload', 100)
+    assert sample(render().decode(), 'imagine_bytes_total{direction="upload"}') == before + 100
+
+
+def test_metrics_route(client):
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    assert b'imagine_stage_seconds' in response.data
@@ -0,0 +1,107 @@
+import os
+from app.models import GalleryIndex, IMAGE_TO_IMAGE, TEXT_TO_IMAGE, kind_for_filename
+
+
+class FakeApp:
+    def __init__(self, tmp_path):
+        self.config = {'GALLERY_DB': str(tmp_path / 'instance' / 'gallery.sqlite3')}
+        self.root_path = str(tmp_path)
+        self.extensions = {}
+
+
+def make_index(tmp_path, files=()):
+    generated_dir = tmp_path / 'static' / 'generated'
+    generated_dir.mkdir(parents=True)
+    for name, size in files:
+        (generated_dir / name).write_bytes(b'x' * size)
+    return GalleryIndex(FakeApp(tmp_path)), generated_dir
+
+
+def test_kind_for_filename():
+    assert kind_for_filename('generated_abc.png') == TEXT_TO_IMAGE
+    assert kind_for_filename('generated_i2i_abc.png') == IMAGE_TO_IMAGE
+
+
+def test_first_run_indexes_existing_files(tmp_path):
+    index, _ = make_index(tmp_path, [('generated_a.png', 10), ('generated_i2i_b.png', 20), ('other.txt', 5)])
+    images, total = index.page(TEXT_TO_IMAGE)
+    assert total == 1
+    assert images[0]['filename'] == 'generated_a.png'
+    assert images[0]['size'] == 10
+    assert index.page(IMAGE_TO_IMAGE)[1] == 1
+
+
+def test_page_sorts_and_paginates(tmp_path):
+    index, _ = make_index(tmp_path)
+    for i in range(5):
+        index.add(f'generated_{i}.png', size=100 - i, created=1000 + i)
+
+    images, total = index.page(TEXT_TO_IMAGE, page=1, per_page=2)
+    assert total == 5
+    assert [image['filename'] for image in images] == ['generated_4.png', 'generated_3.png']
+    images, _ = index.page(TEXT_TO_IMAGE, page=3, per_page=2)
+    assert [image['filename'] for image in images] == ['generated_0.png']
+    images, _ = index.page(TEXT_TO_IMAGE, per_page=2, sort='smallest')
+    assert [image['filename'] for image in images] == ['generated_4.png', 'generated_3.png']
+    images, _ = index.page(TEXT_TO_IMAGE, per_page=2, sort='oldest')
+    assert [image['filename'] for image in images] == ['generated_0.png', 'generated_1.png']
+
+
+def test_add_reads_size_and_remove(tmp_path):
+    index, generated_dir = make_index(tmp_path)
+    (generated_dir / 'generated_new.png').write_bytes(b'x' * 42)
+    index.add('generated_new.png')
+    assert index.page(TEXT_TO_IMAGE)[0][0]['size'] == 42
+    index.remove('generated_new.png')
+    assert index.page(TEXT_TO_IMAGE) == ([], 0)
+
+
+def test_reconcile(tmp_path):
+    index, generated_dir = make_index(tmp_path, [('generated_a.png', 1)])
+    index.add('generated_gone.png', size=1)
+    (generated_dir / 'generated_i2i_new.png').write_bytes(b'x')
+    assert index.reconcile() == (1, 1)
+    assert sorted(image['filename'] for image in index.page(TEXT_TO_IMAGE)[0]) == ['generated_a.png']
+    assert index.page(IMAGE_TO_IMAGE)[1] == 1
+    assert index.reconcile() == (0, 0)
+    assert os.path.exists(tmp_path / 'instance' / 'gallery.sqlite3')
+
+
+def test_migrates_an_older_database(tmp_path):
+    import sqlite3
+    db_path = tmp_path / 'instance' / 'gallery.sqlite3'
+    db_path.parent.mkdir()
+    with sqlite3.connect(db_path) as db:
+        db.execute('CREATE TABLE images (filename TEXT PRIMARY KEY, kind TEXT NOT NULL, size INTEGER NOT NULL, '
+                   'created REAL NOT NULL)')
+    index, _ = make_index(tmp_path, [('generated_a.png', 3)])
+    assert index.set_pinned('generated_a.png')
+    assert index.usage() == {'generated': 3, 'uploads': 0, 'pinned': 3}
+
+
+def test_candidates_skip_pinned_and_follow_order(tmp_path):
+    index, _ = make_index(tmp_path)
+    index.add('generated_old.png', size=1, created=100)
+    index.add('generated_new.png', size=1, created=200)
+    index.add('generated_pinned.png', size=1, created=50)
+    index.set_pinned('generated_pinned.png')
+    index.touch('generated_old.png', now=300)
+
+    assert [entry['filename'] for entry in index.candidates('oldest')] == ['generated_old.png', 'generated_new.png']
+    assert [entry['filename'] for entry in index.candidates('lru')] == ['generated_new.png', 'generated_old.png']
+    assert [entry['filename'] for entry in index.candidates('oldest', created_before=150)] == ['generated_old.png']
+    assert not index.set_pinned('generated_missing.png')
+
+
+def test_uploads_are_indexed_and_touched(tmp_path):
+    index, _ = make_index(tmp_path)
+    upload = tmp_path / 'static' / 'uploads' / 'abc.png'
+    upload.parent.mkdir()
+    upload.write_bytes(b'x' * 7)
+    index.add_upload(str(upload), now=100)
+    index.add_upload(str(upload), now=500)
+    [entry] = index.candidates()
+    assert entry == {'area': 'uploads', 'filename': 'abc.png', 'size': 7, 'created': 100, 'accessed': 500}
+    assert index.usage()['uploads'] == 7
+    index.remove_upload('abc.png')
+    assert list(index.candidates()) == []
@@ -0,0 +1,68 @@
+import base64
+import io
+import json
+import struct
+import pytest
+from app.previews import PREVIEW_IMAGE, PREVIEW_IMAGE_WITH_METADATA, PreviewThrottle, frame_prompt_id
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def png_bytes(size=(512, 256)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 30, 30)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def preview_frame(image, prompt_id=None):
+    if prompt_id is None:
+        return struct.pack('>II', PREVIEW_IMAGE, 2) + image
+    metadata = json.dumps({'image_type': 'image/png', 'prompt_id': prompt_id}).encode('utf-8')
+    return struct.pack('>II', PREVIEW_IMAGE_WITH_METADATA, len(metadata)) + metadata + image
+
+
+def test_frames_are_downscaled_to_jpeg():
+    throttle = PreviewThrottle(fps=10, max_size=64)
+    for frame in (preview_frame(png_bytes()), preview_frame(png_bytes(), prompt_id='p1')):
+        throttle._last = None
+        preview = throttle.render(throttle.take(frame))
+        assert (preview.width, preview.height) == (64, 32)
+        data_url = preview.to_dict()['image']
+        assert data_url.startswith('data:image/jpeg;base64,')
+        with Image.open(io.BytesIO(base64.b64decode(data_url.split(',', 1)[1]))) as image:
+            assert image.format == 'JPEG' and image.size == (64, 32)
+
+
+def test_throttle_drops_frames_between_intervals(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('app.previews.time.monotonic', lambda: now[0])
+    throttle = PreviewThrottle(fps=2)
+    frame = preview_frame(b'image')
+    assert throttle.take(frame) == b'image'
+    now[0] += 0.2
+    assert throttle.take(frame) is None
+    now[0] += 0.4
+    assert throttle.take(frame) == b'image'
+    # Binary events other than previews are never forwarded
+    now[0] += 1
+    assert throttle.take(struct.pack('>II', 3, 0) + b'text') is None
+
+
+def test_undecodable_frame_is_skipped():
+    throttle = PreviewThrottle(fps=2)
+    assert throttle.render(throttle.take(preview_frame(b'not an image'))) is None
+
+
+def test_from_config_honours_preview_fps(app):
+    with app.app_context():
+        app.config.update(PREVIEW_FPS=0)
+        assert PreviewThrottle.from_config() is None
+        app.config.update(PREVIEW_FPS=4, PREVIEW_MAX_SIZE=128)
+        throttle = PreviewThrottle.from_config()
+        assert throttle.interval == 0.25 and throttle.max_size == 128
+
+
+def test_frame_prompt_id():
+    assert frame_prompt_id(preview_frame(b'image', prompt_id='p1')) == 'p1'
+    assert frame_prompt_id(preview_frame(b'image')) is None
+    assert frame_prompt_id(b'short') is None
@@ -0,0 +1,111 @@
+import pytest
+from app import retention as retention_module
+from app.models import GalleryIndex
+from app.retention import RetentionManager
+
+DAY = 24 * 3600
+NOW = 1000 * DAY
+
+
+class FakeApp:
+    def __init__(self, tmp_path, **config):
+        self.config = {
+            'GALLERY_DB': str(tmp_path / 'instance' / 'gallery.sqlite3'),
+            'INSTANCE_DIR': str(tmp_path / 'instance'),
+            'RETENTION_MODE': 'off',
+            'RETENTION_MAX_BYTES': 0,
+            'RETENTION_MAX_AGE_DAYS': 0,
+            'RETENTION_ORDER': 'lru',
+            'RETENTION_INTERVAL': 600,
+            'RETENTION_MIN_AGE': 3600,
+            **config,
+        }
+        self.root_path = str(tmp_path)
+        self.extensions = {}
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """A gallery index and directories under tmp_path, with files added as (name, size, created, accessed)."""
+    for area in ('generated', 'uploads'):
+        (tmp_path / 'static' / area).mkdir(parents=True)
+    index = GalleryIndex(FakeApp(tmp_path))
+    monkeypatch.setattr(retention_module, 'gallery_index', index)
+    removed_thumbs = []
+    monkeypatch.setattr(retention_module.thumbnails, 'remove', removed_thumbs.append)
+
+    def add(name, size, created, accessed=None, area='generated'):
+        path = tmp_path / 'static' / area / name
+        path.write_bytes(b'x' * size)
+        if area == 'generated':
+            index.add(name, size=size, created=created)
+            if accessed:
+                index.touch(name, now=accessed)
+        else:
+            index.add_upload(str(path), now=created)
+        return path
+
+    add.index = index
+    add.removed_thumbs = removed_thumbs
+    return add
+
+
+def manager(tmp_path, **config):
+    return RetentionManager(FakeApp(tmp_path, **config))
+
+
+def test_budget_evicts_least_recently_used_first(tmp_path, store):
+    old = store('generated_old.png', 100, NOW - 10 * DAY, accessed=NOW - 2 * DAY)
+    recent = store('generated_recent.png', 100, NOW - 9 * DAY, accessed=NOW - DAY)
+    stale = store('generated_stale.png', 100, NOW - 5 * DAY)
+    report = manager(tmp_path, RETENTION_MAX_BYTES=150).run(dry_run=False, now=NOW)
+
+    assert [entry['filename'] for entry in report['files']] == ['generated_stale.png', 'generated_old.png']
+    assert report['evicted_bytes'] == 200
+    assert report['remaining_bytes'] == 100
+    assert not stale.exists() and not old.exists() and recent.exists()
+    assert sorted(store.removed_thumbs) == ['generated_old.png', 'generated_stale.png']
+    assert store.index.usage()['generated'] == 100
+
+
+def test_oldest_order_ignores_access(tmp_path, store):
+    store('generated_a.png', 100, NOW - 10 * DAY, accessed=NOW - 2 * DAY)
+    store('generated_b.png', 100, NOW - 5 * DAY)
+    report = manager(tmp_path, RETENTION_MAX_BYTES=100, RETENTION_ORDER='oldest').run(now=NOW)
+    assert [entry['filename'] for entry in report['files']] == ['generated_a.png']
+
+
+def test_dry_run_reports_without_deleting(tmp_path, store):
+    path = store('generated_a.png', 100, NOW - 40 * DAY)
+    upload = store('abc.png', 50, NOW - 31 * DAY, area='uploads')
+    report = manager(tmp_path, RETENTION_MAX_AGE_DAYS=30).run(dry_run=True, now=NOW)
+    assert report['dry_run']
+    assert report['by_reason'] == {'age': 2, 'budget': 0}
+    assert report['evicted_bytes'] == 150
+    assert path.exists() and upload.exists()
+    assert len(list(store.index.candidates())) == 2
+
+
+def test_pinned_and_recently_used_files_are_kept(tmp_path, store):
+    pinned = store('generated_pinned.png', 100, NOW - 40 * DAY)
+    store.index.set_pinned('generated_pinned.png')
+    in_use = store('abc.png', 100, NOW - 40 * DAY, area='uploads')
+    store.index.add_upload(str(in_use), now=NOW - 60)
+    report = manager(tmp_path, RETENTION_MAX_AGE_DAYS=30, RETENTION_MAX_BYTES=50).run(dry_run=False, now=NOW)
+    assert report['evicted_files'] == 0
+    assert report['over_budget']
+    assert report['pinned_bytes'] == 100
+    assert pinned.exists() and in_use.exists()
+
+
+def test_uploads_are_deleted_from_their_directory(tmp_path, store):
+    upload = store('abc.png', 100, NOW - 40 * DAY, area='uploads')
+    report = manager(tmp_path, RETENTION_MAX_AGE_DAYS=30).run(dry_run=False, now=NOW)
+    assert report['files'] == [{'area': 'uploads', 'filename': 'abc.png', 'size': 100, 'reason': 'age'}]
+    assert not upload.exists()
+    assert store.index.usage()['uploads'] == 0
+
+
+def test_rejects_unknown_mode(tmp_path):
+    with pytest.raises(ValueError):
+        manager(tmp_path, RETENTION_MODE='sometimes')
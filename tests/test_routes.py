@@ -1,6 +1,12 @@
+import json
+import os
+import re
 import pytest
 from flask import url_for
 from unittest.mock import patch, Mock
+from app import routes
+from app.previews import Preview
+from app.storage import output_store
 import io
 
 def test_index(client, app):
@@ -74,16 +80,268 @@ def test_generate_image_to_image_post(mock_generate_image_to_image, client, app)
         assert response.json['success'] == True
         assert 'filename' in response.json
 
-def test_result(client, app):
+def test_result(client, app, generated_file):
     with app.test_request_context():
-        response = client.get(url_for('main.result', filename='test.png'))
+        response = client.get(url_for('main.result', filename=generated_file))
         assert response.status_code == 200
         assert b"Generated Image" in response.data
+        assert client.get(url_for('main.result', filename='generated_missing.png')).status_code == 404
 
 @patch('app.routes.send_file')
-def test_download(mock_send_file, client, app):
-    mock_send_file.return_value = 'mocked file'
+def test_download(mock_send_file, client, app, generated_file):
+    from flask import Response
+    mock_send_file.return_value = Response('mocked file')
     with app.test_request_context():
-        response = client.get(url_for('main.download', filename='test.png'))
+        response = client.get(url_for('main.download', filename=generated_file))
         assert response.status_code == 200
-        mock_send_file.assert_called_once()
\ No newline at end of file
+        mock_send_file.assert_called_once()
+
+@patch('app.routes.generate_image')
+def test_generate_stream(mock_generate_image, client, app):
+    app.config['WTF_CSRF_ENABLED'] = False
+    mock_generate_image.return_value = iter([
+        "Prompt queued with ID: test_id",
+        "Progress: Step 5 of 10",
+        [{"image_data": b"test_image_data", "file_name": "test.png", "type": "output"}]
+    ])
+
+    with app.test_request_context():
+        data = {
+            'positive_prompt': 'stream prompt',
+            'steps': 20,
+            'cfg': 7.5,
+            'sampler_name': 'euler',
+            'scheduler': 'normal',
+            'denoise': 1,
+            'ckpt_name': 'SD15/cyberrealistic_classicV31.safetensors',
+            'width': 512,
+            'height': 512,
+            'batch_size': 1
+        }
+        response = client.post(url_for('main.generate_stream'), data=data)
+        assert response.status_code == 200
+        assert response.mimetype == 'text/event-stream'
+        body = response.get_data(as_text=True)
+        assert 'event: progress\ndata: {"message": "Progress: Step 5 of 10"}' in body
+        assert 'event: result' in body
+        assert re.search(r'"filename": "generated_[0-9a-f]{32}\.png"', body)
+
+
+@patch('app.routes.generate_image')
+def test_generate_stream_forwards_previews(mock_generate_image, client, app):
+    app.config['WTF_CSRF_ENABLED'] = False
+    form = {'positive_prompt': 'stream prompt', 'ckpt_name': 'SD15/cyberrealistic_classicV31.safetensors'}
+
+    with app.test_request_context():
+        mock_generate_image.return_value = iter([
+            "Progress: Step 1 of 10",
+            Preview(b'jpeg', 'image/jpeg', 32, 32),
+            [{"image_data": b"test_image_data", "file_name": "test.png", "type": "output"}]
+        ])
+        body = client.post(url_for('main.generate_stream'), data=form).get_data(as_text=True)
+        assert mock_generate_image.call_args.kwargs['live_previews'] is True
+        # Streaming previews does not keep ComfyUI's temp images
+        assert not mock_generate_image.call_args.kwargs.get('save_previews')
+        assert ('event: preview\ndata: {"image": "data:image/jpeg;base64,anBlZw==", "width": 32, "height": 32}'
+                in body)
+        assert 'event: result' in body
+
+        mock_generate_image.return_value = iter(["Error: stop here", []])
+        client.post(url_for('main.generate_stream'), data=dict(form, previews='0')).get_data()
+        assert mock_generate_image.call_args.kwargs['live_previews'] is False
+
+
+@patch('app.routes.generate_image')
+def test_disk_write_is_labelled_by_workflow_and_checkpoint(mock_generate_image, client, app):
+    from prometheus_client import REGISTRY
+    app.config['WTF_CSRF_ENABLED'] = False
+    mock_generate_image.return_value = iter([[{"image_data": b"x", "file_name": "test.png", "type": "output"}]])
+    labels = {'stage': 'disk_write', 'workflow': 'base_workflow.json',
+              'checkpoint': 'SD15/cyberrealistic_classicV31.safetensors'}
+    before = REGISTRY.get_sample_value('imagine_stage_seconds_count', labels) or 0
+
+    response = client.post('/generate', data={'positive_prompt': 'labelled',
+                                               'ckpt_name': 'SD15/cyberrealistic_classicV31.safetensors'})
+    assert response.json['success']
+    assert REGISTRY.get_sample_value('imagine_stage_seconds_count', labels) == before + 1
+
+
+@patch('app.routes.generate_image')
+def test_generate_stream_error(mock_generate_image, client, app):
+    app.config['WTF_CSRF_ENABLED'] = False
+    mock_generate_image.return_value = iter(["Error: ComfyUI unreachable", []])
+
+    with app.test_request_context():
+        response = client.post(url_for('main.generate_stream'), data={
+            'positive_prompt': 'stream prompt',
+            'ckpt_name': 'SD15/cyberrealistic_classicV31.safetensors',
+        })
+        body = response.get_data(as_text=True)
+        assert 'event: error' in body
+        assert 'ComfyUI unreachable' in body
+
+
+def test_generate_stream_invalid_form(client, app):
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.test_request_context():
+        response = client.post(url_for('main.generate_stream'), data={})
+        assert response.status_code == 400
+        assert response.json['success'] == False
+
+
+@patch('app.routes.generate_image')
+def test_generate_saves_every_batch_image(mock_generate_image, client, app):
+    app.config['WTF_CSRF_ENABLED'] = False
+    mock_generate_image.return_value = iter([
+        [{"image_data": b"first", "file_name": "a.png", "type": "output"},
+         {"image_data": None, "file_name": "b.png", "type": "output", "error": "timeout"},
+         {"image_data": b"third", "file_name": "c.png", "type": "output"}]
+    ])
+
+    with app.test_request_context():
+        response = client.post(url_for('main.generate_stream'), data={
+            'positive_prompt': 'batch prompt',
+            'ckpt_name': 'SD15/cyberrealistic_classicV31.safetensors',
+            'batch_size': 3,
+        })
+        body = response.get_data(as_text=True)
+        filenames = json.loads(body.split('event: result\ndata: ', 1)[1])['filenames']
+        assert len(set(filenames)) == 2
+        assert [open(output_store.path(name), 'rb').read() for name in filenames] == [b'first', b'third']
+        assert output_store.metadata(filenames[0])['positive_prompt'] == 'batch prompt'
+        assert output_store.metadata(filenames[0])['source'] == 'a.png'
+
+
+def test_saves_paginates_from_index(client, monkeypatch):
+    calls = []
+
+    def fake_page(kind, page, per_page, sort):
+        calls.append((kind, page, sort))
+        return [{'filename': 'generated_i2i_x.png', 'size': 2048, 'created': 0}], per_page + 1
+
+    monkeypatch.setattr(routes.gallery_index, 'page', fake_page)
+    response = client.get('/saves?kind=image_to_image&sort=largest&page=2')
+    assert response.status_code == 200
+    assert calls == [('image_to_image', 2, 'largest')]
+    assert b'generated_i2i_x.png' in response.data
+    assert b'Page 2 of 2' in response.data
+
+
+def test_thumbnail_route_falls_back_and_404s(client, app):
+    generated_dir = output_store.root
+    os.makedirs(generated_dir, exist_ok=True)
+    path = os.path.join(generated_dir, 'generated_thumb_test.png')
+    with open(path, 'wb') as f:
+        f.write(b'not an image')
+    try:
+        response = client.get('/thumb/generated_thumb_test.png')
+        assert response.status_code == 200
+        assert response.data == b'not an image'
+    finally:
+        os.remove(path)
+    assert client.get('/thumb/generated_missing.png').status_code == 404
+
+
+@pytest.fixture
+def generated_file(app):
+    generated_dir = output_store.root
+    os.makedirs(generated_dir, exist_ok=True)
+    path = os.path.join(generated_dir, 'generated_download_test.png')
+    with open(path, 'wb') as f:
+        f.write(b'0123456789')
+    yield 'generated_download_test.png'
+    os.remove(path)
+
+
+def test_download_conditional_and_range(client, generated_file):
+    response = client.get(f'/download/{generated_file}')
+    assert response.status_code == 200
+    assert response.data == b'0123456789'
+    assert 'attachment' in response.headers['Content-Disposition']
+    assert 'immutable' in response.headers['Cache-Control']
+    etag = response.headers['ETag']
+    assert not etag.startswith('W/')
+
+    assert client.get(f'/download/{generated_file}', headers={'If-None-Match': etag}).status_code == 304
+    response = client.get(f'/static/generated/{generated_file}', headers={'Range': 'bytes=2-4'})
+    assert response.status_code == 206
+    assert response.data == b'234'
+    assert client.get('/download/generated_missing.png').status_code == 404
+
+
+def test_download_x_accel_redirect(client, app, generated_file):
+    app.config['SENDFILE_MODE'] = 'x-accel'
+    response = client.get(f'/download/{generated_file}')
+    assert response.status_code == 200
+    assert response.headers['X-Accel-Redirect'] == f'/internal/generated/{generated_file}'
+    assert response.data == b''
+    assert 'attachment' in response.headers['Content-Disposition']
+    etag = response.headers['ETag']
+    assert client.get(f'/download/{generated_file}', headers={'If-None-Match': etag}).status_code == 304
+
+
+def test_x_accel_views_record_access_and_hide_sidecars(client, app, generated_file, monkeypatch):
+    touched = []
+    monkeypatch.setattr(routes.gallery_index, 'touch', touched.append)
+    app.config['SENDFILE_MODE'] = 'x-accel'
+    response = client.get(f'/static/generated/{generated_file}')
+    assert response.headers['X-Accel-Redirect'] == f'/internal/generated/{generated_file}'
+    assert touched == [generated_file]
+
+    sidecar = os.path.join(output_store.root, 'generated_download_test.json')
+    with open(sidecar, 'w') as f:
+        f.write('{}')
+    try:
+        assert client.get('/static/generated/generated_download_test.json').status_code == 404
+    finally:
+        os.remove(sidecar)
+
+
+def test_pin_toggles_and_404s(client, monkeypatch):
+    calls = []
+
+    def fake_set_pinned(filename, pinned=True):
+        calls.append((filename, pinned))
+        return filename != 'generated_missing.png'
+
+    monkeypatch.setattr(routes.gallery_index, 'set_pinned', fake_set_pinned)
+    assert client.post('/pin/generated_a.png').get_json() == {'success': True, 'pinned': True}
+    assert client.post('/pin/generated_a.png', data={'pinned': '0'}).get_json()['pinned'] is False
+    assert client.post('/pin/generated_missing.png').status_code == 404
+    assert calls == [('generated_a.png', True), ('generated_a.png', False), ('generated_missing.png', True)]
+
+
+def test_stored_outputs_resolve_through_the_store(client, app):
+    filename = output_store.save({'image_data': b'stored image', 'file_name': 'x.png', 'seed': 5},
+                                 'text_to_image', {'positive_prompt': 'a red fox'})
+    try:
+        assert client.get(f'/download/{filename}').data == b'stored image'
+        assert client.get(f'/metadata/{filename}').get_json()['seed'] == 5
+        assert b'a red fox' in client.get(f'/result/{filename}').data
+        app.config['SENDFILE_MODE'] = 'x-accel'
+        response = client.get(f'/download/{filename}')
+        assert response.headers['X-Accel-Redirect'] == f'/internal/generated/{filename[10:12]}/{filename}'
+        assert client.post(f'/delete/{filename}').get_json()['success']
+        assert client.get(f'/download/{filename}').status_code == 404
+    finally:
+        app.config['SENDFILE_MODE'] = ''
+        output_store.delete(filename)
+
+
+@patch('app.routes.generate_image')
+def test_generate_rate_limited(mock_generate_image, client, app, tmp_path):
+    from app.admission import admission
+    app.config.update({'WTF_CSRF_ENABLED': False, 'ADMISSION_ENABLED': True, 'ADMISSION_BURST': 1,
+                       'ADMISSION_DB': str(tmp_path / 'admission.sqlite3')})
+    admission.init_app(app)
+    mock_generate_image.side_effect = lambda *args, **kwargs: iter([[]])
+    data = {'positive_prompt': 'limited', 'ckpt_name': 'SD15/cyberrealistic_classicV31.safetensors'}
+    try:
+        assert client.post('/generate/stream', data=data).status_code == 200
+        response = client.post('/generate/stream', data=data)
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) >= 1
+        assert response.json['retry_after'] == int(response.headers['Retry-After'])
+        assert client.get('/admission').get_json()['waiting'] == 0
+    finally:
+        admission.enabled = False
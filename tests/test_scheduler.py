@@ -0,0 +1,118 @@
+import pytest
+from unittest.mock import patch
+from app.backends import BackendPool
+from app.scheduler import CheckpointScheduler, checkpoint_of
+
+URL = "http://localhost:8188"
+
+
+@pytest.fixture
+def scheduler_db(app, tmp_path):
+    app.config['SCHEDULER_DB'] = str(tmp_path / 'scheduler.sqlite3')
+
+
+@pytest.fixture
+def pool(app, scheduler_db):
+    pool = BackendPool()
+    with app.app_context(), patch('app.scheduler.backend_pool', pool):
+        pool.backends()
+        yield pool
+
+
+def test_checkpoint_of():
+    assert checkpoint_of({"4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "a"}}}) == "a"
+    assert checkpoint_of({"3": {"class_type": "KSampler", "inputs": {"seed": 1}}}) is None
+
+
+def test_waiting_jobs_are_grouped_by_loaded_checkpoint(app, pool):
+    app.config['SCHEDULER_MAX_ACTIVE'] = 1
+    scheduler = CheckpointScheduler(app)
+    first = scheduler.request(URL, "sdxl")
+    waiting = [scheduler.request(URL, name) for name in ("sd15", "sdxl", "sd15", "sdxl")]
+    assert first.granted and not any(ticket.granted for ticket in waiting)
+
+    order = [first.ckpt_name]
+    scheduler.release(first)
+    pending = list(waiting)
+    while pending:
+        granted = [ticket for ticket in pending if ticket.granted]
+        assert len(granted) == 1
+        pending.remove(granted[0])
+        order.append(granted[0].ckpt_name)
+        scheduler.release(granted[0])
+
+    assert order == ["sdxl", "sdxl", "sdxl", "sd15", "sd15"]
+    assert pool.status()[0]['checkpoint'] == "sd15"
+    assert scheduler.stats()['swaps'] == {URL: 1}
+    assert scheduler.stats()['loaded'] == {URL: "sd15"}
+
+
+def test_oldest_job_is_not_starved(app, pool):
+    app.config['SCHEDULER_MAX_ACTIVE'] = 1
+    app.config['SCHEDULER_MAX_SKIPS'] = 1
+    scheduler = CheckpointScheduler(app)
+    current = scheduler.request(URL, "sdxl")
+    starving = scheduler.request(URL, "sd15")
+    later = [scheduler.request(URL, "sdxl") for _ in range(3)]
+
+    scheduler.release(current)
+    assert later[0].granted and not starving.granted
+    scheduler.release(later[0])
+    assert starving.granted
+
+
+def test_workers_share_one_queue(app, pool):
+    app.config['SCHEDULER_MAX_ACTIVE'] = 1
+    # Two schedulers on one database stand in for two gunicorn workers
+    worker_a, worker_b = CheckpointScheduler(app), CheckpointScheduler(app)
+    first = worker_a.request(URL, "sdxl")
+    other = worker_b.request(URL, "sd15")
+    same = worker_a.request(URL, "sdxl")
+    assert first.granted and not other.granted and not same.granted
+    assert worker_b.stats()['waiting'] == {URL: 2}
+
+    worker_a.release(first)
+    # The job on the loaded checkpoint goes first even though another worker queued before it
+    assert same.granted and not worker_b.poll(other)
+    worker_a.release(same)
+    assert worker_b.poll(other)
+    worker_b.wait(other, timeout=1)
+    assert worker_a.stats()['swaps'] == {URL: 1}
+
+
+def test_slots_of_exited_workers_are_freed(app, pool):
+    app.config['SCHEDULER_MAX_ACTIVE'] = 1
+    scheduler = CheckpointScheduler(app)
+    with patch('app.scheduler.process_alive', return_value=True):
+        with patch('app.scheduler.os.getpid', return_value=999999):
+            held = scheduler.request(URL, "sdxl")
+        waiting = scheduler.request(URL, "sdxl")
+    assert held.granted and not waiting.granted
+    # The worker holding the slot has gone without releasing it
+    with patch('app.scheduler.process_alive', side_effect=lambda pid: pid != 999999):
+        assert scheduler.poll(waiting)
+
+
+def test_waiters_back_off_between_polls(app, pool):
+    app.config['SCHEDULER_MAX_ACTIVE'] = 1
+    scheduler = CheckpointScheduler(app)
+    scheduler.request(URL, "sdxl")
+    waiting = scheduler.request(URL, "sdxl")
+    with patch.object(scheduler, 'poll', wraps=scheduler.poll) as poll:
+        with pytest.raises(TimeoutError):
+            scheduler.wait(waiting, timeout=2)
+    # Polls at 0, 0.25, 0.75 and 1.75 seconds, then once more at the deadline; a fixed interval would take nine
+    assert poll.call_count <= 5
+
+
+def test_acquire_prefers_backend_with_checkpoint_loaded(app):
+    app.config['COMFYUI_URL'] = "http://a:8188,http://b:8188"
+    with app.app_context():
+        pool = BackendPool()
+        for backend in pool.backends():
+            backend.checked_at = float('inf')
+        pool.note_checkpoint("http://b:8188", "sdxl")
+        pool.backends()[1].queue_depth = 2
+
+        assert pool.acquire("sdxl") == "http://b:8188"
+        assert pool.acquire("sd15") == "http://a:8188"
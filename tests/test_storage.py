@@ -0,0 +1,75 @@
+import os
+import pytest
+from app.storage import OutputStore, output_path, scan_outputs, shard
+
+
+class FakeApp:
+    def __init__(self, tmp_path):
+        self.root_path = str(tmp_path)
+        self.extensions = {}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return OutputStore(FakeApp(tmp_path))
+
+
+def test_save_shards_by_id_and_never_collides(store, tmp_path):
+    image = {'image_data': b'png', 'file_name': 'ComfyUI_0001.png', 'type': 'output', 'seed': 42}
+    first = store.save(image, 'text_to_image', {'positive_prompt': 'same prompt prefix'})
+    second = store.save(image, 'text_to_image', {'positive_prompt': 'same prompt prefix'})
+    assert first != second
+    assert first.startswith('generated_') and not first.startswith('generated_i2i_')
+    path = store.path(first)
+    assert path == os.path.join(str(tmp_path), 'static', 'generated', first[10:12], first)
+    assert open(path, 'rb').read() == b'png'
+    assert store.resolve(first) == path
+    assert store.relative_path(first) == f"{first[10:12]}/{first}"
+
+
+def test_save_moves_streamed_files_and_writes_sidecar(store, tmp_path):
+    streamed = tmp_path / '.download.png'
+    streamed.write_bytes(b'streamed')
+    filename = store.save({'path': str(streamed), 'file_name': 'x.png', 'seed': None}, 'image_to_image',
+                          {'seed': 7, 'ckpt_name': 'model.safetensors', 'trace': {'total_seconds': 1.5}})
+    assert filename.startswith('generated_i2i_')
+    assert not streamed.exists()
+    metadata = store.metadata(filename)
+    assert metadata['kind'] == 'image_to_image'
+    assert metadata['seed'] == 7
+    assert metadata['ckpt_name'] == 'model.safetensors'
+    assert metadata['source'] == 'x.png'
+    assert metadata['trace'] == {'total_seconds': 1.5}
+
+
+def test_delete_removes_image_and_sidecar(store):
+    filename = store.save({'image_data': b'png', 'file_name': 'x.png'}, 'batch_item')
+    sidecar = os.path.splitext(store.path(filename))[0] + '.json'
+    assert os.path.exists(sidecar)
+    assert store.delete(filename)
+    assert not os.path.exists(sidecar)
+    assert store.resolve(filename) is None
+    assert store.metadata(filename) is None
+    assert not store.delete(filename)
+
+
+def test_legacy_flat_files_and_unsafe_names(store, tmp_path):
+    generated_dir = tmp_path / 'static' / 'generated'
+    generated_dir.mkdir(parents=True)
+    (generated_dir / 'generated_a cat.png').write_bytes(b'old')
+    assert shard('generated_a cat.png') == ''
+    assert store.resolve('generated_a cat.png') == str(generated_dir / 'generated_a cat.png')
+    assert store.metadata('generated_a cat.png') is None
+    for name in ('../secret.png', '.hidden.png', ''):
+        assert store.resolve(name) is None
+        with pytest.raises(ValueError):
+            output_path(str(generated_dir), name)
+
+
+def test_scan_outputs_covers_shards_and_flat_files(store, tmp_path):
+    new = store.save({'image_data': b'abc', 'file_name': 'x.png'}, 'text_to_image')
+    (tmp_path / 'static' / 'generated' / 'generated_old.png').write_bytes(b'x')
+    (tmp_path / 'static' / 'generated' / '.partial.png').write_bytes(b'x')
+    found = scan_outputs(store.root)
+    assert sorted(found) == sorted([new, 'generated_old.png'])
+    assert found[new][0] == 3
@@ -0,0 +1,66 @@
+import pytest
+from app.thumbnails import ThumbnailService, make_thumbnail, thumbnail_name
+
+Image = pytest.importorskip("PIL.Image")
+
+
+class FakeApp:
+    def __init__(self, tmp_path, workers=0):
+        self.config = {'THUMBNAIL_DIR': str(tmp_path / 'thumbs'), 'THUMBNAIL_SIZE': 64,
+                       'THUMBNAIL_QUALITY': 80, 'THUMBNAIL_WORKERS': workers}
+        self.root_path = str(tmp_path)
+        self.extensions = {}
+
+
+def write_png(path, size=(512, 256)):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    Image.new('RGB', size, (200, 30, 30)).save(path)
+
+
+def test_make_thumbnail(tmp_path):
+    write_png(tmp_path / 'generated_a.png')
+    size = make_thumbnail(str(tmp_path / 'generated_a.png'), str(tmp_path / 'a.webp'), 64, 80)
+    assert size > 0
+    with Image.open(tmp_path / 'a.webp') as thumb:
+        assert thumb.format == 'WEBP'
+        assert thumb.size == (64, 32)
+
+
+def test_submit_inline_and_ensure_lazily(tmp_path):
+    service = ThumbnailService(FakeApp(tmp_path))
+    write_png(tmp_path / 'static' / 'generated' / 'generated_a.png')
+    write_png(tmp_path / 'static' / 'generated' / 'generated_b.png')
+
+    assert service.submit('generated_a.png') is None
+    assert (tmp_path / 'thumbs' / thumbnail_name('generated_a.png')).exists()
+    assert not (tmp_path / 'thumbs' / 'generated_b.webp').exists()
+    assert service.ensure('generated_b.png') == str(tmp_path / 'thumbs' / 'generated_b.webp')
+    assert (tmp_path / 'thumbs' / 'generated_b.webp').exists()
+    assert service.stats()['thumbnails_created'] == 2
+
+    service.remove('generated_b.png')
+    service.remove('generated_b.png')
+    assert not (tmp_path / 'thumbs' / 'generated_b.webp').exists()
+
+
+def test_submit_logs_failures(tmp_path):
+    service = ThumbnailService(FakeApp(tmp_path))
+    (tmp_path / 'static' / 'generated').mkdir(parents=True)
+    (tmp_path / 'static' / 'generated' / 'generated_bad.png').write_bytes(b'not an image')
+    service.submit('generated_bad.png')
+    assert service.stats()['thumbnails_failed'] == 1
+    assert list((tmp_path / 'thumbs').iterdir()) == []
+
+
+def test_backfill(tmp_path):
+    service = ThumbnailService(FakeApp(tmp_path, workers=2))
+    for name in ('generated_a.png', 'generated_b.png'):
+        write_png(tmp_path / 'static' / 'generated' / name)
+    (tmp_path / 'static' / 'generated' / 'generated_bad.png').write_bytes(b'not an image')
+
+    created, failed, elapsed = service.backfill()
+    assert (created, failed) == (2, 1)
+    assert sorted(p.name for p in (tmp_path / 'thumbs').iterdir()) == ['generated_a.webp', 'generated_b.webp']
+    assert service.backfill()[:2] == (0, 1)
+    # Forking a threaded worker can hand the pool a copy of a lock some other thread held
+    assert service._executor()._mp_context.get_start_method() == 'spawn'
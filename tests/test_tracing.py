@@ -0,0 +1,60 @@
+import logging
+import pstats
+from app import tracing
+from app.metrics import Stages
+from app.tracing import Trace
+
+
+def test_stages_are_recorded_in_the_active_trace():
+    trace = Trace('text_to_image')
+    assert Stages().trace is None
+    with trace.activate():
+        assert tracing.current() is trace
+        stages = Stages('wf.json', 'ckpt')
+        with stages.stage('queue_prompt'):
+            pass
+        stages.observe('execution', 2.5)
+    assert tracing.current() is None
+
+    data = trace.to_dict()
+    assert [span['stage'] for span in data['stages']] == ['queue_prompt', 'execution']
+    assert data['stages'][1]['seconds'] == 2.5
+    assert data['total_seconds'] >= 0
+    assert data['profile'] is None
+
+
+def test_slow_requests_are_logged(caplog):
+    trace = Trace('image_to_image', slow_seconds=0)
+    with caplog.at_level(logging.WARNING, logger='app.tracing'):
+        with trace.activate():
+            trace.add('execution', 1.0)
+    assert 'execution=1.000s' in caplog.text
+
+    caplog.clear()
+    with caplog.at_level(logging.WARNING, logger='app.tracing'):
+        with Trace('image_to_image', slow_seconds=60).activate():
+            pass
+    assert caplog.text == ''
+
+
+def test_profiled_trace_saves_report(tmp_path):
+    trace = Trace('text_to_image', profile_dir=str(tmp_path))
+    with trace.activate():
+        sum(range(1000))
+    assert trace.to_dict()['profile'] == f"text_to_image_{trace.id}.prof"
+    pstats.Stats(trace.profile_path)
+
+
+def test_generation_response_includes_trace(app):
+    from app.routes import _run_generation
+    trace = Trace('text_to_image')
+    images = [{'image_data': b'data', 'file_name': 'x.png', 'type': 'output'}]
+    with app.test_request_context():
+        filenames = _run_generation(iter(["Progress: 1/1 tasks done", images]), {'kind': 'text_to_image'},
+                                    trace=trace)
+    from app.models import gallery_index
+    from app.storage import output_store
+    assert output_store.metadata(filenames[0])['trace']['trace_id'] == trace.id
+    output_store.delete(filenames[0])
+    gallery_index.remove(filenames[0])
+    assert [span['stage'] for span in trace.to_dict()['stages']] == ['disk_write']
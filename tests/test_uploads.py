@@ -0,0 +1,26 @@
+import hashlib
+import io
+from werkzeug.datastructures import FileStorage
+from app.uploads import is_content_addressed, save_upload
+
+
+def test_save_upload_is_content_addressed(tmp_path):
+    content = b"test image content"
+    path = save_upload(FileStorage(io.BytesIO(content), filename="input.PNG"), str(tmp_path))
+    assert path == str(tmp_path / f"{hashlib.sha256(content).hexdigest()}.png")
+    assert open(path, "rb").read() == content
+    assert is_content_addressed(path)
+
+
+def test_identical_uploads_share_one_file(tmp_path):
+    first = save_upload(FileStorage(io.BytesIO(b"same"), filename="a.jpg"), str(tmp_path))
+    second = save_upload(FileStorage(io.BytesIO(b"same"), filename="b.jpg"), str(tmp_path))
+    other = save_upload(FileStorage(io.BytesIO(b"different"), filename="a.jpg"), str(tmp_path))
+    assert first == second
+    assert other != first
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted({first.split('/')[-1], other.split('/')[-1]})
+
+
+def test_is_content_addressed():
+    assert not is_content_addressed("input.png")
+    assert is_content_addressed("static/uploads/" + "a" * 64 + ".jpg")
@@ -3,15 +3,9 @@ import json
 from unittest.mock import Mock, patch
 from app.utils import (open_websocket_connection, queue_prompt, get_image,
                        upload_image, get_history, track_progress, generate_image,
-                       generate_image_to_image)
-
-@pytest.fixture
-def app():
-    from app import create_app
-    app = create_app()
-    app.config['TESTING'] = True
-    app.config['COMFYUI_URL'] = 'http://localhost:8188'
-    return app
+                       generate_image_to_image, get_session,
+                       get_images_from_history, save_image, ensure_uploaded)
+from app.websocket_manager import close_websocket_managers
 
 @pytest.fixture
 def mock_websocket():
@@ -19,11 +13,12 @@ def mock_websocket():
         mock_ws_instance = Mock()
         mock_ws.return_value = mock_ws_instance
         yield mock_ws_instance
+        close_websocket_managers()
 
 @pytest.fixture
 def mock_requests():
-    with patch('app.utils.requests') as mock_req:
-        yield mock_req
+    with patch('app.utils.get_session') as mock_get_session:
+        yield mock_get_session.return_value
 
 def test_open_websocket_connection(app, mock_websocket):
     with app.app_context():
@@ -151,4 +146,90 @@ def test_generate_image_to_image(mock_websocket, mock_requests, tmp_path, app):
         images = next(result)
         assert len(images) == 1
         assert images[0]["file_name"] == "test_output.png"
-        assert images[0]["image_data"] == b"image_data"
\ No newline at end of file
+        assert images[0]["image_data"] == b"image_data"
+
+
+def test_get_session_is_pooled(app, monkeypatch):
+    monkeypatch.setattr('app.utils._sessions', {})
+    with app.app_context():
+        app.config['COMFYUI_POOL_SIZE'] = 7
+        session = get_session()
+        assert get_session() is session
+        adapter = session.get_adapter("http://localhost:8188/view")
+        assert adapter._pool_maxsize == 7
+        assert adapter.max_retries.allowed_methods == frozenset(['GET'])
+        assert session.timeout == (app.config['COMFYUI_CONNECT_TIMEOUT'], app.config['COMFYUI_READ_TIMEOUT'])
+
+
+def test_get_images_from_history_keeps_order_and_reports_failures(app):
+    history = {"outputs": {
+        "9": {"images": [{"filename": f"out_{i}.png", "subfolder": "", "type": "output"} for i in range(4)]},
+        "10": {"images": [{"filename": "preview.png", "subfolder": "", "type": "temp"}]},
+    }}
+
+    def fake_get_image(filename, subfolder, folder_type, server_address):
+        if filename == "out_2.png":
+            raise ConnectionError("connection reset")
+        return filename.encode()
+
+    with app.app_context(), patch('app.utils.get_image', side_effect=fake_get_image):
+        images = get_images_from_history(history, "server_address")
+
+    assert [image["file_name"] for image in images] == ["out_0.png", "out_1.png", "out_2.png", "out_3.png"]
+    assert images[0]["image_data"] == b"out_0.png"
+    assert images[2]["image_data"] is None
+    assert images[2]["error"] == "connection reset"
+    assert "error" not in images[3]
+
+
+def test_save_image_streams_to_disk(app, mock_requests, tmp_path):
+    with app.app_context():
+        response = mock_requests.get.return_value.__enter__.return_value
+        response.iter_content.return_value = [b"chunk1", b"chunk2"]
+        dest = tmp_path / "out.png"
+
+        size = save_image("out.png", "", "output", "server_address", str(dest))
+
+        assert size == 12
+        assert dest.read_bytes() == b"chunk1chunk2"
+        assert mock_requests.get.call_args.kwargs["stream"] is True
+        assert not (tmp_path / "out.png.part").exists()
+
+
+def test_ensure_uploaded_skips_known_inputs(app, mock_requests, tmp_path, monkeypatch):
+    monkeypatch.setattr('app.utils._uploaded_inputs', set())
+    p = tmp_path / ("b" * 64 + ".png")
+    p.write_bytes(b"test image content")
+    with app.app_context():
+        mock_requests.head.return_value.status_code = 404
+        assert ensure_uploaded(str(p), p.name, "server_address") is True
+        assert ensure_uploaded(str(p), p.name, "server_address") is False
+        assert mock_requests.post.call_count == 1
+
+        mock_requests.head.return_value.status_code = 200
+        assert ensure_uploaded(str(p), p.name, "other_server") is False
+        assert mock_requests.post.call_count == 1
+
+
+def test_track_progress_reports_execution_start(mock_websocket):
+    mock_websocket.recv.side_effect = [
+        json.dumps({"type": "execution_start", "data": {"prompt_id": "other_id"}}),
+        json.dumps({"type": "execution_start", "data": {"prompt_id": "test_id"}}),
+        json.dumps({"type": "executing", "data": {"node": None, "prompt_id": "test_id"}})
+    ]
+    started = []
+    assert list(track_progress({"1": {}}, mock_websocket, "test_id", on_start=lambda: started.append(True))) == []
+    assert started == [True]
+
+
+def test_track_progress_raises_instead_of_looping(mock_websocket):
+    mock_websocket.recv.side_effect = [ConnectionError("WebSocket connection lost"), AssertionError("looped")]
+    with pytest.raises(ConnectionError):
+        list(track_progress({"1": {}}, mock_websocket, "test_id"))
+
+    from app.utils import PromptFailed
+    mock_websocket.recv.side_effect = [
+        json.dumps({"type": "execution_interrupted", "data": {"prompt_id": "test_id", "node_id": "3"}})
+    ]
+    with pytest.raises(PromptFailed, match="execution_interrupted"):
+        list(track_progress({"1": {}}, mock_websocket, "test_id"))
@@ -0,0 +1,64 @@
+import json
+import struct
+import pytest
+from app.websocket_manager import WebSocketManager
+
+
+@pytest.fixture
+def manager():
+    return WebSocketManager("http://localhost:8188")
+
+
+def test_messages_are_routed_by_prompt_id(manager):
+    first = manager.subscribe("first")
+    second = manager.subscribe("second")
+
+    manager._dispatch(json.dumps({"type": "executing", "data": {"node": "3", "prompt_id": "second"}}))
+    manager._dispatch(json.dumps({"type": "executing", "data": {"node": "3", "prompt_id": "first"}}))
+
+    assert json.loads(first.recv(timeout=1))["data"]["prompt_id"] == "first"
+    assert json.loads(second.recv(timeout=1))["data"]["prompt_id"] == "second"
+    assert first.queue.empty() and second.queue.empty()
+
+
+def test_messages_without_prompt_id_go_to_executing_prompt(manager):
+    subscription = manager.subscribe("test_id")
+    manager._dispatch(json.dumps({"type": "execution_start", "data": {"prompt_id": "test_id"}}))
+    manager._dispatch(json.dumps({"type": "progress", "data": {"value": 1, "max": 20}}))
+    manager._dispatch(b"binary preview frame")
+    manager._dispatch(json.dumps({"type": "status", "data": {"status": {}}}))
+
+    subscription.recv(timeout=1)
+    assert json.loads(subscription.recv(timeout=1))["type"] == "progress"
+    assert subscription.recv(timeout=1) == b"binary preview frame"
+    assert subscription.queue.empty()
+
+
+def test_early_messages_are_replayed_on_subscribe(manager):
+    manager._dispatch(json.dumps({"type": "executing", "data": {"node": None, "prompt_id": "test_id"}}))
+    subscription = manager.subscribe("test_id")
+    assert json.loads(subscription.recv(timeout=1))["data"]["node"] is None
+    assert manager._current_prompt_id is None
+
+
+def test_connection_loss_fails_subscribers(manager):
+    subscription = manager.subscribe("test_id")
+    manager._fail_subscriptions(OSError("reset"))
+    with pytest.raises(ConnectionError):
+        subscription.recv(timeout=1)
+
+    subscription.close()
+    assert "test_id" not in manager._subscriptions
+
+
+def test_preview_frames_with_metadata_are_routed_by_prompt_id(manager):
+    first = manager.subscribe("first")
+    second = manager.subscribe("second")
+    manager._dispatch(json.dumps({"type": "execution_start", "data": {"prompt_id": "first"}}))
+    metadata = json.dumps({"image_type": "image/jpeg", "prompt_id": "second"}).encode("utf-8")
+    frame = struct.pack(">II", 4, len(metadata)) + metadata + b"jpeg"
+    manager._dispatch(frame)
+
+    first.recv(timeout=1)
+    assert first.queue.empty()
+    assert second.recv(timeout=1) == frame
@@ -0,0 +1,57 @@
+import json
+import os
+import pytest
+from app.workflows import WorkflowTemplate, WorkflowRegistry
+
+WORKFLOW = {
+    "3": {"class_type": "KSampler", "inputs": {"seed": 1, "positive": ["6", 0], "negative": ["7", 0]}},
+    "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "a.safetensors"}},
+    "5": {"class_type": "EmptyLatentImage", "inputs": {"width": 512}},
+    "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "positive"}},
+    "7": {"class_type": "CLIPTextEncode", "inputs": {"text": "negative"}},
+}
+
+
+class FakeApp:
+    def __init__(self, workflows_dir):
+        self.config = {'WORKFLOWS_DIR': str(workflows_dir)}
+        self.extensions = {}
+
+
+def test_template_indexes_node_roles():
+    template = WorkflowTemplate(WORKFLOW)
+    assert template.node_id('KSampler') == "3"
+    assert template.node_id('EmptyLatentImage') == "5"
+    assert template.positive_id == "6"
+    assert template.negative_id == "7"
+    with pytest.raises(ValueError, match="LoadImage not found in the workflow"):
+        template.node_id('LoadImage')
+
+
+def test_template_copy_does_not_modify_template():
+    template = WorkflowTemplate(json.loads(json.dumps(WORKFLOW)))
+    prompt = template.copy()
+    prompt["3"]["inputs"]["seed"] = 42
+    prompt["6"]["inputs"]["text"] = "changed"
+    assert template.graph["3"]["inputs"]["seed"] == 1
+    assert template.graph["6"]["inputs"]["text"] == "positive"
+
+
+def test_registry_caches_and_reloads_on_mtime_change(tmp_path):
+    path = tmp_path / "base_workflow.json"
+    path.write_text(json.dumps(WORKFLOW))
+    registry = WorkflowRegistry(FakeApp(tmp_path))
+
+    template = registry.get("base_workflow.json")
+    assert registry.get("base_workflow.json") is template
+    assert registry.names() == ["base_workflow.json"]
+
+    changed = dict(WORKFLOW, **{"4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "b"}}})
+    path.write_text(json.dumps(changed))
+    os.utime(path, (template.mtime + 10, template.mtime + 10))
+    reloaded = registry.get("base_workflow.json")
+    assert reloaded is not template
+    assert reloaded.graph["4"]["inputs"]["ckpt_name"] == "b"
+
+    with pytest.raises(FileNotFoundError):
+        registry.get("missing.json")